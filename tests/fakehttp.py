@@ -0,0 +1,111 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""In-process HTTP server serving files from a dict, for tests"""
+
+import hashlib
+import http.server
+import json
+import threading
+
+import fixtures
+
+
+class FakeHTTPHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body=b'', headers={}):
+        self.send_response(code)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _route(self):
+        self.server.requests.append(
+            (self.command, self.path, dict(self.headers)))
+        self.server.connections.add(self.client_address)
+        handler = getattr(self, 'handle_' + self.command)
+        handler()
+
+    do_GET = do_HEAD = do_PUT = do_POST = _route
+
+    def handle_GET(self):
+        if self.path not in self.server.files:
+            return self.send(404)
+        data = self.server.files[self.path]
+        etag = '"%s"' % hashlib.sha256(data).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304, headers={'ETag': etag})
+        self.send(200, data, {'ETag': etag})
+
+    handle_HEAD = handle_GET
+
+    def handle_PUT(self):
+        if self.headers.get('X-Checksum-Deploy') == 'true':
+            sha1 = self.headers.get('X-Checksum-Sha1')
+            for data in list(self.server.files.values()):
+                if hashlib.sha1(data).hexdigest() == sha1:
+                    break
+            else:
+                return self.send(404)
+        else:
+            data = self.body()
+        self.server.files[self.path] = data
+        self.send(201, json.dumps({'checksums': {
+            'sha1': hashlib.sha1(data).hexdigest(),
+            'sha256': hashlib.sha256(data).hexdigest()}}).encode())
+
+    def handle_POST(self):
+        self.send(405)
+
+
+class FakeHTTPServer(fixtures.Fixture):
+    """HTTP server running in a thread of the test process
+
+    files maps paths to the content served, PUT requests are stored in it.
+    GET responses have an ETag, and If-None-Match is honoured. PUT requests
+    support Artifactory's checksum deploy of content already in files.
+    requests records (method, path, headers) of every request made, and
+    connections the distinct client addresses that connected.
+    """
+
+    def __init__(self, handler=FakeHTTPHandler):
+        super().__init__()
+        self.handler = handler
+
+    def _setUp(self):
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), self.handler)
+        self.server.daemon_threads = True
+        self.server.files = self.files = {}
+        self.server.requests = self.requests = []
+        self.server.connections = self.connections = set()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
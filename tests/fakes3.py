@@ -0,0 +1,178 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""In-process S3 compatible server, for tests
+
+Implements enough of the S3 API for boto3 transfers: objects are put, read
+with ranges and heads, and uploaded in multiple parts. Buckets exist as soon
+as they are used and addressing is path style.
+"""
+
+import hashlib
+import threading
+import time
+import urllib.parse
+import uuid
+
+import boto3
+import botocore.config
+
+import tests.fakehttp
+
+
+class FakeS3Handler(tests.fakehttp.FakeHTTPHandler):
+
+    def _start(self):
+        url = urllib.parse.urlsplit(self.path)
+        self.key = urllib.parse.unquote(url.path)
+        self.query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        time.sleep(server.delay)
+
+    def _route(self):
+        self._start()
+        try:
+            super()._route()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    do_GET = do_HEAD = do_PUT = do_POST = _route
+
+    def payload(self):
+        body = self.body()
+        if 'aws-chunked' not in self.headers.get('Content-Encoding', ''):
+            return body
+        # Chunks of "<hex size>[;signature]\r\n<data>\r\n", then trailers.
+        data = b''
+        while True:
+            line, body = body.split(b'\r\n', 1)
+            size = int(line.split(b';')[0], 16)
+            if not size:
+                return data
+            data += body[:size]
+            body = body[size + 2:]
+
+    def send_xml(self, xml, headers={}):
+        self.send(200, xml.encode(), dict(
+            headers, **{'Content-Type': 'application/xml'}))
+
+    def object_headers(self, obj):
+        headers = {'ETag': obj['etag'], 'Accept-Ranges': 'bytes',
+                   'Last-Modified': 'Tue, 01 Jan 2019 00:00:00 GMT'}
+        for k, v in obj['metadata'].items():
+            headers['x-amz-meta-' + k] = v
+        return headers
+
+    def handle_GET(self):
+        obj = self.server.objects.get(self.key)
+        if obj is None:
+            return self.send(404, headers={'x-amz-error-code': 'NoSuchKey'})
+        data = obj['data']
+        headers = self.object_headers(obj)
+        if 'Range' in self.headers:
+            start, end = self.headers['Range'][len('bytes='):].split('-')
+            start = int(start)
+            end = min(int(end or len(data) - 1), len(data) - 1)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, end, len(data))
+            return self.send(206, data[start:end + 1], headers)
+        self.send(200, data, headers)
+
+    handle_HEAD = handle_GET
+
+    def handle_PUT(self):
+        data = self.payload()
+        if 'uploadId' in self.query:
+            upload = self.server.uploads[self.query['uploadId'][0]]
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            upload['parts'][int(self.query['partNumber'][0])] = data
+            return self.send(200, headers={'ETag': etag})
+        metadata = {
+            k[len('x-amz-meta-'):].lower(): v
+            for k, v in self.headers.items()
+            if k.lower().startswith('x-amz-meta-')}
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self.server.objects[self.key] = {
+            'data': data, 'etag': etag, 'metadata': metadata}
+        self.server.puts.append(self.key)
+        self.send(200, headers={'ETag': etag})
+
+    def handle_POST(self):
+        self.payload()
+        if 'uploads' in self.query:
+            upload_id = uuid.uuid4().hex
+            metadata = {
+                k[len('x-amz-meta-'):].lower(): v
+                for k, v in self.headers.items()
+                if k.lower().startswith('x-amz-meta-')}
+            self.server.uploads[upload_id] = {
+                'parts': {}, 'metadata': metadata}
+            bucket, key = self.key.lstrip('/').split('/', 1)
+            return self.send_xml(
+                '<InitiateMultipartUploadResult><Bucket>%s</Bucket>'
+                '<Key>%s</Key><UploadId>%s</UploadId>'
+                '</InitiateMultipartUploadResult>' % (bucket, key, upload_id))
+        if 'uploadId' in self.query:
+            upload = self.server.uploads.pop(self.query['uploadId'][0])
+            parts = [upload['parts'][n] for n in sorted(upload['parts'])]
+            md5s = b''.join(hashlib.md5(p).digest() for p in parts)
+            etag = '"%s-%d"' % (hashlib.md5(md5s).hexdigest(), len(parts))
+            self.server.objects[self.key] = {
+                'data': b''.join(parts), 'etag': etag,
+                'metadata': upload['metadata']}
+            self.server.puts.append(self.key)
+            return self.send_xml(
+                '<CompleteMultipartUploadResult><ETag>%s</ETag>'
+                '</CompleteMultipartUploadResult>' % etag)
+        self.send(405)
+
+
+class FakeS3Server(tests.fakehttp.FakeHTTPServer):
+    """S3 compatible server running in a thread of the test process
+
+    objects maps "/bucket/key" to dicts of the object's data, etag and
+    metadata, and puts lists the keys written. Every request is delayed by
+    delay seconds, and max_active is the most requests handled at once.
+    """
+
+    def __init__(self, handler=FakeS3Handler, delay=0):
+        super().__init__(handler)
+        self.delay = delay
+
+    def _setUp(self):
+        super()._setUp()
+        self.server.objects = self.objects = {}
+        self.server.uploads = {}
+        self.server.puts = self.puts = []
+        self.server.lock = threading.Lock()
+        self.server.active = 0
+        self.server.max_active = 0
+        self.server.delay = self.delay
+
+    @property
+    def max_active(self):
+        return self.server.max_active
+
+    def client(self):
+        return boto3.client(
+            's3', endpoint_url=self.url, region_name='us-east-1',
+            aws_access_key_id='key', aws_secret_access_key='secret',
+            config=botocore.config.Config(
+                s3={'addressing_style': 'path'}, max_pool_connections=20))
@@ -0,0 +1,123 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import errno
+import hashlib
+import os
+import unittest.mock
+
+import fixtures
+import testtools
+
+import windlass.cache
+
+
+class TestDiskCache(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dir = self.useFixture(fixtures.TempDir()).path
+        self.cache = windlass.cache.DiskCache(
+            'test', max_size=250, cache_dir=self.dir)
+
+    def put(self, key, data, mtime):
+        with self.cache.put(key) as fp:
+            fp.write(data)
+        os.utime(self.cache.path(key), (mtime, mtime))
+
+    def test_put_open(self):
+        self.assertIsNone(self.cache.open('a'))
+        self.put('a', b'data', 1)
+        with self.cache.open('a') as fp:
+            self.assertEqual(b'data', fp.read())
+
+    def test_failed_put_not_cached(self):
+        def put():
+            with self.cache.put('a') as fp:
+                fp.write(b'partial')
+                raise ValueError()
+        self.assertRaises(ValueError, put)
+        self.assertIsNone(self.cache.open('a'))
+        self.assertEqual([], os.listdir(self.dir))
+
+    def test_least_recently_used_evicted(self):
+        self.put('a', b'a' * 100, 1)
+        self.put('b', b'b' * 100, 2)
+        # Reading a makes b the least recently used.
+        self.cache.open('a').close()
+        self.put('c', b'c' * 100, 3)
+        self.assertIsNone(self.cache.open('b'))
+        self.assertIsNotNone(self.cache.open('a'))
+        self.assertIsNotNone(self.cache.open('c'))
+
+    def test_make_key(self):
+        self.assertEqual(
+            windlass.cache.make_key('a', {'x': 1, 'y': 2}),
+            windlass.cache.make_key('a', {'y': 2, 'x': 1}))
+        self.assertNotEqual(
+            windlass.cache.make_key('a', 1), windlass.cache.make_key('a', 2))
+
+
+class TestDownloadCache(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = windlass.cache.DownloadCache(
+            cache_dir=self.useFixture(fixtures.TempDir()).path)
+        self.tmp = self.useFixture(fixtures.TempDir()).path
+        self.path = os.path.join(self.tmp, 'app.tgz')
+        with open(self.path, 'wb') as fp:
+            fp.write(b'data')
+        self.digest = hashlib.sha256(b'data').hexdigest()
+        self.other = os.path.join(self.tmp, 'other.tgz')
+
+    def read(self, path):
+        with open(path, 'rb') as fp:
+            return fp.read()
+
+    def test_by_digest(self):
+        self.assertFalse(self.cache.get(self.other, self.digest))
+        self.cache.add(self.path, self.digest)
+        self.assertTrue(self.cache.get(self.other, self.digest))
+        self.assertEqual(b'data', self.read(self.other))
+        self.assertTrue(os.path.samefile(self.path, self.other))
+
+    def test_by_url(self):
+        self.cache.add(self.path, self.digest, 'http://a/app.tgz', '1.0')
+        self.assertFalse(
+            self.cache.get(self.other, url='http://a/app.tgz', version='2.0'))
+        self.assertTrue(
+            self.cache.get(self.other, url='http://a/app.tgz', version='1.0'))
+        self.assertEqual(b'data', self.read(self.other))
+
+    def test_copied_across_filesystems(self):
+        with unittest.mock.patch(
+                'os.link', side_effect=OSError(errno.EXDEV, 'cross-device')):
+            self.cache.add(self.path, self.digest)
+            self.assertTrue(self.cache.get(self.other, self.digest))
+        self.assertEqual(b'data', self.read(self.other))
+        self.assertFalse(os.path.samefile(self.path, self.other))
+        self.assertEqual(
+            ['app.tgz', 'other.tgz'], sorted(os.listdir(self.tmp)))
+
+    def test_modified_file_removed(self):
+        self.cache.add(self.path, self.digest)
+        # Modifying the linked file modifies the cached file.
+        with open(self.path, 'wb') as fp:
+            fp.write(b'changed')
+        self.assertFalse(self.cache.get(self.other, self.digest))
+        self.assertFalse(os.path.exists(self.other))
+        self.assertFalse(self.cache.get(self.other, self.digest))
@@ -14,14 +14,17 @@
 # under the License.
 #
 
+import hashlib
 import io
 import os
 import shutil
 import tarfile
 import tempfile
+import unittest.mock
 import yaml
 
 import docker
+import fixtures
 import git
 import requests
 import testtools
@@ -30,6 +33,9 @@ import windlass.charts
 import windlass.exc
 import windlass.images
 import windlass.tools
+import windlass.transport
+
+import tests.fakehttp
 
 
 class TestCharts(testtools.TestCase):
@@ -144,3 +150,535 @@ class TestCharts(testtools.TestCase):
         for text in ['non_existing', 'ubuntu', 'ubuntu/values.yaml']:
             self.assertIn(text, str(e))
             self.assertIn(text, debug_message)
+
+
+class TestChartRepository(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixtures.MockPatch('time.sleep'))
+        self.useFixture(fixtures.EnvironmentVariable(
+            'WINDLASS_CACHE_DIR', self.useFixture(fixtures.TempDir()).path))
+        self.useFixture(fixtures.MockPatchObject(
+            windlass.charts, '_indexes', {}))
+        self.useFixture(fixtures.MockPatchObject(
+            windlass.transport, '_no_checksum_deploy', set()))
+        self.cwd = self.useFixture(fixtures.TempDir()).path
+        saved_cwd = os.getcwd()
+        os.chdir(self.cwd)
+        self.addCleanup(os.chdir, saved_cwd)
+
+        self.server = self.useFixture(tests.fakehttp.FakeHTTPServer())
+        self.data = os.urandom(3 * windlass.charts.CHUNK_SIZE + 10)
+        self.server.files['/charts/mychart-1.0.0.tgz'] = self.data
+        self.set_index(hashlib.sha256(self.data).hexdigest())
+        self.chart = windlass.charts.Chart({'name': 'mychart'})
+
+    def set_index(self, digest):
+        self.server.files['/charts/index.yaml'] = yaml.safe_dump({
+            'apiVersion': 'v1',
+            'entries': {'mychart': [
+                {'version': '0.9.0', 'digest': 'bad',
+                 'urls': ['mychart-0.9.0.tgz']},
+                {'version': '1.0.0', 'digest': digest,
+                 'urls': ['mychart-1.0.0.tgz']},
+            ]},
+        }).encode()
+
+    def download(self):
+        self.chart.download(
+            version='1.0.0', charts_url=self.server.url + '/charts')
+
+    def chart_gets(self):
+        return [r for r in self.server.requests
+                if r[:2] == ('GET', '/charts/mychart-1.0.0.tgz')]
+
+    def test_download(self):
+        self.download()
+        with open('mychart-1.0.0.tgz', 'rb') as fp:
+            self.assertEqual(self.data, fp.read())
+        self.assertEqual(['mychart-1.0.0.tgz'], os.listdir(self.cwd))
+
+    def test_chart_url_from_index(self):
+        data = self.server.files.pop('/charts/mychart-1.0.0.tgz')
+        self.server.files['/charts/stable/mychart-1.0.0.tgz'] = data
+        self.set_index(hashlib.sha256(data).hexdigest())
+        index = yaml.safe_load(self.server.files['/charts/index.yaml'])
+        index['entries']['mychart'][1]['urls'] = [
+            self.server.url + '/charts/stable/mychart-1.0.0.tgz']
+        self.server.files['/charts/index.yaml'] = yaml.safe_dump(
+            index).encode()
+        self.download()
+        with open('mychart-1.0.0.tgz', 'rb') as fp:
+            self.assertEqual(self.data, fp.read())
+
+    def test_index_fetched_once_per_run(self):
+        self.download()
+        self.download()
+        index_gets = [r for r in self.server.requests
+                      if r[1] == '/charts/index.yaml']
+        self.assertEqual(1, len(index_gets))
+
+        # The next run revalidates the index kept on disk.
+        windlass.charts._indexes.clear()
+        self.download()
+        self.assertEqual(
+            self.server.requests[-1][2]['If-None-Match'],
+            '"%s"' % hashlib.sha256(
+                self.server.files['/charts/index.yaml']).hexdigest())
+        self.assertIsNotNone(
+            windlass.charts.get_index(self.server.url + '/charts').get(
+                'mychart', '1.0.0'))
+
+    def upload(self, version, **kwargs):
+        with open('mychart-%s.tgz' % version, 'wb') as fp:
+            fp.write(b'chart')
+        chart = windlass.charts.Chart({'name': 'mychart', 'version': version})
+        chart.upload(charts_url=self.server.url + '/charts', **kwargs)
+
+    def test_upload_skips_indexed_chart(self):
+        self.upload('1.0.0')
+        self.assertEqual(
+            [('GET', '/charts/index.yaml')],
+            [r[:2] for r in self.server.requests])
+
+    def test_upload_new_chart(self):
+        self.upload('2.0.0')
+        # The checksum deploy is refused, so the chart is uploaded.
+        self.assertEqual(
+            [('GET', '/charts/index.yaml'),
+             ('PUT', '/charts/mychart-2.0.0.tgz'),
+             ('PUT', '/charts/mychart-2.0.0.tgz')],
+            [r[:2] for r in self.server.requests])
+        self.assertEqual(
+            hashlib.sha256(
+                self.server.files['/charts/mychart-2.0.0.tgz']).hexdigest(),
+            self.server.requests[-1][2]['X-Checksum-Sha256'])
+
+    def test_upload_by_checksum(self):
+        self.upload('2.0.0')
+        del self.server.files['/charts/index.yaml']
+        self.useFixture(fixtures.MockPatchObject(
+            windlass.charts, '_indexes', {}))
+        self.server.requests.clear()
+        self.upload('2.0.0', allow_clobber=True)
+        self.assertEqual(
+            [('GET', '/charts/index.yaml'),
+             ('PUT', '/charts/mychart-2.0.0.tgz')],
+            [r[:2] for r in self.server.requests])
+        self.assertEqual('true', self.server.requests[-1][2][
+            'X-Checksum-Deploy'])
+
+    def test_upload_without_index(self):
+        del self.server.files['/charts/index.yaml']
+        self.upload('1.0.0')
+        self.assertEqual(
+            [('GET', '/charts/index.yaml'),
+             ('HEAD', '/charts/mychart-1.0.0.tgz')],
+            [r[:2] for r in self.server.requests])
+
+    def test_verified_chart_skipped(self):
+        self.download()
+        self.download()
+        self.assertEqual(1, len(self.chart_gets()))
+
+        # A modified chart is downloaded again.
+        with open('mychart-1.0.0.tgz', 'wb') as fp:
+            fp.write(b'truncated')
+        self.download()
+        self.assertEqual(2, len(self.chart_gets()))
+        with open('mychart-1.0.0.tgz', 'rb') as fp:
+            self.assertEqual(self.data, fp.read())
+
+    def test_download_cached(self):
+        self.download()
+        os.chdir(self.useFixture(fixtures.TempDir()).path)
+        self.download()
+        self.assertEqual(1, len(self.chart_gets()))
+        with open('mychart-1.0.0.tgz', 'rb') as fp:
+            self.assertEqual(self.data, fp.read())
+
+    def test_checksum_mismatch(self):
+        self.set_index(hashlib.sha256(b'other').hexdigest())
+        self.assertRaises(
+            windlass.exc.FailedRetriesException, self.download)
+        # Nothing left behind.
+        self.assertEqual([], os.listdir(self.cwd))
+
+    def test_no_index(self):
+        del self.server.files['/charts/index.yaml']
+        self.download()
+        with open('mychart-1.0.0.tgz', 'rb') as fp:
+            self.assertEqual(self.data, fp.read())
+
+
+class TestPackageChart(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixtures.EnvironmentVariable(
+            'WINDLASS_CACHE_DIR', self.useFixture(fixtures.TempDir()).path))
+        self.cwd = self.useFixture(fixtures.TempDir()).path
+        saved_cwd = os.getcwd()
+        os.chdir(self.cwd)
+        self.addCleanup(os.chdir, saved_cwd)
+
+        with tarfile.open('ubuntu-0.0.1.tgz', 'w:gz') as tar:
+            tar.add(os.path.join(saved_cwd, 'tests/fakerepo/helm/ubuntu'),
+                    arcname='ubuntu')
+        self.chart = windlass.charts.Chart({
+            'name': 'ubuntu',
+            'version': '0.0.1',
+            'values': {'image': {'tag': '{version}',
+                                 'registry': '{registry}'}},
+        })
+
+    def read_member(self, data, name):
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+            return tar.extractfile(name).read()
+
+    def test_package_chart(self):
+        data = self.chart.package_chart('0.0.1', '2.1.0', registry='reg')
+        chart_data = yaml.safe_load(
+            self.read_member(data, 'ubuntu/Chart.yaml'))
+        values_data = yaml.safe_load(
+            self.read_member(data, 'ubuntu/values.yaml'))
+        self.assertEqual('2.1.0', chart_data['version'])
+        self.assertEqual('reg', values_data['image']['registry'])
+        self.assertEqual('2.1.0', values_data['image']['tag'])
+
+        with open('ubuntu-0.0.1.tgz', 'rb') as fp:
+            source = fp.read()
+        for name in ['ubuntu/templates/ubuntu-pod.yaml']:
+            self.assertEqual(self.read_member(source, name),
+                             self.read_member(data, name))
+
+    def test_deterministic(self):
+        data = self.chart.package_chart('0.0.1', '2.1.0', registry='reg')
+        with unittest.mock.patch('time.time', return_value=0):
+            self.assertEqual(
+                data,
+                self.chart.package_chart('0.0.1', '2.1.0', registry='reg'))
+
+    def test_write_to_stream(self):
+        class Pipe(object):
+            """Write only, not seekable, output"""
+            def __init__(self):
+                self.data = b''
+
+            def write(self, data):
+                self.data += data
+                return len(data)
+
+            def flush(self):
+                pass
+
+        pipe = Pipe()
+        self.chart.write_chart(pipe, '0.0.1', '2.1.0', registry='reg')
+        self.assertEqual(
+            self.chart.package_chart('0.0.1', '2.1.0', registry='reg'),
+            pipe.data)
+
+    def test_repackaged_once(self):
+        del self.chart.data['values']['image']['registry']
+        write_chart = self.useFixture(fixtures.MockPatchObject(
+            self.chart, 'write_chart',
+            wraps=self.chart.write_chart)).mock
+        data = self.chart.package_chart('0.0.1', '2.1.0')
+        with self.chart.export_stream('2.1.0') as fp:
+            self.assertEqual(data, fp.read())
+        path = self.chart.export(export_name='export.tgz', version='2.1.0')
+        with open(path, 'rb') as fp:
+            self.assertEqual(data, fp.read())
+        self.chart.update_version('2.1.0')
+        self.assertEqual(1, write_chart.call_count)
+
+        # Different values substituted.
+        self.chart.package_chart('0.0.1', '2.1.0', registry='reg')
+        self.assertEqual(2, write_chart.call_count)
+
+        # A different source chart.
+        with tarfile.open('ubuntu-0.0.1.tgz', 'w:gz') as tar:
+            tar.add(os.path.join(os.path.dirname(__file__),
+                                 'fakerepo/helm/ubuntu'), arcname='ubuntu')
+            tar.add(path, arcname='ubuntu/extra.tgz')
+        self.chart.package_chart('0.0.1', '2.1.0')
+        self.assertEqual(3, write_chart.call_count)
+
+    def test_update_version(self):
+        del self.chart.data['values']['image']['registry']
+        self.chart.update_version('3.0.0')
+        self.assertEqual('3.0.0', self.chart.version)
+        with open('ubuntu-3.0.0.tgz', 'rb') as fp:
+            chart_data = yaml.safe_load(
+                self.read_member(fp.read(), 'ubuntu/Chart.yaml'))
+        self.assertEqual('3.0.0', chart_data['version'])
+        self.assertEqual(
+            ['ubuntu-0.0.1.tgz', 'ubuntu-3.0.0.tgz'],
+            sorted(os.listdir(self.cwd)))
+
+
+class TestPackage(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixtures.EnvironmentVariable(
+            'WINDLASS_CACHE_DIR', self.useFixture(fixtures.TempDir()).path))
+        self.useFixture(fixtures.MockPatchObject(
+            windlass.charts, '_indexes', {}))
+        self.tmp = self.useFixture(fixtures.TempDir()).path
+        self.chartdir = os.path.join(self.tmp, 'ubuntu')
+        shutil.copytree(
+            os.path.join(os.path.dirname(__file__), 'fakerepo/helm/ubuntu'),
+            self.chartdir)
+        self.output_dir = os.path.join(self.tmp, 'out')
+
+    def write(self, relpath, data=''):
+        path = os.path.join(self.chartdir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            fp.write(data)
+
+    def members(self, path):
+        with tarfile.open(path, 'r:gz') as tar:
+            return tar.getnames()
+
+    def test_package(self):
+        path = windlass.charts.package(self.chartdir, self.output_dir)
+        self.assertEqual(
+            os.path.join(self.output_dir, 'ubuntu-0.0.1.tgz'), path)
+        self.assertEqual(
+            ['ubuntu/Chart.yaml', 'ubuntu/templates/ubuntu-pod.yaml',
+             'ubuntu/values.yaml'],
+            self.members(path))
+
+    def test_helmignore(self):
+        self.write('.helmignore',
+                   '# comment\n*.swp\ndocs/\n/templates/*.txt\n'
+                   '*.bak\n')
+        for relpath in ['values.yaml.swp', 'docs/README.md',
+                        'templates/notes.txt', 'templates/.hidden',
+                        'old.bak', 'templates/sub/notes.txt',
+                        'extra/docs']:
+            self.write(relpath)
+        path = windlass.charts.package(self.chartdir, self.output_dir)
+        self.assertEqual(
+            ['ubuntu/Chart.yaml', 'ubuntu/.helmignore', 'ubuntu/extra/docs',
+             'ubuntu/templates/sub/notes.txt',
+             'ubuntu/templates/ubuntu-pod.yaml', 'ubuntu/values.yaml'],
+            self.members(path))
+
+    def test_deterministic(self):
+        path = windlass.charts.package(self.chartdir, self.output_dir)
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        os.utime(os.path.join(self.chartdir, 'values.yaml'), (1, 1))
+        path = windlass.charts.package(self.chartdir, self.output_dir)
+        with open(path, 'rb') as fp:
+            self.assertEqual(data, fp.read())
+
+    def test_dependencies(self):
+        self.write('requirements.yaml', yaml.safe_dump({'dependencies': [
+            {'name': 'redis', 'version': '1.0.0'}]}))
+        self.assertRaisesRegex(
+            Exception, 'Dependency redis of chart ubuntu is missing',
+            windlass.charts.package, self.chartdir, self.output_dir)
+
+        self.write('charts/redis-1.0.0.tgz')
+        path = windlass.charts.package(self.chartdir, self.output_dir)
+        self.assertIn('ubuntu/charts/redis-1.0.0.tgz', self.members(path))
+
+    def test_build(self):
+        chart = windlass.charts.Chart({'name': 'ubuntu', 'location': 'helm'})
+        saved_cwd = os.getcwd()
+        os.chdir(self.tmp)
+        self.addCleanup(os.chdir, saved_cwd)
+        os.makedirs('helm')
+        os.rename(self.chartdir, 'helm/ubuntu')
+        chart.build()
+        self.assertEqual(
+            ['ubuntu/Chart.yaml', 'ubuntu/templates/ubuntu-pod.yaml',
+             'ubuntu/values.yaml'],
+            self.members('ubuntu-0.0.1.tgz'))
+
+    def serve_dependencies(self):
+        server = self.useFixture(tests.fakehttp.FakeHTTPServer())
+        entries = []
+        for version in ['1.0.0', '1.1.0', '2.0.0-rc1', '2.0.0']:
+            data = ('redis %s' % version).encode()
+            server.files['/repo/redis-%s.tgz' % version] = data
+            entries.append({
+                'name': 'redis', 'version': version,
+                'digest': hashlib.sha256(data).hexdigest(),
+                'urls': ['redis-%s.tgz' % version]})
+        server.files['/repo/index.yaml'] = yaml.safe_dump(
+            {'apiVersion': 'v1', 'entries': {'redis': entries}}).encode()
+        return server
+
+    def require(self, server, version):
+        self.write('requirements.yaml', yaml.safe_dump({'dependencies': [
+            {'name': 'redis', 'version': version,
+             'repository': server.url + '/repo'}]}))
+
+    def downloads(self, server):
+        return [r[1] for r in server.requests
+                if r[0] == 'GET' and r[1].endswith('.tgz')]
+
+    def test_update_dependencies(self):
+        server = self.serve_dependencies()
+        self.require(server, '^1.0.0')
+        self.assertEqual(
+            ['redis-1.1.0.tgz'],
+            windlass.charts.update_dependencies(self.chartdir))
+        path = windlass.charts.package(self.chartdir, self.output_dir)
+        self.assertIn('ubuntu/charts/redis-1.1.0.tgz', self.members(path))
+
+        # Nothing fetched when the dependency is in place.
+        windlass.charts.update_dependencies(self.chartdir)
+        self.assertEqual(['/repo/redis-1.1.0.tgz'], self.downloads(server))
+
+        # A changed dependency is fetched, and the old one removed.
+        self.require(server, '>= 2.0.0')
+        windlass.charts.update_dependencies(self.chartdir)
+        self.assertEqual(
+            ['redis-2.0.0.tgz'],
+            os.listdir(os.path.join(self.chartdir, 'charts')))
+
+        # Back to the previous version, from the cache.
+        self.require(server, '1.1.x')
+        windlass.charts.update_dependencies(self.chartdir)
+        self.assertEqual(
+            ['/repo/redis-1.1.0.tgz', '/repo/redis-2.0.0.tgz'],
+            self.downloads(server))
+        with open(os.path.join(self.chartdir, 'charts/redis-1.1.0.tgz'),
+                  'rb') as fp:
+            self.assertEqual(b'redis 1.1.0', fp.read())
+
+    def vendor(self, filename):
+        os.makedirs(os.path.join(self.chartdir, 'charts'), exist_ok=True)
+        with open(os.path.join(self.chartdir, 'charts', filename), 'wb') as fp:
+            fp.write(b'vendored')
+
+    def test_vendored_dependency_kept(self):
+        server = self.serve_dependencies()
+        self.require(server, '^1.0.0')
+        self.vendor('redis-1.0.0.tgz')
+        self.assertEqual(
+            ['redis-1.0.0.tgz'],
+            windlass.charts.update_dependencies(self.chartdir))
+        # The repository isn't contacted.
+        self.assertEqual([], server.requests)
+
+    def test_vendored_dependency_used_offline(self):
+        server = self.serve_dependencies()
+        del server.files['/repo/index.yaml']
+        self.require(server, '>=2.0.0')
+        self.vendor('redis-1.0.0.tgz')
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(
+                ['redis-1.0.0.tgz'],
+                windlass.charts.update_dependencies(self.chartdir))
+        self.assertEqual(
+            ['redis-1.0.0.tgz'],
+            os.listdir(os.path.join(self.chartdir, 'charts')))
+
+    def test_alias_repository_not_fetched(self):
+        self.write('requirements.yaml', yaml.safe_dump({'dependencies': [
+            {'name': 'redis', 'version': '^1.0.0',
+             'repository': '@stable'}]}))
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(
+                [], windlass.charts.update_dependencies(self.chartdir))
+        self.vendor('redis-1.2.0.tgz')
+        self.assertEqual(
+            ['redis-1.2.0.tgz'],
+            windlass.charts.update_dependencies(self.chartdir))
+        path = windlass.charts.package(self.chartdir, self.output_dir)
+        self.assertIn('ubuntu/charts/redis-1.2.0.tgz', self.members(path))
+
+    def test_lock_file(self):
+        server = self.serve_dependencies()
+        self.require(server, '^1.0.0')
+        self.write('requirements.lock', yaml.safe_dump({'dependencies': [
+            {'name': 'redis', 'version': '1.0.0'}]}))
+        self.assertEqual(
+            ['redis-1.0.0.tgz'],
+            windlass.charts.update_dependencies(self.chartdir))
+
+    def test_version_matches(self):
+        for version, constraint, expected in [
+                ('1.2.3', '1.2.3', True),
+                ('1.2.4', '1.2.3', False),
+                ('1.2.9', '~1.2.3', True),
+                ('1.3.0', '~1.2.3', False),
+                ('1.9.0', '^1.2.3', True),
+                ('2.0.0', '^1.2.3', False),
+                ('0.2.9', '^0.2.3', True),
+                ('0.3.0', '^0.2.3', False),
+                ('1.2.7', '1.2.x', True),
+                ('1.3.0', '1.2.x', False),
+                ('1.5.0', '>=1.2, <2', True),
+                ('1.5.0', '>= 1.2 < 1.5', False),
+                ('1.4.0', '1.2 - 1.4', True),
+                ('3.0.0', '^1.0 || ^3.0', True),
+                ('2.0.0-rc1', '>=1.0.0', False),
+                ('9.9.9', '*', True)]:
+            self.assertEqual(
+                expected,
+                windlass.charts.version_matches(version, constraint),
+                (version, constraint))
+
+
+class TestChartMetadata(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixtures.MockPatchObject(
+            windlass.charts, '_metadata', {}))
+        self.tmp = self.useFixture(fixtures.TempDir()).path
+        self.chartdir = os.path.join(self.tmp, 'helm', 'ubuntu')
+        shutil.copytree(
+            os.path.join(os.path.dirname(__file__), 'fakerepo/helm/ubuntu'),
+            self.chartdir)
+
+    def test_parsed_once(self):
+        chart = windlass.charts.Chart({'name': 'ubuntu', 'location': 'helm'})
+        chart.metadata['repopath'] = self.tmp
+        with unittest.mock.patch('yaml.load', wraps=yaml.load) as load:
+            chart.load_metadata()
+            for i in range(3):
+                self.assertEqual('0.0.1', chart.get_local_version())
+                str(chart)
+        self.assertEqual(1, load.call_count)
+
+    def test_modified_chart_reloaded(self):
+        chart = windlass.charts.Chart({'name': 'ubuntu', 'location': 'helm'})
+        chart.metadata['repopath'] = self.tmp
+        self.assertEqual('0.0.1', chart.get_local_version())
+        path = os.path.join(self.chartdir, 'Chart.yaml')
+        with open(path) as fp:
+            data = yaml.safe_load(fp)
+        data['version'] = '0.0.2'
+        with open(path, 'w') as fp:
+            yaml.safe_dump(data, fp)
+        os.utime(path, ns=(0, 0))
+        self.assertEqual('0.0.2', chart.get_local_version())
+
+    def test_chart_dir_in_repopath(self):
+        chart = windlass.charts.Chart({'name': 'ubuntu', 'location': 'helm'})
+        self.assertEqual(
+            os.path.join(os.path.abspath('.'), 'helm', 'ubuntu'),
+            chart.get_chart_dir())
+        chart.metadata['repopath'] = self.tmp
+        self.assertEqual(self.chartdir, chart.get_chart_dir())
+        # Not in the repository, so in the working directory.
+        chart.metadata['repopath'] = os.path.join(self.tmp, 'other')
+        self.assertEqual(
+            os.path.join(os.path.abspath('.'), 'helm', 'ubuntu'),
+            chart.get_chart_dir())
+
+    def test_missing_chart_not_loaded(self):
+        chart = windlass.charts.Chart({'name': 'missing'})
+        chart.metadata['repopath'] = self.tmp
+        chart.load_metadata()
+        self.assertEqual({}, windlass.charts._metadata)
@@ -0,0 +1,74 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import gzip
+import lzma
+import os
+import unittest.mock
+
+import testtools
+
+import windlass.compression
+
+
+class TestCompressStream(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Uneven reads from the source, spanning several blocks.
+        data = os.urandom(1000) * 300
+        self.source = [data[i:i + 7000] for i in range(0, len(data), 7000)]
+        self.data = data
+
+    def compress(self, codec, **kwargs):
+        return b''.join(windlass.compression.compress_stream(
+            iter(self.source), codec, chunk_size=64 * 1024, threads=3,
+            **kwargs))
+
+    def test_gzip(self):
+        compressed = self.compress('gzip')
+        self.assertEqual(self.data, gzip.decompress(compressed))
+
+    def test_xz(self):
+        compressed = self.compress('xz', level=1)
+        self.assertEqual(self.data, lzma.decompress(compressed))
+
+    def test_zstd(self):
+        zstandard = windlass.compression.zstandard
+        if zstandard is None:
+            self.skipTest('zstandard is not installed')
+        compressed = self.compress('zstd')
+        self.assertEqual(
+            self.data,
+            zstandard.ZstdDecompressor().decompressobj().decompress(
+                compressed))
+
+    def test_stats(self):
+        stats = windlass.compression.CompressionStats('gzip')
+        compressed = self.compress('gzip', stats=stats)
+        self.assertEqual(len(self.data), stats.uncompressed)
+        self.assertEqual(len(compressed), stats.compressed)
+        self.assertIsNotNone(stats.finished)
+        self.assertIn('gzip', str(stats))
+
+    def test_source_closed(self):
+        stream = unittest.mock.MagicMock()
+        stream.__iter__.return_value = iter(self.source)
+        list(windlass.compression.compress_stream(stream, 'gzip'))
+        stream.close.assert_called_once_with()
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, self.compress, 'bzip2')
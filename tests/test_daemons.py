@@ -0,0 +1,146 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import json
+import os
+import unittest.mock
+
+import docker
+import fixtures
+import testtools
+
+import windlass.daemons
+import windlass.images
+
+
+class FakeDaemon(object):
+    """Stand-in for a docker daemon, holding a set of image names"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.images = set()
+
+    def client(self):
+        client = unittest.mock.MagicMock()
+        client.api.base_url = self.endpoint
+
+        def get(name):
+            if name not in self.images:
+                raise docker.errors.ImageNotFound(name)
+            return unittest.mock.MagicMock()
+        client.images.get.side_effect = get
+        client.api.get_image.return_value = unittest.mock.MagicMock()
+
+        def load_image(stream):
+            self.images.update(self.saved)
+        client.api.load_image.side_effect = load_image
+
+        def build(tag, **kwargs):
+            self.images.add(tag)
+            return []
+        client.api.build.side_effect = build
+        return client
+
+
+class TestDaemons(testtools.TestCase):
+
+    endpoints = ['tcp://daemon1:2375', 'tcp://daemon2:2375',
+                 'tcp://daemon3:2375']
+
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixtures.EnvironmentVariable(
+            'WINDLASS_CACHE_DIR', self.useFixture(fixtures.TempDir()).path))
+        self.useFixture(fixtures.EnvironmentVariable(
+            windlass.daemons.DOCKER_HOSTS_ENV, ','.join(self.endpoints)))
+        self.daemons = {e: FakeDaemon(e) for e in self.endpoints}
+        self.useFixture(fixtures.MockPatch(
+            'windlass.daemons.get_client',
+            side_effect=lambda endpoint=None, timeout=180:
+                self.daemons[endpoint].client()))
+
+    def test_default_single_daemon(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            windlass.daemons.DOCKER_HOSTS_ENV, ''))
+        self.assertEqual([None], windlass.daemons.get_endpoints())
+
+    def test_least_loaded(self):
+        clients = [windlass.daemons.acquire() for i in range(3)]
+        self.assertEqual(
+            self.endpoints, [c.windlass_endpoint for c in clients])
+
+        windlass.daemons.release(clients[1])
+        client = windlass.daemons.acquire()
+        self.assertEqual(self.endpoints[1], client.windlass_endpoint)
+
+        # All daemons have 1 job, the first is picked.
+        client = windlass.daemons.acquire()
+        self.assertEqual(self.endpoints[0], client.windlass_endpoint)
+
+    def test_dead_workers_jobs_discarded(self):
+        counter = windlass.daemons.JobCounter()
+        # A worker process that no longer exists.
+        with open(counter.path, 'w') as fp:
+            json.dump({self.endpoints[0]: {'999999999': 5}}, fp)
+        client = windlass.daemons.acquire()
+        self.assertEqual(self.endpoints[0], client.windlass_endpoint)
+        with open(counter.path) as fp:
+            self.assertEqual(
+                {self.endpoints[0]: {str(os.getpid()): 1}}, json.load(fp))
+
+    def test_acquire_for_image(self):
+        self.daemons[self.endpoints[2]].images.add('org/image:1')
+        client = windlass.daemons.acquire_for_image('org/image:1')
+        self.assertEqual(self.endpoints[2], client.windlass_endpoint)
+        self.assertIsNone(windlass.daemons.locate_image('org/missing:1'))
+
+    def test_ensure_image_copies_between_daemons(self):
+        source = self.daemons[self.endpoints[1]]
+        source.images.add('org/base:1')
+        dest = self.daemons[self.endpoints[0]]
+        dest.saved = ['org/base:1']
+
+        windlass.daemons.ensure_image('org/base:1', dest.client())
+        self.assertIn('org/base:1', dest.images)
+
+    def test_build_places_base_images(self):
+        self.daemons[self.endpoints[1]].images.add('org/base:1')
+        self.daemons[self.endpoints[0]].saved = ['org/base:1']
+        path = self.useFixture(fixtures.TempDir()).path
+        with open(os.path.join(path, 'Dockerfile'), 'w') as fp:
+            fp.write('FROM org/base:1 AS build\nFROM build\n')
+
+        self.useFixture(fixtures.EnvironmentVariable(
+            windlass.images.BUILD_LOG_DIR_ENV, path))
+        windlass.images.build_verbosly('org/image:1', path)
+        self.assertIn('org/base:1', self.daemons[self.endpoints[0]].images)
+
+
+class TestBaseImages(testtools.TestCase):
+
+    def test_get_base_images(self):
+        path = self.useFixture(fixtures.TempDir()).path
+        with open(os.path.join(path, 'build.Dockerfile'), 'w') as fp:
+            fp.write(
+                'ARG VERSION=1\n'
+                'FROM --platform=linux/amd64 golang:1.12 as builder\n'
+                'RUN make\n'
+                'from alpine\n'
+                'COPY --from=builder /app /app\n'
+                'FROM builder\n')
+        self.assertEqual(
+            ['golang:1.12', 'alpine'],
+            windlass.images.get_base_images(path, 'build.Dockerfile'))
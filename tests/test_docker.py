@@ -17,6 +17,7 @@
 import docker
 import fixtures
 import logging
+import os
 import pathlib
 import unittest
 import unittest.mock
@@ -90,6 +91,8 @@ class TestDockerUtils(tests.test_e2e.FakeRegistry):
         debug_output = e.debug_message()
         for line in e.out + e.errors:
             self.assertIn(line, debug_output)
+        self.assertTrue(os.path.exists(e.log_path))
+        self.assertIn(e.log_path, debug_output)
 
     def test_image_build_delete(self):
         temp = self.useFixture(
@@ -0,0 +1,611 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tracemalloc
+import unittest.mock
+import urllib.parse
+import zipfile
+
+import fixtures
+import testtools
+
+import windlass.exc
+import windlass.generic
+import windlass.transport
+
+import tests.fakehttp
+
+
+class FakeArtifactoryHandler(tests.fakehttp.FakeHTTPHandler):
+    """Property search, storage API and downloads of Artifactory
+
+    The server's properties map paths in files to their version property.
+    Downloads have an ETag, unless the server's validators is false, and
+    honour Range requests with a matching If-Range. The connection is
+    dropped after the number of bytes in the server's truncate, if set.
+    """
+
+    def handle_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/artifactory/api/search/prop':
+            query = urllib.parse.parse_qs(url.query)
+            repo = query['repos'][0]
+            results = [
+                {'uri': '%s/artifactory/api/storage%s' % (
+                    self.server.url, path[len('/artifactory'):])}
+                for path, version in sorted(self.server.properties.items())
+                if version == query['version'][0] and
+                path.startswith('/artifactory/%s/' % repo)]
+            return self.send(200, json.dumps({'results': results}).encode())
+        if url.path.startswith('/artifactory/api/storage/'):
+            path = '/artifactory/' + url.path[len(
+                '/artifactory/api/storage/'):]
+            if path not in self.server.files:
+                return self.send(404)
+            return self.send(200, json.dumps(
+                {'downloadUri': self.server.url + path}).encode())
+        if self.path not in self.server.files:
+            return self.send(404)
+
+        data = self.server.files[self.path]
+        headers = {
+            'X-Checksum-Sha256': self.server.checksums.get(
+                self.path, hashlib.sha256(data).hexdigest())}
+        etag = '"%s"' % hashlib.sha256(data).hexdigest()
+        if self.server.validators:
+            headers['ETag'] = etag
+        code = 200
+        if 'Range' in self.headers and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'][len('bytes='):].split('-')[0])
+            if start >= len(data):
+                return self.send(416)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, len(data) - 1, len(data))
+            code, data = 206, data[start:]
+
+        self.send_response(code)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.server.truncate is not None:
+            data = data[:self.server.truncate]
+            self.server.truncate = None
+            self.close_connection = True
+        self.wfile.write(data)
+
+
+class TestGenericURL(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixtures.MockPatchObject(
+            windlass.generic, '_searches', {}))
+        self.server = self.useFixture(
+            tests.fakehttp.FakeHTTPServer(FakeArtifactoryHandler))
+        self.server.server.url = self.server.url
+        self.server.server.properties = self.properties = {}
+        self.server.server.checksums = {}
+        self.server.server.truncate = None
+        self.server.server.validators = True
+        self.generic_url = self.server.url + '/artifactory/generic-local'
+        for i in range(20):
+            self.add('app%d-1.0.tgz' % i, '1.0')
+            self.add('app%d-0.9.tgz' % i, '0.9')
+
+    def add(self, filename, version, repo='generic-local'):
+        path = '/artifactory/%s/%s' % (repo, filename)
+        self.server.files[path] = filename.encode()
+        self.properties[path] = version
+
+    def generic(self, filename):
+        return windlass.generic.Generic(
+            {'name': filename, 'filename': filename})
+
+    def searches(self):
+        return [r for r in self.server.requests if '/api/search/' in r[1]]
+
+    def storage_lookups(self):
+        return [r for r in self.server.requests if '/api/storage/' in r[1]]
+
+    def test_url(self):
+        self.assertEqual(
+            self.generic_url + '/app3-1.0.tgz',
+            self.generic('app3-*.tgz').url('1.0', self.generic_url))
+        self.assertEqual(1, len(self.storage_lookups()))
+
+    def test_one_search_per_version(self):
+        for i in range(20):
+            self.generic('app%d-*.tgz' % i).url('1.0', self.generic_url)
+            self.generic('app%d-*.tgz' % i).url('1.0', self.generic_url)
+            self.generic('app%d-*.tgz' % i).url('0.9', self.generic_url)
+        self.assertEqual(2, len(self.searches()))
+        # Storage is only queried once for each artifact found.
+        self.assertEqual(40, len(self.storage_lookups()))
+
+    def test_matching_uris_looked_up(self):
+        search = windlass.generic.get_search(self.generic_url, '1.0')
+        self.assertEqual(
+            [self.generic_url + '/app1-1.0.tgz',
+             self.generic_url + '/app10-1.0.tgz'],
+            search.find('app1*-1.0.tgz')[:2])
+        self.assertEqual(11, len(self.storage_lookups()))
+
+    def test_other_repository_ignored(self):
+        self.add('other-1.0.tgz', '1.0', repo='other-local')
+        self.assertRaisesRegex(
+            Exception, 'Could not find artifact other-1.0.tgz',
+            self.generic('other-1.0.tgz').url, '1.0', self.generic_url)
+
+
+class TestGenericDownload(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = self.useFixture(
+            tests.fakehttp.FakeHTTPServer(FakeArtifactoryHandler))
+        self.server.server.url = self.server.url
+        self.server.server.properties = {}
+        self.server.server.checksums = {}
+        self.server.server.truncate = None
+        self.server.server.validators = True
+        self.data = os.urandom(3 * windlass.generic.CHUNK_SIZE)
+        self.server.files['/generic/image.qcow2'] = self.data
+        self.useFixture(fixtures.MockPatch('time.sleep'))
+        self.useFixture(fixtures.EnvironmentVariable(
+            'WINDLASS_CACHE_DIR', self.useFixture(fixtures.TempDir()).path))
+        self.tmp = self.useFixture(fixtures.TempDir()).path
+        saved_cwd = os.getcwd()
+        os.chdir(self.tmp)
+        self.addCleanup(os.chdir, saved_cwd)
+        self.generic = windlass.generic.Generic(
+            {'name': 'image', 'filename': 'image.qcow2'})
+        url = self.server.url + '/generic/image.qcow2'
+        self.useFixture(fixtures.MockPatchObject(
+            windlass.generic.Generic, 'url', return_value=url))
+
+    def ranges(self):
+        return [r[2].get('Range') for r in self.server.requests]
+
+    def download(self):
+        self.generic.download(
+            version='1.0', generic_url=self.server.url + '/generic')
+        with open('image.qcow2', 'rb') as fp:
+            return fp.read()
+
+    def test_download(self):
+        self.assertEqual(self.data, self.download())
+        self.assertEqual(['image.qcow2'], os.listdir(self.tmp))
+
+    def test_resumed(self):
+        self.server.server.truncate = int(2.5 * windlass.generic.CHUNK_SIZE)
+        self.assertEqual(self.data, self.download())
+        # The chunks received in full before the connection dropped are
+        # kept.
+        self.assertEqual(
+            [None, 'bytes=%d-' % (2 * windlass.generic.CHUNK_SIZE)],
+            self.ranges())
+        self.assertEqual(
+            '"%s"' % hashlib.sha256(self.data).hexdigest(),
+            self.server.requests[1][2].get('If-Range'))
+        self.assertEqual(['image.qcow2'], os.listdir(self.tmp))
+
+    def test_checksum_mismatch(self):
+        self.server.server.checksums['/generic/image.qcow2'] = 'bad'
+        self.assertRaises(
+            windlass.exc.FailedRetriesException, self.download)
+        self.assertEqual([], os.listdir(self.tmp))
+        self.assertEqual([None, None, None], self.ranges())
+
+    def test_resume_without_validator(self):
+        self.server.server.validators = False
+        self.server.server.truncate = int(2.5 * windlass.generic.CHUNK_SIZE)
+        self.assertEqual(self.data, self.download())
+        self.assertEqual([None, None], self.ranges())
+
+    def test_stale_part_discarded(self):
+        with open('image.qcow2.part', 'wb') as fp:
+            fp.write(b'x' * (len(self.data) + 1))
+        self.assertEqual(self.data, self.download())
+        self.assertEqual([None], self.ranges())
+
+    def test_changed_artifact_downloaded(self):
+        with open('image.qcow2.part', 'wb') as fp:
+            fp.write(b'x' * windlass.generic.CHUNK_SIZE)
+        with open('image.qcow2.part.json', 'w') as fp:
+            json.dump({'url': self.generic.url(), 'validator': '"old"'}, fp)
+        self.assertEqual(self.data, self.download())
+        # The artifact changed since the partial download, so it's sent in
+        # full.
+        self.assertEqual(
+            [('bytes=%d-' % windlass.generic.CHUNK_SIZE, '"old"')],
+            [(r[2].get('Range'), r[2].get('If-Range'))
+             for r in self.server.requests])
+        self.assertEqual(['image.qcow2'], os.listdir(self.tmp))
+
+    def test_download_cached(self):
+        self.download()
+        os.chdir(self.useFixture(fixtures.TempDir()).path)
+        self.assertEqual(self.data, self.download())
+        self.assertEqual(1, len(self.server.requests))
+        # Another version is downloaded.
+        self.generic.download(
+            version='2.0', generic_url=self.server.url + '/generic')
+        self.assertEqual(2, len(self.server.requests))
+
+    def archive(self):
+        """Generic archive of self.data, on the server"""
+        os.mkdir('site')
+        with open('site/image.qcow2', 'wb') as fp:
+            fp.write(self.data)
+        generic = windlass.generic.Generic(
+            {'name': 'site', 'filename': 'site', 'archive': 'site.tar'})
+        with generic.export_stream() as fp:
+            self.server.files['/generic/site.tar'] = fp.read()
+        shutil.rmtree('site')
+        self.useFixture(fixtures.MockPatchObject(
+            windlass.generic.Generic, 'url',
+            return_value=self.server.url + '/generic/site.tar'))
+        return generic
+
+    def test_archive_resumed(self):
+        generic = self.archive()
+        self.server.server.truncate = int(2.5 * windlass.generic.CHUNK_SIZE)
+        generic.download(version='1.0', generic_url=self.server.url)
+        with open('site/image.qcow2', 'rb') as fp:
+            self.assertEqual(self.data, fp.read())
+        # Carried on from what was unpacked before the connection dropped.
+        self.assertEqual(
+            [None, 'bytes=%d-' % (2 * windlass.generic.CHUNK_SIZE)],
+            self.ranges())
+        self.assertEqual(['site'], os.listdir(self.tmp))
+
+    def test_archive_not_resumed_without_validator(self):
+        generic = self.archive()
+        self.server.server.validators = False
+        self.server.server.truncate = int(2.5 * windlass.generic.CHUNK_SIZE)
+        generic.download(version='1.0', generic_url=self.server.url)
+        with open('site/image.qcow2', 'rb') as fp:
+            self.assertEqual(self.data, fp.read())
+        # Downloaded again from the start.
+        self.assertEqual([None, None], self.ranges())
+
+    def test_streamed(self):
+        with unittest.mock.patch(
+                'requests.Response.content',
+                new_callable=unittest.mock.PropertyMock) as content:
+            self.download()
+        content.assert_not_called()
+
+
+class DigestingHandler(tests.fakehttp.FakeHTTPHandler):
+    """Stores the digest of uploads instead of their content
+
+    Like servers other than Artifactory, checksum deploy isn't supported.
+    """
+
+    def handle_PUT(self):
+        sha = hashlib.sha256()
+        remaining = int(self.headers['Content-Length'])
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 64 * 1024))
+            sha.update(chunk)
+            remaining -= len(chunk)
+        self.server.files[self.path] = sha.hexdigest()
+        self.send(201)
+
+
+class TestGenericUpload(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = self.useFixture(
+            tests.fakehttp.FakeHTTPServer(DigestingHandler))
+        self.useFixture(fixtures.MockPatchObject(
+            windlass.transport, '_no_checksum_deploy', set()))
+        self.tmp = self.useFixture(fixtures.TempDir()).path
+        saved_cwd = os.getcwd()
+        os.chdir(self.tmp)
+        self.addCleanup(os.chdir, saved_cwd)
+        self.generic = windlass.generic.Generic(
+            {'name': 'image', 'filename': 'image.qcow2'})
+
+    def write(self, size):
+        sha = hashlib.sha256()
+        with open('image.qcow2', 'wb') as fp:
+            for i in range(0, size, 1024 * 1024):
+                chunk = os.urandom(min(1024 * 1024, size - i))
+                sha.update(chunk)
+                fp.write(chunk)
+        return sha.hexdigest()
+
+    def upload(self, **kwargs):
+        self.generic.upload(
+            version='1.0', generic_url=self.server.url + '/generic',
+            **kwargs)
+        return self.server.files['/generic/image.qcow2;version=1.0']
+
+    def test_upload(self):
+        digest = self.write(3 * 1024 * 1024 + 1)
+        progress = unittest.mock.Mock()
+        self.assertEqual(digest, self.upload(progress=progress))
+        # After the checksum deploy is found not to be supported.
+        self.assertEqual(2, len(self.server.requests))
+        headers = self.server.requests[-1][2]
+        self.assertEqual(digest, headers['X-Checksum-Sha256'])
+        self.assertEqual(str(3 * 1024 * 1024 + 1), headers['Content-Length'])
+        self.assertNotIn('Transfer-Encoding', headers)
+        self.assertEqual(
+            (3 * 1024 * 1024 + 1, 3 * 1024 * 1024 + 1),
+            progress.call_args[0])
+
+    def test_progress_logged(self):
+        self.write(4 * 1024 * 1024)
+        logger = self.useFixture(fixtures.FakeLogger(level=logging.INFO))
+        self.upload()
+        self.assertIn('image: uploaded 100% (4194304 of 4194304 bytes)',
+                      logger.output)
+
+    def test_memory_flat(self):
+        size = 32 * 1024 * 1024
+        digest = self.write(size)
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        self.assertEqual(digest, self.upload())
+        peak = tracemalloc.get_traced_memory()[1]
+        self.assertLess(peak, size / 4)
+
+    def test_export(self):
+        self.write(1024)
+        os.mkdir('out')
+        path = self.generic.export('out')
+        self.assertEqual(os.path.join('out', 'image.qcow2'), path)
+        with open(path, 'rb') as fp, open('image.qcow2', 'rb') as orig:
+            self.assertEqual(orig.read(), fp.read())
+
+
+class TestGenericArchive(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixtures.MockPatch('time.sleep'))
+        self.useFixture(fixtures.EnvironmentVariable(
+            'WINDLASS_CACHE_DIR', self.useFixture(fixtures.TempDir()).path))
+        self.server = self.useFixture(tests.fakehttp.FakeHTTPServer())
+        self.tmp = self.useFixture(fixtures.TempDir()).path
+        saved_cwd = os.getcwd()
+        os.chdir(self.tmp)
+        self.addCleanup(os.chdir, saved_cwd)
+        self.files = {
+            'site/index.html': b'index',
+            'site/css/site.css': b'css' * 100000,
+            'dist/a.whl': b'a',
+            'dist/b.whl': b'b',
+        }
+        for path, data in self.files.items():
+            self.write(path, data)
+
+    def write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+    def generic(self, filename, archive):
+        return windlass.generic.Generic(
+            {'name': 'docs', 'filename': filename, 'archive': archive})
+
+    def read(self, generic):
+        with generic.export_stream() as fp:
+            return fp.read()
+
+    def test_tar_directory(self):
+        generic = self.generic('site', 'docs.tar.gz')
+        self.assertEqual('docs.tar.gz', generic.get_filename())
+        with tarfile.open(fileobj=io.BytesIO(self.read(generic))) as tar:
+            self.assertEqual(
+                ['site/css/site.css', 'site/index.html'], tar.getnames())
+            self.assertEqual(
+                self.files['site/css/site.css'],
+                tar.extractfile('site/css/site.css').read())
+
+    def test_zip_glob(self):
+        generic = self.generic('dist/*.whl', 'wheels.zip')
+        with zipfile.ZipFile(io.BytesIO(self.read(generic))) as zf:
+            self.assertEqual(['dist/a.whl', 'dist/b.whl'], zf.namelist())
+            self.assertEqual(b'b', zf.read('dist/b.whl'))
+
+    def test_same_archive_every_time(self):
+        for archive in ('docs.tar', 'docs.tgz', 'docs.zip'):
+            generic = self.generic('*', archive)
+            self.assertEqual(self.read(generic), self.read(generic))
+
+    def test_same_archive_any_checkout(self):
+        for archive in ('docs.tar', 'docs.tgz', 'docs.zip'):
+            generic = self.generic('*', archive)
+            before = self.read(generic)
+            # As checked out elsewhere, later and with another umask.
+            for path in self.files:
+                os.utime(path, (1234567890, 1234567890))
+                os.chmod(path, 0o664)
+            self.assertEqual(before, self.read(generic))
+
+    def test_reread(self):
+        with self.generic('site', 'docs.tar.gz').export_stream() as fp:
+            data = fp.read()
+            self.assertEqual(len(data), fp.seek(0, io.SEEK_END))
+            fp.seek(0)
+            self.assertEqual(data[:10], fp.read(10))
+            fp.seek(100)
+            self.assertEqual(data[100:], fp.read())
+
+    def test_export(self):
+        generic = self.generic('site', 'docs.tar')
+        os.mkdir('out')
+        path = generic.export('out')
+        self.assertEqual(os.path.join('out', 'docs.tar'), path)
+        with open(path, 'rb') as fp:
+            self.assertEqual(self.read(generic), fp.read())
+
+    def test_no_files(self):
+        generic = self.generic('missing/*', 'docs.tar')
+        self.assertRaises(
+            windlass.generic.LocalArtifactCopyMissing, generic.export_stream)
+
+    def test_upload(self):
+        generic = self.generic('site', 'docs.tar.gz')
+        generic.upload(version='1.0', generic_url=self.server.url + '/g')
+        self.assertEqual(
+            self.read(generic),
+            self.server.files['/g/docs.tar.gz;version=1.0'])
+        headers = self.server.requests[-1][2]
+        self.assertEqual(
+            str(len(self.read(generic))), headers['Content-Length'])
+
+    def not_on_disk(self, filename):
+        """Fail if the archive filename, or any temporary file, is written"""
+        real_open = open
+
+        def guarded_open(path, *args, **kwargs):
+            if isinstance(path, str) and \
+                    os.path.basename(path).startswith(filename):
+                raise AssertionError('%s written to disk' % path)
+            return real_open(path, *args, **kwargs)
+        self.useFixture(fixtures.MockPatch('builtins.open', guarded_open))
+        for name in ('TemporaryFile', 'SpooledTemporaryFile',
+                     'NamedTemporaryFile'):
+            self.useFixture(fixtures.MockPatch(
+                'tempfile.' + name,
+                side_effect=AssertionError('Temporary file written')))
+
+    def test_upload_streamed(self):
+        generic = self.generic('site', 'docs.tar.gz')
+        archive = self.read(generic)
+        generated = []
+        tar_chunks = windlass.generic._tar_chunks
+
+        def chunks(*args):
+            for chunk in tar_chunks(*args):
+                generated.append(len(chunk))
+                yield chunk
+        self.not_on_disk('docs.tar.gz')
+        with unittest.mock.patch.object(
+                windlass.generic, '_tar_chunks', chunks):
+            generic.upload(version='1.0', generic_url=self.server.url + '/g')
+        self.assertEqual(
+            archive, self.server.files['/g/docs.tar.gz;version=1.0'])
+        # Generated to checksum it, then again to send it.
+        self.assertEqual(2 * len(archive), sum(generated))
+
+    def download(self, generic):
+        self.server.files['/g/' + generic.get_filename()] = self.read(generic)
+        os.chdir(self.useFixture(fixtures.TempDir()).path)
+        self.write('site/stale.html', b'stale')
+        with unittest.mock.patch.object(
+                windlass.generic.Generic, 'url',
+                return_value=self.server.url + '/g/' + generic.get_filename()):
+            generic.download(version='1.0', generic_url=self.server.url)
+
+    def test_download_tar(self):
+        self.not_on_disk('docs.tar.gz')
+        self.download(self.generic('site', 'docs.tar.gz'))
+        self.assertEqual(['site'], os.listdir('.'))
+        with open('site/css/site.css', 'rb') as fp:
+            self.assertEqual(self.files['site/css/site.css'], fp.read())
+        # Files not in the archive are left alone.
+        with open('site/stale.html', 'rb') as fp:
+            self.assertEqual(b'stale', fp.read())
+
+    def test_download_replaces_members(self):
+        generic = self.generic('site/*.html', 'docs.tar')
+        self.server.files['/g/docs.tar'] = self.read(generic)
+        os.chdir(self.useFixture(fixtures.TempDir()).path)
+        self.write('site/index.html', b'old')
+        self.write('site/other.txt', b'other')
+        with unittest.mock.patch.object(
+                windlass.generic.Generic, 'url',
+                return_value=self.server.url + '/g/docs.tar'):
+            generic.download(version='1.0', generic_url=self.server.url)
+        self.assertEqual(
+            ['index.html', 'other.txt'], sorted(os.listdir('site')))
+        with open('site/index.html', 'rb') as fp:
+            self.assertEqual(b'index', fp.read())
+        with open('site/other.txt', 'rb') as fp:
+            self.assertEqual(b'other', fp.read())
+
+    def test_download_zip(self):
+        self.not_on_disk('docs.zip')
+        self.download(self.generic('site', 'docs.zip'))
+        self.assertEqual(['site'], os.listdir('.'))
+        with open('site/index.html', 'rb') as fp:
+            self.assertEqual(b'index', fp.read())
+
+    def test_download_unsafe_tar(self):
+        out = io.BytesIO()
+        with tarfile.open(fileobj=out, mode='w') as tar:
+            info = tarfile.TarInfo('../escaped')
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b'evil'))
+        self.server.files['/g/docs.tar'] = out.getvalue()
+        generic = self.generic('site', 'docs.tar')
+        with unittest.mock.patch.object(
+                windlass.generic.Generic, 'url',
+                return_value=self.server.url + '/g/docs.tar'):
+            self.assertRaisesRegex(
+                Exception, 'Unsafe member', generic.download,
+                version='1.0', generic_url=self.server.url)
+        self.assertFalse(os.path.exists('../escaped'))
+        self.assertEqual(
+            ['dist', 'site'], sorted(os.listdir('.')))
+
+    def test_download_unsafe_zip(self):
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, 'w') as zf:
+            zf.writestr('../escaped', b'evil')
+        self.server.files['/g/docs.zip'] = out.getvalue()
+        generic = self.generic('site', 'docs.zip')
+        with unittest.mock.patch.object(
+                windlass.generic.Generic, 'url',
+                return_value=self.server.url + '/g/docs.zip'):
+            self.assertRaisesRegex(
+                Exception, 'Unsafe member', generic.download,
+                version='1.0', generic_url=self.server.url)
+        self.assertFalse(os.path.exists('../escaped'))
+
+    def test_download_stored_zip(self):
+        # Written with the sizes before the data, as by other zip tools.
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, 'w') as zf:
+            zf.writestr('site/empty/', b'')
+            zf.writestr('site/index.html', b'new', zipfile.ZIP_STORED)
+            zf.writestr('site/big.html', b'big' * 1000, zipfile.ZIP_DEFLATED)
+        self.server.files['/g/docs.zip'] = out.getvalue()
+        generic = self.generic('site', 'docs.zip')
+        with unittest.mock.patch.object(
+                windlass.generic.Generic, 'url',
+                return_value=self.server.url + '/g/docs.zip'):
+            generic.download(version='1.0', generic_url=self.server.url)
+        self.assertTrue(os.path.isdir('site/empty'))
+        with open('site/index.html', 'rb') as fp:
+            self.assertEqual(b'new', fp.read())
+        with open('site/big.html', 'rb') as fp:
+            self.assertEqual(b'big' * 1000, fp.read())
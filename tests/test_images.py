@@ -14,15 +14,41 @@
 # under the License.
 #
 
+import json
 import tarfile
 import tempfile
+import unittest.mock
 
 import docker
 import testtools
 
+import windlass.exc
 import windlass.images
 
 
+class TestCheckDockerStream(testtools.TestCase):
+
+    def check(self, error):
+        rate_limiter = unittest.mock.Mock()
+        stream = [json.dumps({'status': 'Pulling'}), json.dumps(error)]
+        self.assertRaises(
+            windlass.exc.WindlassPushPullException,
+            windlass.images.check_docker_stream, stream, rate_limiter)
+        return rate_limiter.rate_limited.called
+
+    def test_rate_limited(self):
+        message = 'toomanyrequests: You have reached your pull rate limit.'
+        self.assertTrue(self.check(
+            {'error': message, 'errorDetail': {'message': message}}))
+        self.assertTrue(self.check(
+            {'error': 'Too many', 'errorDetail': {'code': 429}}))
+
+    def test_other_error(self):
+        message = 'manifest for app:1.429 not found: manifest unknown'
+        self.assertFalse(self.check(
+            {'error': message, 'errorDetail': {'message': message}}))
+
+
 class TestImageAPI(testtools.TestCase):
 
     def setUp(self):
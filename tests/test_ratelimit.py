@@ -0,0 +1,106 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import fixtures
+import testtools
+
+import windlass.ratelimit
+
+
+class TestRegistryOf(testtools.TestCase):
+
+    def test_docker_hub(self):
+        for image in ['alpine', 'alpine:3.5', 'org/image:1',
+                      'registry.hub.docker.com/org/image',
+                      'docker.io/library/alpine']:
+            self.assertEqual(
+                windlass.ratelimit.DOCKER_HUB,
+                windlass.ratelimit.registry_of(image))
+
+    def test_other_registry(self):
+        self.assertEqual(
+            '127.0.0.1:5000',
+            windlass.ratelimit.registry_of('127.0.0.1:5000/org/image:1'))
+        self.assertEqual(
+            ('quay.io', 'org/image'),
+            windlass.ratelimit.split_registry('quay.io/org/image'))
+
+
+class TestTokenBucket(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        state_dir = self.useFixture(fixtures.TempDir()).path
+        self.bucket = windlass.ratelimit.TokenBucket('docker.io', state_dir)
+        # Another process sharing the same state.
+        self.other = windlass.ratelimit.TokenBucket('docker.io', state_dir)
+        self.sleep = self.useFixture(
+            fixtures.MockPatch('time.sleep')).mock
+
+    def test_unlimited_without_headers(self):
+        for i in range(10):
+            self.bucket.acquire()
+        self.sleep.assert_not_called()
+
+    def test_paces_when_tokens_run_out(self):
+        self.bucket.update_from_headers({
+            'RateLimit-Limit': '100;w=21600',
+            'RateLimit-Remaining': '2;w=21600',
+        })
+        self.bucket.acquire()
+        self.other.acquire()
+        self.sleep.assert_not_called()
+
+        # Out of tokens, the third pull waits for the bucket to refill.
+        self.sleep.side_effect = StopIteration
+        self.assertRaises(StopIteration, self.bucket.acquire)
+
+    def test_wait_time_from_refill_rate(self):
+        self.bucket.update_from_headers({
+            'RateLimit-Limit': '100;w=21600',
+            'RateLimit-Remaining': '0;w=21600',
+        })
+
+        def take(state, now):
+            state['tokens'] = 0
+            state['updated'] = now
+        self.bucket._update(take)
+
+        self.sleep.side_effect = StopIteration
+        self.assertRaises(StopIteration, self.other.acquire)
+        wait = self.sleep.call_args[0][0]
+        # 100 pulls per 6 hours is one every 216 seconds.
+        self.assertTrue(210 < wait <= 216, wait)
+
+    def test_retry_after_blocks_all_workers(self):
+        self.bucket.update_from_headers({'Retry-After': '30'}, 429)
+        self.sleep.side_effect = StopIteration
+        self.assertRaises(StopIteration, self.other.acquire)
+        wait = self.sleep.call_args[0][0]
+        self.assertTrue(25 < wait <= 30, wait)
+
+    def test_rate_limited_without_retry_after(self):
+        self.bucket.rate_limited()
+        self.sleep.side_effect = StopIteration
+        self.assertRaises(StopIteration, self.other.acquire)
+        self.assertTrue(
+            self.sleep.call_args[0][0] > windlass.ratelimit.default_backoff
+            - 5)
+
+    def test_stale(self):
+        self.assertTrue(self.bucket.stale())
+        self.bucket.update_from_headers({})
+        self.assertFalse(self.other.stale())
@@ -0,0 +1,387 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import hashlib
+import http.server
+import json
+import os
+import pickle
+import re
+import tempfile
+import threading
+import urllib.parse
+import uuid
+
+import fixtures
+import testtools
+
+import windlass.exc
+import windlass.images
+import windlass.registries
+import windlass.remotes
+
+MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+
+
+def digest_of(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+class FakeRegistryHandler(http.server.BaseHTTPRequestHandler):
+    """Minimal in-process implementation of the registry v2 API"""
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body=b'', headers={}):
+        self.send_response(code)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _authorized(self):
+        if not self.server.token:
+            return True
+        if self.headers.get('Authorization') == 'Bearer %s' % (
+                self.server.token):
+            return True
+        self._send(401, headers={
+            'WWW-Authenticate': 'Bearer realm="http://%s:%d/token",'
+            'service="fake",scope="repository:any:pull,push"' % (
+                self.server.server_address)})
+        return False
+
+    def _route(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/token':
+            self.server.token_requests += 1
+            return self._send(200, json.dumps({
+                'token': self.server.token,
+                'expires_in': self.server.expires_in}).encode())
+        if not self._authorized():
+            return
+        self.server.requests.append((self.command, url.path))
+        m = re.match(r'/v2/(.+)/manifests/(.+)$', url.path)
+        if m:
+            return self._manifest(m.group(1), m.group(2))
+        m = re.match(r'/v2/(.+)/blobs/uploads/(.*)$', url.path)
+        if m:
+            return self._upload(m.group(1), m.group(2), query)
+        m = re.match(r'/v2/(.+)/blobs/(.+)$', url.path)
+        if m:
+            return self._blob(m.group(1), m.group(2))
+        self._send(404)
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_PATCH = _route
+
+    def _manifest(self, repo, ref):
+        manifests = self.server.manifests
+        if self.command == 'PUT':
+            body = self._body()
+            digest = digest_of(body)
+            media_type = self.headers['Content-Type']
+            manifests[(repo, ref)] = manifests[(repo, digest)] = (
+                body, media_type)
+            return self._send(201, headers={'Docker-Content-Digest': digest})
+        if (repo, ref) not in manifests:
+            return self._send(404)
+        body, media_type = manifests[(repo, ref)]
+        self._send(200, body, {
+            'Content-Type': media_type,
+            'Docker-Content-Digest': digest_of(body)})
+
+    def _blob(self, repo, digest):
+        if (repo, digest) not in self.server.blobs:
+            return self._send(404)
+        self._send(200, self.server.blobs[(repo, digest)])
+
+    def _upload(self, repo, upload_id, query):
+        server = self.server
+        if self.command == 'POST':
+            source = query.get('from')
+            if source and (source, query['mount']) in server.blobs:
+                server.blobs[(repo, query['mount'])] = server.blobs[
+                    (source, query['mount'])]
+                return self._send(201)
+            upload_id = uuid.uuid4().hex
+            server.uploads[upload_id] = b''
+            return self._send(202, headers={
+                'Location': '/v2/%s/blobs/uploads/%s' % (repo, upload_id)})
+        data = server.uploads[upload_id]
+        if self.command == 'GET':
+            return self._send(204, headers={
+                'Location': self.path,
+                'Range': '0-%d' % max(len(data) - 1, 0)})
+        if self.command == 'PATCH':
+            chunk = self._body()
+            start = int(self.headers['Content-Range'].split('-')[0])
+            if start != len(data):
+                return self._send(416)
+            server.uploads[upload_id] = data + chunk
+            if server.fail_patches:
+                # Drop the connection after storing the chunk, as if the
+                # response never made it back.
+                server.fail_patches -= 1
+                self.close_connection = True
+                return
+            return self._send(202, headers={
+                'Location': self.path,
+                'Range': '0-%d' % (len(data) + len(chunk) - 1)})
+        if self.command == 'PUT':
+            data += self._body()
+            if digest_of(data) != query['digest']:
+                return self._send(400)
+            server.blobs[(repo, query['digest'])] = data
+            return self._send(201)
+
+
+class FakeRegistry(object):
+
+    def __init__(self, token=None):
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), FakeRegistryHandler)
+        self.server.token = token
+        self.server.token_requests = 0
+        self.server.expires_in = 300
+        self.server.manifests = {}
+        self.server.blobs = {}
+        self.server.uploads = {}
+        self.server.requests = []
+        self.server.fail_patches = 0
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_image(self, repo, tag, layers):
+        config = json.dumps({'architecture': 'amd64'}).encode()
+        descs = []
+        for blob, media_type in [(config, 'config')] + [
+                (layer, 'layer') for layer in layers]:
+            self.server.blobs[(repo, digest_of(blob))] = blob
+            descs.append({
+                'mediaType': media_type, 'size': len(blob),
+                'digest': digest_of(blob)})
+        manifest = json.dumps({
+            'schemaVersion': 2, 'mediaType': MANIFEST_V2,
+            'config': descs[0], 'layers': descs[1:]}).encode()
+        self.server.manifests[(repo, tag)] = self.server.manifests[
+            (repo, digest_of(manifest))] = (manifest, MANIFEST_V2)
+        return digest_of(manifest)
+
+
+class TestRegistryClient(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.registry = FakeRegistry()
+        self.addCleanup(self.registry.stop)
+        self.client = windlass.remotes.RegistryClient(
+            self.registry.url, chunk_size=1024)
+        self.layers = [os.urandom(3000), os.urandom(10)]
+        self.digest = self.registry.add_image('org/app', '1.0', self.layers)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.layout = tmp.name
+
+    def test_pull(self):
+        digest = self.client.pull('org/app', '1.0', self.layout)
+        self.assertEqual(self.digest, digest)
+        for layer in self.layers:
+            path = os.path.join(
+                self.layout, 'blobs', 'sha256', digest_of(layer)[7:])
+            with open(path, 'rb') as fp:
+                self.assertEqual(layer, fp.read())
+        with open(os.path.join(self.layout, 'index.json')) as fp:
+            self.assertEqual(
+                self.digest, json.load(fp)['manifests'][0]['digest'])
+
+    def test_pull_digest_mismatch(self):
+        self.registry.server.blobs[
+            ('org/app', digest_of(self.layers[0]))] = b'corrupt'
+        self.assertRaises(
+            windlass.exc.WindlassPushPullException,
+            self.client.pull, 'org/app', '1.0', self.layout)
+
+    def test_push(self):
+        self.client.pull('org/app', '1.0', self.layout)
+        digest = self.client.push('other/app', '2.0', self.layout)
+        self.assertEqual(self.digest, digest)
+        self.assertIn(('other/app', '2.0'), self.registry.server.manifests)
+        for layer in self.layers:
+            self.assertEqual(
+                layer,
+                self.registry.server.blobs[('other/app', digest_of(layer))])
+
+    def test_chunked_upload_resumes(self):
+        self.registry.server.fail_patches = 1
+        data = os.urandom(5000)
+        with tempfile.TemporaryFile() as fp:
+            fp.write(data)
+            self.client.upload_blob('org/app', digest_of(data), fp)
+        self.assertEqual(
+            data, self.registry.server.blobs[('org/app', digest_of(data))])
+        patches = [r for r in self.registry.server.requests
+                   if r[0] == 'PATCH']
+        # 5 chunks of 1024, the dropped chunk isn't sent again.
+        self.assertEqual(5, len(patches))
+
+    def test_copy_image_same_registry_mounts(self):
+        digest = self.client.copy_image(
+            self.client, 'org/app', '1.0', 'promoted/app', '1.0')
+        self.assertEqual(self.digest, digest)
+        self.assertNotIn(
+            'PATCH', [r[0] for r in self.registry.server.requests])
+        self.assertIn(
+            ('promoted/app', digest_of(self.layers[0])),
+            self.registry.server.blobs)
+
+    def test_copy_image_between_registries(self):
+        other = FakeRegistry(token='secret')
+        self.addCleanup(other.stop)
+        dest = windlass.remotes.RegistryClient(other.url, 'user', 'pass')
+        digest = dest.copy_image(
+            self.client, 'org/app', '1.0', 'org/app', '1.1')
+        self.assertEqual(self.digest, digest)
+        self.assertIn(('org/app', '1.1'), other.server.manifests)
+        for layer in self.layers:
+            self.assertEqual(
+                layer, other.server.blobs[('org/app', digest_of(layer))])
+        # Token is reused for subsequent requests.
+        self.assertEqual(1, other.server.token_requests)
+
+    def test_stale_token_renewed(self):
+        registry = FakeRegistry(token='secret')
+        self.addCleanup(registry.stop)
+        client = windlass.remotes.RegistryClient(registry.url)
+        data = os.urandom(3000)
+        registry.server.blobs[('org/app', digest_of(data))] = data
+        self.assertTrue(client.blob_exists('org/app', digest_of(data)))
+        # The registry no longer accepts the token, as if it expired.
+        registry.server.token = 'renewed'
+        self.assertTrue(client.blob_exists('org/app', digest_of(data)))
+        self.assertEqual(2, registry.server.token_requests)
+
+    def test_expired_token_renewed(self):
+        registry = FakeRegistry(token='secret')
+        registry.server.expires_in = -1
+        self.addCleanup(registry.stop)
+        client = windlass.remotes.RegistryClient(registry.url)
+        challenge = (
+            'Bearer realm="%s/token",service="fake",scope="repository:a:pull"'
+            % registry.url)
+        self.assertEqual('secret', client._get_token(challenge))
+        self.assertEqual('secret', client._get_token(challenge))
+        self.assertEqual(2, registry.server.token_requests)
+
+
+class TestImageRegistryTransfer(testtools.TestCase):
+    """Images downloaded and uploaded without the docker daemon"""
+
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixtures.EnvironmentVariable(
+            'WINDLASS_CACHE_DIR', self.useFixture(fixtures.TempDir()).path))
+        for name in ('acquire', 'acquire_for_image', 'get_client'):
+            self.useFixture(fixtures.MockPatch(
+                'windlass.daemons.' + name,
+                side_effect=AssertionError('docker daemon used')))
+        self.source = FakeRegistry()
+        self.addCleanup(self.source.stop)
+        self.dest = FakeRegistry()
+        self.addCleanup(self.dest.stop)
+        self.layers = [os.urandom(3000), os.urandom(10)]
+        self.digest = self.source.add_image('org/app', '1.0', self.layers)
+        self.layout_dir = self.useFixture(fixtures.TempDir()).path
+
+    def host(self, registry):
+        return registry.url[len('http://'):]
+
+    def image(self):
+        return windlass.images.Image(dict(name='org/app', version='1.0'))
+
+    def upload(self, image, **kwargs):
+        registry = windlass.registries.DockerRegistry(self.host(self.dest))
+        return image.upload(
+            version='1.1', docker_image_registry=registry,
+            registry_transfer=True, **kwargs)
+
+    def test_promoted(self):
+        image = self.image()
+        image.download(docker_image_registry=self.host(self.source),
+                       registry_transfer=True)
+        self.assertEqual(
+            '%s/org/app:1.1' % self.host(self.dest), self.upload(image))
+        self.assertEqual(
+            self.source.server.manifests[('org/app', '1.0')],
+            self.dest.server.manifests[('org/app', '1.1')])
+        for layer in self.layers:
+            self.assertEqual(
+                layer, self.dest.server.blobs[('org/app', digest_of(layer))])
+
+    def test_promoted_in_registry(self):
+        image = self.image()
+        image.download(docker_image_registry=self.host(self.source),
+                       registry_transfer=True)
+        registry = windlass.registries.DockerRegistry(
+            self.host(self.source) + '/release')
+        image.upload(version='1.0', docker_image_registry=registry,
+                     registry_transfer=True)
+        self.assertIn(
+            ('release/org/app', '1.0'), self.source.server.manifests)
+        # The blobs are mounted rather than sent again.
+        self.assertNotIn(
+            'PATCH', [r[0] for r in self.source.server.requests])
+
+    def test_pushed_from_layout(self):
+        self.image().download(
+            docker_image_registry=self.host(self.source),
+            registry_transfer=True, oci_layout_dir=self.layout_dir)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.layout_dir, 'org', 'app', '1.0', 'index.json')))
+        requests = len(self.source.server.requests)
+        # By another run, from the layout.
+        self.upload(self.image(), oci_layout_dir=self.layout_dir)
+        self.assertEqual(
+            self.source.server.manifests[('org/app', '1.0')],
+            self.dest.server.manifests[('org/app', '1.1')])
+        self.assertEqual(requests, len(self.source.server.requests))
+
+    def test_downloaded_image_pickled(self):
+        image = self.image()
+        image.download(docker_image_registry=self.host(self.source),
+                       registry_transfer=True)
+        image = pickle.loads(pickle.dumps(image))
+        self.upload(image)
+        self.assertIn(('org/app', '1.1'), self.dest.server.manifests)
+
+    def test_missing_image(self):
+        self.useFixture(fixtures.MockPatch('time.sleep'))
+        self.assertRaises(
+            windlass.exc.FailedRetriesException, self.image().download,
+            version='2.0', docker_image_registry=self.host(self.source),
+            registry_transfer=True)
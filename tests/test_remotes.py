@@ -14,14 +14,31 @@
 # under the License.
 #
 
-import base64
+import hashlib
+import io
+import logging
+import json
+import os
+import pickle
+import tarfile
+import time
 import unittest
 
 import boto3
+import botocore.exceptions
+import botocore.response
 import botocore.stub
+import fixtures
 import testtools
+import yaml
 
+import windlass.api
+import windlass.charts
+import windlass.images
 import windlass.remotes
+import windlass.testing
+
+import tests.fakes3
 
 aws_region = 'test-region'
 aws_account = '012345678901'
@@ -48,24 +65,29 @@ class TestECRConnectorBase(testtools.TestCase):
         self.stubber.activate()
         self.addCleanup(self.stubber.deactivate)
 
-        auth_resp = {'authorizationData': [{
-            'proxyEndpoint': 'https://%s.dkr.ecr.%s.amazonaws.com' % (
-                aws_account, aws_region
-            ),
-            'authorizationToken': base64.b64encode(
-                b'test_username:test_password'
-            ).decode('utf-8'),
-        }]}
-        self.stubber.add_response('get_authorization_token', auth_resp, {})
+        self.cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.EnvironmentVariable(
+            'WINDLASS_CACHE_DIR', self.cache_dir))
 
         # Set the retry backoff time to 0 to speed up tests.
         windlass.remotes.global_retry_backoff = 0
 
     # Stub helper functions for various ecr operations.
-    def _stub_create_repository(self, image_name):
-        self.stubber.add_response(
-            'describe_repositories', {'repositories': []}, {}
+    def _stub_get_authorization_token(self, password='test_password',
+                                      expires_in=12 * 60 * 60):
+        windlass.testing.stub_get_authorization_token(
+            self.stubber,
+            '%s.dkr.ecr.%s.amazonaws.com' % (aws_account, aws_region),
+            password=password, expires_in=expires_in,
         )
+
+    def _stub_describe_repositories(self, names, existing):
+        windlass.testing.stub_describe_repositories(
+            self.stubber, names, existing)
+
+    def _stub_create_repository(self, image_name, look_up=True):
+        if look_up:
+            self._stub_describe_repositories([image_name], [])
         inp = {'repositoryName': image_name}
         resp = {'repository': {
             'registryId': aws_account,
@@ -153,6 +175,62 @@ class TestECRConnectorInitialisation(TestECRConnectorBase):
         )
 
 
+class TestECRConnectorLogin(TestECRConnectorBase):
+    """Test the docker logins of ECRConnector objects."""
+
+    creds = windlass.remotes.AWSCreds(aws_key_id, aws_secret_key, aws_region)
+    registry = '%s.dkr.ecr.%s.amazonaws.com' % (aws_account, aws_region)
+
+    def connector(self):
+        return windlass.remotes.ECRConnector(
+            creds=self.creds, ecrc=self.ecr_client)
+
+    def test_login_when_used(self):
+        connector = self.connector()
+        self.stubber.assert_no_pending_responses()
+        self._stub_get_authorization_token()
+        self.assertEqual([self.registry], connector.registry_list)
+        self.assertEqual('test_username', connector.username)
+        self.assertEqual('test_password', connector.password)
+        self.stubber.assert_no_pending_responses()
+
+    def test_login_cached(self):
+        self._stub_get_authorization_token()
+        self.assertEqual('test_password', self.connector().password)
+        # Other connectors, also in other processes, use the same login.
+        self.assertEqual('test_password', self.connector().password)
+        self.stubber.assert_no_pending_responses()
+
+        token_dir = os.path.join(self.cache_dir, 'ecr-tokens')
+        self.assertEqual(0o700, os.stat(token_dir).st_mode & 0o777)
+        tokens = [
+            f for f in os.listdir(token_dir) if f.endswith('.json')]
+        self.assertEqual(1, len(tokens))
+        token_path = os.path.join(token_dir, tokens[0])
+        self.assertEqual(0o600, os.stat(token_path).st_mode & 0o777)
+        self.assertNotIn(aws_key_id, tokens[0])
+
+    def test_expiring_login_renewed(self):
+        self._stub_get_authorization_token(expires_in=60)
+        connector = self.connector()
+        self.assertEqual('test_password', connector.password)
+        self._stub_get_authorization_token(password='new_password')
+        self.assertEqual('new_password', connector.password)
+        self.assertEqual('new_password', self.connector().password)
+        self.stubber.assert_no_pending_responses()
+
+    def test_login_per_credentials(self):
+        self._stub_get_authorization_token()
+        self.assertEqual('test_password', self.connector().password)
+        self._stub_get_authorization_token(password='other_password')
+        connector = windlass.remotes.ECRConnector(
+            creds=windlass.remotes.AWSCreds(
+                aws_key_id, aws_secret_key, 'other-region'),
+            ecrc=self.ecr_client)
+        self.assertEqual('other_password', connector.password)
+        self.stubber.assert_no_pending_responses()
+
+
 class TestECRConnectorUsage(TestECRConnectorBase):
     def setUp(self):
         super().setUp()
@@ -227,6 +305,137 @@ class TestECRConnectorUsage(TestECRConnectorBase):
             self.assertEqual(retry, 3)
             self.assertIn('Maximum number of retries occurred (3)', str(e))
 
+    def test_existing_repo_not_created(self):
+        image_name = 'my/old/image'
+        self._stub_describe_repositories([image_name], [image_name])
+
+        self.connector._create_repo_if_new(image_name)
+        self.connector._create_repo_if_new(image_name)
+        self.stubber.assert_no_pending_responses()
+
+    @unittest.mock.patch('windlass.remotes.ECR_BATCH_SIZE', 4)
+    def test_check_repos_batched(self):
+        names = ['image%d' % i for i in range(6)]
+        existing = [n for n in names if n != 'image3']
+        # Batches with a missing repository are split until it's found.
+        self._stub_describe_repositories(names[:4], existing)
+        self._stub_describe_repositories(names[:2], existing)
+        self._stub_describe_repositories(names[2:4], existing)
+        self._stub_describe_repositories(names[2:3], existing)
+        self._stub_describe_repositories(names[3:4], existing)
+        self._stub_describe_repositories(names[4:], existing)
+
+        self.connector.check_repos(reversed(names))
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(set(existing), self.connector.existing_repos)
+
+        # Checked repositories aren't looked up again.
+        self.connector.check_repos(names)
+        self.connector._create_repo_if_new('image0')
+        self._stub_create_repository('image9')
+        self._stub_set_repository_policy('image9')
+        self.connector._create_repo_if_new('image9')
+        self.stubber.assert_no_pending_responses()
+
+
+class TestECRConnectorPush(TestECRConnectorBase):
+    """Test skipping pushes of images already in the registry."""
+
+    def setUp(self):
+        super().setUp()
+        self.connector = windlass.remotes.ECRConnector(
+            creds=None, ecrc=self.ecr_client)
+        # The local images, by name.
+        self.local_images = {}
+
+        def acquire_for_image(name):
+            dcli = unittest.mock.Mock()
+            dcli.images.get.side_effect = lambda name: unittest.mock.Mock(
+                id=self.local_images[name])
+            return dcli
+        self.useFixture(fixtures.MockPatch(
+            'windlass.daemons.acquire_for_image', acquire_for_image))
+        self.useFixture(fixtures.MockPatch('windlass.daemons.release'))
+        self.push = self.useFixture(fixtures.MockPatch(
+            'windlass.remotes.DockerConnector.upload',
+            return_value='pushed')).mock
+
+    @unittest.mock.patch('windlass.remotes.ECR_BATCH_SIZE', 2)
+    def test_check_images_batched(self):
+        windlass.testing.stub_batch_get_image(
+            self.stubber, 'image', ['1', '2'], {'1': 'sha256:1'})
+        windlass.testing.stub_batch_get_image(
+            self.stubber, 'image', ['3'], {'3': 'sha256:3'})
+        self.connector.check_images(
+            [('image', '3'), ('image', '2'), ('image', '1')])
+        self.stubber.assert_no_pending_responses()
+
+        self.local_images['image:3'] = 'sha256:3'
+        self.assertTrue(self.connector._in_registry('image:3', 'image', '3'))
+        self.assertFalse(self.connector._in_registry('image:2', 'image', '2'))
+        self.local_images['image:1'] = 'sha256:other'
+        self.assertFalse(self.connector._in_registry('image:1', 'image', '1'))
+
+    def test_prepare_looks_up_images(self):
+        connector = windlass.remotes.ECRConnector(
+            creds=None, path_prefixes='prefix/', ecrc=self.ecr_client)
+        self._stub_describe_repositories(['prefix/image'], ['prefix/image'])
+        windlass.testing.stub_batch_get_image(
+            self.stubber, 'prefix/image', ['1.0.0'], {'1.0.0': 'sha256:abc'})
+        connector.prepare([('image', '1.0.0')])
+        self.stubber.assert_no_pending_responses()
+
+        # The upload doesn't look the image up again.
+        self._stub_get_authorization_token()
+        self.local_images['image:dev'] = 'sha256:abc'
+        connector.upload('image:dev', upload_tag='1.0.0')
+        self.stubber.assert_no_pending_responses()
+        self.push.assert_not_called()
+
+    def test_pushed_image_skipped(self):
+        self._stub_describe_repositories(['image'], ['image'])
+        windlass.testing.stub_batch_get_image(
+            self.stubber, 'image', ['1.0.0'], {'1.0.0': 'sha256:abc'})
+        self.connector.check_repos(['image'])
+        self.connector.check_images([('image', '1.0.0')])
+        self._stub_get_authorization_token()
+
+        self.local_images['image:dev'] = 'sha256:abc'
+        self.assertEqual(
+            '%s.dkr.ecr.%s.amazonaws.com/image:1.0.0' % (
+                aws_account, aws_region),
+            self.connector.upload('image:dev', upload_tag='1.0.0'))
+        self.stubber.assert_no_pending_responses()
+        self.push.assert_not_called()
+
+    def test_changed_image_pushed(self):
+        # The repository exists, as it has images, so isn't looked up.
+        windlass.testing.stub_batch_get_image(
+            self.stubber, 'image', ['1.0.0'], {'1.0.0': 'sha256:abc'})
+
+        self.local_images['image:1.0.0'] = 'sha256:def'
+        self.assertEqual('pushed', self.connector.upload('image:1.0.0'))
+        self.stubber.assert_no_pending_responses()
+        self.push.assert_called_once_with('image:1.0.0', 'image', None)
+
+    def test_image_lookup_failure(self):
+        self.stubber.add_client_error(
+            'batch_get_image', 'AccessDeniedException')
+        self._stub_describe_repositories(['image'], ['image'])
+
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual('pushed', self.connector.upload('image:1.0.0'))
+        self.stubber.assert_no_pending_responses()
+
+    def test_new_repository_pushed(self):
+        self.stubber.add_client_error(
+            'batch_get_image', 'RepositoryNotFoundException')
+        # Known not to exist, so not looked up again before it's created.
+        self._stub_create_repository('image', look_up=False)
+
+        self.assertEqual('pushed', self.connector.upload('image:1.0.0'))
+        self.stubber.assert_no_pending_responses()
+
 
 class TestAWSRemote(TestECRConnectorBase):
 
@@ -266,3 +475,332 @@ class TestAWSRemote(TestECRConnectorBase):
         self.assertEqual(
             self.remote.ecr.new_repo_lifecycle_policy, policy['lifecycle']
         )
+
+    def test_prepare_checks_repos(self):
+        self.remote.setup_docker(['prefix/'], ecr_access_policies[0])
+        artifacts = [
+            windlass.images.Image(dict(name='some/image', version='1.0.0')),
+            windlass.images.Image(dict(name='other/image', version='1.0.0')),
+            windlass.charts.Chart(dict(name='some/chart', version='1.0.0')),
+        ]
+        self._stub_describe_repositories(
+            ['prefix/other/image', 'prefix/some/image'],
+            ['prefix/some/image'],
+        )
+        self._stub_describe_repositories(['prefix/other/image'], [])
+        self._stub_describe_repositories(
+            ['prefix/some/image'], ['prefix/some/image'])
+        # There are no images in the new repository to look up.
+        windlass.testing.stub_batch_get_image(
+            self.stubber, 'prefix/some/image', ['1.0.0'],
+            {'1.0.0': 'sha256:abc'})
+        self.remote.prepare(artifacts)
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(
+            set(['prefix/some/image']), self.remote.ecr.existing_repos)
+        self.assertEqual(
+            {('prefix/other/image', '1.0.0'): None,
+             ('prefix/some/image', '1.0.0'): 'sha256:abc'},
+            self.remote.ecr._registry_images,
+        )
+        self.remote.finalize()
+
+    def test_prepare_lookup_failure(self):
+        self.remote.setup_docker()
+        self.stubber.add_client_error(
+            'describe_repositories', 'AccessDeniedException')
+        artifacts = [
+            windlass.images.Image(dict(name='some/image', version='1.0.0')),
+        ]
+        with self.assertLogs(level='WARNING'):
+            self.remote.prepare(artifacts)
+        # Looked up again on upload.
+        self._stub_create_repository('some/image')
+        self.remote.ecr._create_repo_if_new('some/image')
+        self.stubber.assert_no_pending_responses()
+
+
+def make_chart(name, version):
+    chart_yaml = yaml.safe_dump({
+        'apiVersion': 'v1', 'name': name, 'version': version}).encode()
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w:gz') as tar:
+        member = tarfile.TarInfo('%s/Chart.yaml' % name)
+        member.size = len(chart_yaml)
+        tar.addfile(member, io.BytesIO(chart_yaml))
+    return out.getvalue()
+
+
+class RecordingS3Connector(windlass.remotes.S3Connector):
+    """Uploads nowhere, and records the index updates made"""
+
+    def upload(self, upload_name, stream):
+        stream.read()
+        return self._obj_url(upload_name)
+
+    def update_chart_index(self, entries, attempts=5):
+        self.index_updates.append(entries)
+
+
+def upload_chart(artifact, remote=None):
+    return remote.upload_chart(
+        'charts/%s-%s.tgz' % (artifact.name, artifact.version),
+        io.BytesIO(make_chart(artifact.name, artifact.version)))
+
+
+class TestS3ChartIndex(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.connector = windlass.remotes.S3Connector(
+            None, 'bucket', 'stable/')
+        self.connector._s3c = boto3.client(
+            's3', aws_access_key_id='None', aws_secret_access_key='None',
+            region_name='us-east-1')
+        self.stubber = botocore.stub.Stubber(self.connector._s3c)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+        self.entry = windlass.charts.index_entry(
+            io.BytesIO(make_chart('app', '1.0.0')), 'http://charts/app.tgz')
+
+    def stub_get(self, index, etag):
+        body = yaml.safe_dump(index).encode()
+        self.stubber.add_response('get_object', {
+            'Body': botocore.response.StreamingBody(
+                io.BytesIO(body), len(body)),
+            'ETag': etag,
+        }, {'Bucket': 'bucket', 'Key': 'stable/index.yaml'})
+
+    def stub_put(self, **kwargs):
+        params = {'Bucket': 'bucket', 'Key': 'stable/index.yaml',
+                  'Body': botocore.stub.ANY,
+                  'ContentType': 'application/x-yaml'}
+        params.update(kwargs)
+        self.stubber.add_response('put_object', {}, params)
+
+    def conditional_writes(self, supported):
+        if supported and not self.connector._supports('PutObject', 'IfMatch'):
+            self.skipTest('botocore without conditional writes')
+        self.useFixture(fixtures.MockPatchObject(
+            self.connector, '_supports', return_value=supported))
+
+    def test_new_index(self):
+        self.conditional_writes(True)
+        self.stubber.add_client_error(
+            'get_object', 'NoSuchKey', http_status_code=404)
+        self.stub_put(IfNoneMatch='*')
+        self.connector.update_chart_index([self.entry])
+        self.stubber.assert_no_pending_responses()
+
+    def test_changed_index_retried(self):
+        self.conditional_writes(True)
+        index = windlass.charts.merge_index(None, [])
+        self.stub_get(index, '"1"')
+        self.stubber.add_client_error(
+            'put_object', 'PreconditionFailed', http_status_code=412)
+        self.stub_get(index, '"2"')
+        self.stub_put(IfMatch='"2"')
+        self.connector.update_chart_index([self.entry])
+        self.stubber.assert_no_pending_responses()
+
+    def stub_head(self, etag):
+        self.stubber.add_response('head_object', {'ETag': etag}, {
+            'Bucket': 'bucket', 'Key': 'stable/index.yaml'})
+
+    def test_new_index_unconditional(self):
+        self.conditional_writes(False)
+        self.stubber.add_client_error(
+            'get_object', 'NoSuchKey', http_status_code=404)
+        self.stub_put()
+        self.connector.update_chart_index([self.entry])
+        self.stubber.assert_no_pending_responses()
+
+    def test_changed_index_retried_unconditional(self):
+        self.conditional_writes(False)
+        index = windlass.charts.merge_index(None, [])
+        self.stub_get(index, '"1"')
+        self.stub_head('"2"')
+        self.stub_get(index, '"2"')
+        self.stub_head('"2"')
+        self.stub_put()
+        self.connector.update_chart_index([self.entry])
+        self.stubber.assert_no_pending_responses()
+
+    def test_merge_index(self):
+        index = windlass.charts.merge_index(None, [self.entry])
+        newer = dict(self.entry, version='1.10.0')
+        index = windlass.charts.merge_index(index, [newer, self.entry])
+        self.assertEqual(
+            ['1.10.0', '1.0.0'],
+            [e['version'] for e in index['entries']['app']])
+        self.assertEqual(
+            ['http://charts/app.tgz'], index['entries']['app'][1]['urls'])
+        self.assertEqual(64, len(index['entries']['app'][1]['digest']))
+
+    def test_one_index_update_per_run(self):
+        remote = windlass.remotes.AWSRemote(
+            aws_key_id, aws_secret_key, aws_region)
+        remote.charts_connector = RecordingS3Connector(
+            remote.creds, 'bucket')
+        remote.charts_connector.index_updates = []
+        artifacts = [
+            windlass.charts.Chart({'name': 'chart%d' % i, 'version': '1.0'})
+            for i in range(5)]
+        g = windlass.api.Windlass(
+            artifacts=windlass.api.Artifacts(artifacts=artifacts))
+        g.run(upload_chart, remote=remote)
+
+        updates = remote.charts_connector.index_updates
+        self.assertEqual(1, len(updates))
+        self.assertEqual(
+            ['chart%d' % i for i in range(5)],
+            sorted(e['name'] for e in updates[0]))
+        self.assertIsNone(remote.chart_index_spool)
+
+    def test_remote_pickled_after_index_update(self):
+        remote = windlass.remotes.AWSRemote(
+            aws_key_id, aws_secret_key, aws_region)
+        remote.setup_charts('bucket')
+        remote.prepare([])
+        with open(os.path.join(remote.chart_index_spool, 'a.json'), 'w') as fp:
+            json.dump(self.entry, fp, default=str)
+        stubber = botocore.stub.Stubber(remote.charts_connector.s3c)
+        stubber.add_client_error(
+            'get_object', 'NoSuchKey', http_status_code=404)
+        stubber.add_response('put_object', {})
+        with stubber:
+            remote.finalize()
+        stubber.assert_no_pending_responses()
+        # Remotes are passed to the workers of later runs.
+        copy = pickle.loads(pickle.dumps(remote))
+        self.assertIsNone(copy.charts_connector._s3c)
+        self.assertIsNotNone(remote.charts_connector._s3c)
+
+
+class TestS3Transfers(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = self.useFixture(tests.fakes3.FakeS3Server(delay=0.02))
+        self.useFixture(fixtures.MockPatchObject(
+            windlass.remotes, '_s3_objects', {}))
+        # S3 parts are at least 5MiB.
+        self.data = os.urandom(3 * 5 * 1024 * 1024 + 10)
+        self.tmp = self.useFixture(fixtures.TempDir()).path
+
+    def connector(self, concurrency=4):
+        connector = windlass.remotes.S3Connector(
+            None, 'bucket', 'generic/',
+            transfer_config=windlass.remotes.s3_transfer_config(
+                threshold=5 * 1024 * 1024, part_size=5 * 1024 * 1024,
+                concurrency=concurrency))
+        connector._s3c = self.server.client()
+        return connector
+
+    def test_multipart_upload(self):
+        self.connector().upload('app.tgz', io.BytesIO(self.data))
+        obj = self.server.objects['/bucket/generic/app.tgz']
+        self.assertEqual(self.data, obj['data'])
+        self.assertTrue(obj['etag'].endswith('-4"'))
+        self.assertGreater(self.server.max_active, 1)
+
+    def heads(self):
+        return [r for r in self.server.requests if r[0] == 'HEAD']
+
+    def test_unchanged_not_uploaded(self):
+        self.connector().upload('app.tgz', io.BytesIO(self.data))
+        self.assertEqual(
+            {'sha256': hashlib.sha256(self.data).hexdigest()},
+            self.server.objects['/bucket/generic/app.tgz']['metadata'])
+        # As seen by another run.
+        windlass.remotes._s3_objects.clear()
+        self.connector().upload('app.tgz', io.BytesIO(self.data))
+        self.assertEqual(['/bucket/generic/app.tgz'], self.server.puts)
+        self.assertEqual(2, len(self.heads()))
+
+    def test_unchanged_checked_once_per_run(self):
+        connector = self.connector()
+        for i in range(3):
+            connector.upload('app.tgz', io.BytesIO(self.data))
+        self.assertEqual(1, len(self.server.puts))
+        self.assertEqual(1, len(self.heads()))
+
+    def test_changed_uploaded(self):
+        self.connector().upload('app.tgz', io.BytesIO(b'old'))
+        windlass.remotes._s3_objects.clear()
+        self.connector().upload('app.tgz', io.BytesIO(b'new'))
+        self.assertEqual(
+            b'new', self.server.objects['/bucket/generic/app.tgz']['data'])
+        self.assertEqual(2, len(self.server.puts))
+
+    def test_single_part_etag_compared(self):
+        # Uploaded by something else, without the sha256 metadata.
+        self.server.objects['/bucket/generic/sig.asc'] = {
+            'data': b'signature', 'metadata': {},
+            'etag': '"%s"' % hashlib.md5(b'signature').hexdigest()}
+        stream = iter([b'signature'])
+        self.connector().upload('sig.asc', unittest.mock.Mock(
+            read=lambda n=-1: next(stream, b'')))
+        self.assertEqual([], self.server.puts)
+
+    def test_forbidden_head_uploaded(self):
+        connector = self.connector()
+        self.useFixture(fixtures.MockPatchObject(
+            connector._s3c, 'head_object',
+            side_effect=botocore.exceptions.ClientError(
+                {'Error': {'Code': '403', 'Message': 'Forbidden'}},
+                'HeadObject')))
+        connector.upload('app.tgz', io.BytesIO(b'data'))
+        self.assertEqual(['/bucket/generic/app.tgz'], self.server.puts)
+
+    def test_ranged_download(self):
+        self.server.objects['/bucket/generic/app.tgz'] = {
+            'data': self.data, 'etag': '"etag"', 'metadata': {}}
+        path = os.path.join(self.tmp, 'app.tgz')
+        self.connector().download('app.tgz', path)
+        with open(path, 'rb') as fp:
+            self.assertEqual(self.data, fp.read())
+        ranges = [r for r in self.server.requests
+                  if r[0] == 'GET' and 'Range' in r[2]]
+        self.assertEqual(4, len(ranges))
+        self.assertGreater(self.server.max_active, 1)
+        self.assertEqual(['app.tgz'], os.listdir(self.tmp))
+
+    def test_transfer_config_from_env(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            windlass.remotes.S3_PART_SIZE_ENV, str(64 * 1024 * 1024)))
+        self.useFixture(fixtures.EnvironmentVariable(
+            windlass.remotes.S3_CONCURRENCY_ENV, '20'))
+        config = windlass.remotes.s3_transfer_config()
+        self.assertEqual(64 * 1024 * 1024, config.multipart_chunksize)
+        self.assertEqual(20, config.max_concurrency)
+        self.assertEqual(
+            windlass.remotes.DEFAULT_S3_THRESHOLD, config.multipart_threshold)
+
+    def test_client_per_process(self):
+        self.useFixture(fixtures.MockPatchObject(
+            windlass.remotes, '_s3_clients', {}))
+        creds = windlass.remotes.AWSCreds('key', 'secret', 'us-east-1')
+        client = windlass.remotes.get_s3_client(creds)
+        self.assertIs(client, windlass.remotes.get_s3_client(creds))
+        self.assertIs(
+            client,
+            windlass.remotes.S3Connector(creds, 'other-bucket').s3c)
+        with unittest.mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(client, windlass.remotes.get_s3_client(creds))
+        self.assertEqual(1, len(windlass.remotes._s3_clients))
+
+    def test_transfer_benchmark(self):
+        """Parts are transferred concurrently"""
+        timings = []
+        for concurrency in (1, 4):
+            connector = self.connector(concurrency)
+            start = time.time()
+            name = 'app-%d.tgz' % concurrency
+            connector.upload(name, io.BytesIO(self.data))
+            connector.download(name, os.path.join(self.tmp, name))
+            timings.append(time.time() - start)
+        logging.info(
+            'Uploading and downloading %d bytes: %.3fs one part at a time, '
+            '%.3fs with 4 concurrent parts', len(self.data), *timings)
+        self.assertGreater(self.server.max_active, 1)
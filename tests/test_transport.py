@@ -0,0 +1,169 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import io
+import logging
+import time
+import unittest.mock
+
+import fixtures
+import requests
+import testtools
+
+import windlass.remotes
+import windlass.transport
+
+import tests.fakehttp
+
+
+class FlakyHandler(tests.fakehttp.FakeHTTPHandler):
+    """Unavailable for the first requests"""
+
+    def handle_GET(self):
+        if self.server.unavailable:
+            self.server.unavailable -= 1
+            return self.send(503)
+        super().handle_GET()
+
+
+class PlainPutHandler(tests.fakehttp.FakeHTTPHandler):
+    """Stores PUT requests as they are, like servers other than Artifactory"""
+
+    def handle_PUT(self):
+        self.server.files[self.path] = self.body()
+        self.send(201)
+
+
+class TestTransport(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = self.useFixture(
+            tests.fakehttp.FakeHTTPServer(FlakyHandler))
+        self.server.server.unavailable = 0
+        self.useFixture(fixtures.MockPatchObject(
+            windlass.transport, '_sessions', {}))
+        self.useFixture(fixtures.MockPatchObject(
+            windlass.transport, '_no_checksum_deploy', set()))
+
+    def test_session_per_process(self):
+        session = windlass.transport.get_session()
+        self.assertIs(session, windlass.transport.get_session())
+        with unittest.mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(session, windlass.transport.get_session())
+        # The parent's sessions are dropped in the new process.
+        self.assertEqual(1, len(windlass.transport._sessions))
+
+    def test_auth_configured_once(self):
+        session = windlass.transport.get_session('user', 'secret')
+        self.assertIsNot(session, windlass.transport.get_session())
+        session.get(self.server.url + '/file')
+        self.assertEqual(
+            requests.auth._basic_auth_str('user', 'secret'),
+            self.server.requests[0][2]['Authorization'])
+
+    def test_default_timeout(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            windlass.transport.TIMEOUT_ENV, '2,20'))
+        session = windlass.transport.Session()
+        with unittest.mock.patch('requests.Session.request') as request:
+            session.get(self.server.url)
+            session.get(self.server.url, timeout=5)
+        self.assertEqual(
+            [(2, 20), 5], [c[1]['timeout'] for c in request.call_args_list])
+
+    def test_retries_unavailable(self):
+        self.server.files['/file'] = b'data'
+        self.server.server.unavailable = 2
+        resp = windlass.transport.Session(retries=3).get(
+            self.server.url + '/file')
+        self.assertEqual(b'data', resp.content)
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_checksum_deploy(self):
+        self.server.files['/repo/a.tgz'] = b'data'
+        headers = windlass.transport.checksum_headers(io.BytesIO(b'data'))
+        session = windlass.transport.get_session()
+        url = self.server.url + '/repo/b.tgz'
+        self.assertTrue(
+            windlass.transport.checksum_deploy(session, url, headers))
+        self.assertEqual(b'data', self.server.files['/repo/b.tgz'])
+        self.assertEqual('0', self.server.requests[0][2]['Content-Length'])
+
+        headers = windlass.transport.checksum_headers(io.BytesIO(b'new'))
+        self.assertFalse(
+            windlass.transport.checksum_deploy(session, url, headers))
+
+    def test_checksum_deploy_unsupported(self):
+        server = self.useFixture(
+            tests.fakehttp.FakeHTTPServer(PlainPutHandler))
+        headers = windlass.transport.checksum_headers(io.BytesIO(b'data'))
+        session = windlass.transport.get_session()
+        for i in range(2):
+            self.assertFalse(windlass.transport.checksum_deploy(
+                session, server.url + '/a.tgz', headers))
+        # Not tried again once the server is found not to support it.
+        self.assertEqual(1, len(server.requests))
+
+    def test_connector_upload_by_checksum(self):
+        self.server.files['/charts/a.tgz'] = b'x' * 512
+        connector = windlass.remotes.HTTPBasicAuthConnector(
+            self.server.url + '/charts', 'user', 'secret')
+        stream = iter([b'x' * 512])
+        connector.upload('b.tgz', unittest.mock.Mock(
+            read=lambda n=-1: next(stream, b'')))
+        self.assertEqual(b'x' * 512, self.server.files['/charts/b.tgz'])
+        self.assertEqual(
+            [('PUT', '/charts/b.tgz')],
+            [r[:2] for r in self.server.requests])
+
+    def test_progress_reader(self):
+        fp = io.BytesIO(b'skip' + b'x' * 10)
+        fp.seek(4)
+        callback = unittest.mock.Mock()
+        reader = windlass.transport.ProgressReader(fp, 10, callback)
+        self.assertEqual(10, len(reader))
+        self.assertEqual(b'x' * 6, reader.read(6))
+        callback.assert_called_with(6, 10)
+        reader.seek(0)
+        self.assertEqual(0, reader.tell())
+        self.assertEqual(b'x' * 10, reader.read())
+        callback.assert_called_with(10, 10)
+
+    def test_chart_upload_benchmark(self):
+        """Many small chart uploads reuse a single connection"""
+        charts = 50
+        connector = windlass.remotes.HTTPBasicAuthConnector(
+            self.server.url + '/charts', 'user', 'secret')
+        start = time.time()
+        for i in range(charts):
+            connector.upload('chart-%d.tgz' % i, io.BytesIO(b'x' * 512))
+        pooled = time.time() - start
+        self.assertEqual(1, len(self.server.connections))
+        self.assertEqual(charts, len(self.server.files))
+
+        # The same uploads with a new connection for every request.
+        self.server.connections.clear()
+        start = time.time()
+        for i in range(charts):
+            requests.put(
+                '%s/charts/chart-%d.tgz' % (self.server.url, i),
+                data=io.BytesIO(b'x' * 512), auth=('user', 'secret'))
+        unpooled = time.time() - start
+        self.assertEqual(charts, len(self.server.connections))
+        logging.info(
+            '%d chart uploads: %.3fs over one connection, %.3fs with a '
+            'connection each', charts, pooled, unpooled)
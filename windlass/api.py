@@ -68,6 +68,14 @@ class Artifact(object):
         self.version = data.get('version', None)
         self.priority = data.get('priority', 0)
 
+    def load_metadata(self):
+        """Load data about the artifact from its sources
+
+        Called by Artifacts once the artifact is loaded and its metadata
+        set, so that this is done once for the run rather than whenever
+        it's needed.
+        """
+
     def set_version(self, version):
         """Set vesrion of artifact.
 
@@ -239,6 +247,7 @@ class Artifacts(object):
                         artifact = cls(artifact_def)
                         artifact.metadata['repopath'] = repopath
                         artifact.metadata.update(metadata)
+                        artifact.load_metadata()
 
                     artifacts.append(artifact)
 
@@ -265,6 +274,21 @@ class Remote(object):
         """
         raise NotImplementedError('Docker download not implemented')
 
+    def prepare(self, artifacts):
+        """Called by Windlass.run before processing artifacts
+
+        Runs in the parent process, before the remote is passed to the
+        workers, so state set up here is seen by all of them. Only remotes
+        passed directly as arguments of the processor are prepared, which
+        the windlass command line doesn't use.
+        """
+
+    def finalize(self):
+        """Called by Windlass.run once all artifacts were processed
+
+        Runs in the parent process, also when processing failed.
+        """
+
 
 class NoValidRemoteError(Exception):
     """Indicate that a remote upload endpoint is not configured"""
@@ -447,6 +471,24 @@ class Windlass(object):
             **kwargs):
         if self._running:
             raise Exception('Windlass is already processing these artifacts')
+
+        # Remotes passed to the processor, for them to prepare and finish
+        # work spanning all artifacts.
+        remotes = []
+        for value in kwargs.values():
+            for remote in value if isinstance(value, list) else [value]:
+                if isinstance(remote, Remote):
+                    remotes.append(remote)
+        for remote in remotes:
+            remote.prepare(self.artifacts)
+        try:
+            return self._run(
+                processor, type, artifact_name, parallel, **kwargs)
+        finally:
+            for remote in remotes:
+                remote.finalize()
+
+    def _run(self, processor, type, artifact_name, parallel, **kwargs):
         d = defaultdict(list)
         for artifact in self.artifacts:
             if artifact_name is not None and artifact.name != artifact_name:
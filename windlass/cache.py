@@ -0,0 +1,186 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Size bounded caches of files on disk
+
+Entries are files named by a key, usually a digest of what produced
+them, in a directory under the windlass cache directory. Entries are
+written atomically and are never modified, so any number of processes can
+share a cache. Reading an entry updates its mtime, and once the cache grows
+past its maximum size the least recently used entries are removed.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+
+import windlass.tools
+
+MAX_SIZE_ENV = 'WINDLASS_CACHE_MAX_SIZE'
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+DOWNLOADS_MAX_SIZE_ENV = 'WINDLASS_DOWNLOAD_CACHE_MAX_SIZE'
+
+
+def make_key(*parts):
+    """Digest of json serializable parts, to use as a cache key"""
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class DiskCache(object):
+
+    def __init__(self, name, max_size=None, cache_dir=None):
+        self.name = name
+        self.dir = cache_dir or windlass.tools.cache_dir(name)
+        if max_size is None:
+            max_size = int(os.environ.get(MAX_SIZE_ENV, DEFAULT_MAX_SIZE))
+        self.max_size = max_size
+
+    def path(self, key):
+        return os.path.join(self.dir, key)
+
+    def open(self, key):
+        """Open the entry for key for reading, None if not cached"""
+        path = self.path(key)
+        try:
+            fp = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted since, the open file can still be read.
+            pass
+        return fp
+
+    @contextlib.contextmanager
+    def put(self, key):
+        """Write the entry for key to the file object returned
+
+        The entry only becomes visible once complete.
+        """
+        with windlass.tools.atomic_open(self.path(key)) as fp:
+            yield fp
+        self.evict()
+
+    def link(self, key, path):
+        """Hard link or copy the entry for key to path
+
+        Returns False if key isn't cached.
+        """
+        try:
+            windlass.tools.link_or_copy(self.path(key), path)
+        except FileNotFoundError:
+            return False
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def add(self, key, path):
+        """Hard link or copy the file at path into the cache as key"""
+        windlass.tools.link_or_copy(path, self.path(key))
+        self.evict()
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open(os.path.join(self.dir, '.lock'), 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def evict(self):
+        """Remove least recently used entries above the size limit"""
+        with self._lock():
+            entries = []
+            for entry in os.scandir(self.dir):
+                # Skip the lock and partially written entries.
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            size = sum(e[1] for e in entries)
+            for mtime, entry_size, path in sorted(entries):
+                if size <= self.max_size:
+                    break
+                logging.debug('Evicting %s from the %s cache', path,
+                              self.name)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= entry_size
+
+
+class DownloadCache(object):
+    """Downloaded files, shared by every checkout and process
+
+    Files are stored by the hex sha256 of their content, and found either
+    by digest or by the (url, version) they were downloaded from. Files are
+    hard linked in and out of the cache when possible, so they take no
+    extra space, and are verified against their digest when used. The size
+    of the cache is limited by WINDLASS_DOWNLOAD_CACHE_MAX_SIZE, defaulting
+    to WINDLASS_CACHE_MAX_SIZE.
+    """
+
+    def __init__(self, max_size=None, cache_dir=None):
+        if max_size is None and os.environ.get(DOWNLOADS_MAX_SIZE_ENV):
+            max_size = int(os.environ[DOWNLOADS_MAX_SIZE_ENV])
+        self.files = DiskCache('downloads', max_size, cache_dir)
+
+    def _name_key(self, url, version):
+        return 'url-' + make_key(url, version)
+
+    def get(self, path, digest=None, url=None, version=None):
+        """Link the cached file to path, returning False if not cached"""
+        if digest is None and url is not None:
+            fp = self.files.open(self._name_key(url, version))
+            if fp is None:
+                return False
+            with fp:
+                digest = fp.read().decode('ascii')
+        if digest is None or not self.files.link(digest, path):
+            return False
+        # Writing to a linked file in place changes the cached file too.
+        if windlass.tools.sha256sum(path) != digest:
+            logging.warning('Removing modified %s from the download cache',
+                            path)
+            for p in (path, self.files.path(digest)):
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+            return False
+        logging.debug('Found %s in the download cache', path)
+        return True
+
+    def add(self, path, digest, url=None, version=None):
+        """Add the downloaded file at path, of the sha256 digest"""
+        self.files.add(digest, path)
+        if url is not None:
+            with self.files.put(self._name_key(url, version)) as fp:
+                fp.write(digest.encode('ascii'))
@@ -14,20 +14,603 @@
 # under the License.
 #
 
+import concurrent.futures
+import datetime
+import fnmatch
+import gzip
+import hashlib
 import io
+import json
 import logging
+import operator
 import os
+import packaging.version
+import re
 import requests
-import requests.auth
 import ruamel.yaml
-import subprocess
+import shutil
 import tarfile
 import tempfile
+import urllib.parse
 import yaml
 
 import windlass.api
+import windlass.cache
 import windlass.exc
 import windlass.retry
+import windlass.tools
+import windlass.transport
+
+# Size of the chunks charts are streamed in.
+CHUNK_SIZE = 1024 * 1024
+
+# Indexes of large repositories take a while to parse, use libyaml if
+# available.
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class HelmIgnore(object):
+    """Rules of a .helmignore file
+
+    Follows helm: patterns without a slash match the base name of files
+    and directories, others the whole path relative to the chart
+    directory, with each wildcard only matching within a path segment.
+    A trailing slash only matches directories. As in helm, a rule with a
+    leading ! ignores everything it doesn't match, rather than re-including
+    what it matches. Files in templates starting with a dot are always
+    ignored.
+    """
+
+    defaults = ['templates/.?*']
+
+    def __init__(self, lines=()):
+        self.rules = []
+        for line in self.defaults + list(lines):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            must_dir = line.endswith('/')
+            line = line.strip('/')
+            if line:
+                self.rules.append((line, negate, must_dir))
+
+    @classmethod
+    def from_dir(cls, chartdir):
+        try:
+            with open(os.path.join(chartdir, '.helmignore')) as fp:
+                return cls(fp.readlines())
+        except FileNotFoundError:
+            return cls()
+
+    @staticmethod
+    def _match(pattern, path):
+        if '/' not in pattern:
+            return fnmatch.fnmatchcase(os.path.basename(path), pattern)
+        parts = path.split('/')
+        pattern_parts = pattern.split('/')
+        return len(parts) == len(pattern_parts) and all(
+            fnmatch.fnmatchcase(p, pp) for p, pp in zip(parts, pattern_parts))
+
+    def ignored(self, path, is_dir=False):
+        """Whether path, relative to the chart directory, is ignored"""
+        for pattern, negate, must_dir in self.rules:
+            if negate:
+                if must_dir and not is_dir:
+                    return True
+                if not self._match(pattern, path):
+                    return True
+                continue
+            if must_dir and not is_dir:
+                continue
+            if self._match(pattern, path):
+                return True
+        return False
+
+
+def _chart_dependencies(chartdir, chart):
+    deps = list(chart.get('dependencies') or [])
+    try:
+        with open(os.path.join(chartdir, 'requirements.yaml')) as fp:
+            requirements = yaml.load(fp, Loader=yaml.SafeLoader) or {}
+        deps.extend(requirements.get('dependencies') or [])
+    except FileNotFoundError:
+        pass
+    return deps
+
+
+def _check_dependencies(chartdir, chart):
+    """Raise if a dependency of the chart is missing from charts/"""
+    subcharts = os.path.join(chartdir, 'charts')
+    present = os.listdir(subcharts) if os.path.isdir(subcharts) else []
+    for dep in _chart_dependencies(chartdir, chart):
+        name = dep['name']
+        if name in present or any(
+                f.startswith(name + '-') and f.endswith('.tgz')
+                for f in present):
+            continue
+        raise Exception(
+            'Dependency %s of chart %s is missing from %s' % (
+                name, chart['name'], subcharts))
+
+
+def package(chartdir, output_dir='.'):
+    """Package the chart in chartdir, like helm package
+
+    Writes <name>-<version>.tgz to output_dir and returns its path. Files
+    matching .helmignore are left out, and dependencies must already be in
+    the charts directory. The chart is packaged in this process and only
+    writes to output_dir, so charts can be packaged concurrently. The
+    archive only depends on the chart files.
+    """
+    chartdir = os.path.abspath(chartdir)
+    with open(os.path.join(chartdir, 'Chart.yaml')) as fp:
+        chart = yaml.load(fp, Loader=yaml.SafeLoader)
+    for key in ('name', 'version'):
+        if not chart.get(key):
+            raise Exception('%s missing from %s/Chart.yaml' % (key, chartdir))
+    name = chart['name']
+    if os.path.basename(chartdir) != name:
+        raise Exception(
+            'Chart directory %s does not match the chart name %s' % (
+                chartdir, name))
+    _check_dependencies(chartdir, chart)
+
+    ignore = HelmIgnore.from_dir(chartdir)
+    files = []
+    for root, dirs, filenames in os.walk(chartdir, followlinks=True):
+        reldir = os.path.relpath(root, chartdir)
+        reldir = '' if reldir == '.' else reldir + '/'
+        dirs[:] = sorted(
+            d for d in dirs if not ignore.ignored(reldir + d, is_dir=True))
+        files.extend(
+            reldir + f for f in sorted(filenames)
+            if not ignore.ignored(reldir + f))
+    # helm expects Chart.yaml first.
+    files.sort(key=lambda f: (f != 'Chart.yaml', f))
+
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, '%s-%s.tgz' % (name, chart['version']))
+    with windlass.tools.atomic_open(path) as fp, \
+            gzip.GzipFile(filename='', mode='wb', fileobj=fp,
+                          mtime=0) as gz, \
+            tarfile.open(fileobj=gz, mode='w|') as tar:
+        for relpath in files:
+            with open(os.path.join(chartdir, relpath), 'rb') as src:
+                # From the open file, to follow symlinks like helm.
+                member = tar.gettarinfo(
+                    arcname='%s/%s' % (name, relpath), fileobj=src)
+                member.mtime = 0
+                member.uid = member.gid = 0
+                member.uname = member.gname = ''
+                tar.addfile(member, src)
+    return path
+
+
+class ChartIndex(object):
+    """index.yaml of a helm chart repository
+
+    The index is kept on disk between runs, along with its ETag and
+    Last-Modified headers, so that it is only downloaded again when it
+    changed. load() leaves entries as None if the repository has no
+    index, in which case charts have to be looked up one by one.
+    """
+
+    def __init__(self, charts_url, session=None, cache_dir=None):
+        self.charts_url = charts_url
+        self.index_url = os.path.join(charts_url, 'index.yaml')
+        self.session = session or windlass.transport.get_session()
+        cache_dir = cache_dir or windlass.tools.cache_dir('helm-index')
+        key = hashlib.sha256(self.index_url.encode('utf-8')).hexdigest()
+        self.path = os.path.join(cache_dir, key + '.yaml')
+        self.meta_path = os.path.join(cache_dir, key + '.json')
+        self.entries = None
+
+    def _read_cache(self):
+        try:
+            with open(self.meta_path) as fp:
+                meta = json.load(fp)
+            with open(self.path, 'rb') as fp:
+                return meta, fp.read()
+        except (OSError, ValueError):
+            return {}, None
+
+    def _write_cache(self, resp):
+        with windlass.tools.atomic_open(self.path) as fp:
+            fp.write(resp.content)
+        meta = {
+            'url': self.index_url,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+        }
+        with windlass.tools.atomic_open(self.meta_path) as fp:
+            fp.write(json.dumps(meta).encode('utf-8'))
+
+    def load(self):
+        meta, cached = self._read_cache()
+        headers = {}
+        if cached is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            resp = self.session.get(self.index_url, headers=headers)
+        except requests.RequestException as e:
+            logging.debug('Failed to read helm repository index %s: %s',
+                          self.index_url, e)
+            return self
+
+        if resp.status_code == 304:
+            logging.debug('Helm repository index %s unchanged',
+                          self.index_url)
+            data = cached
+        elif resp.status_code == 200:
+            data = resp.content
+            self._write_cache(resp)
+        else:
+            logging.debug('No helm repository index at %s (status: %d)',
+                          self.index_url, resp.status_code)
+            return self
+
+        try:
+            index = yaml.load(data, Loader=YamlLoader)
+        except yaml.YAMLError as e:
+            logging.debug('Failed to parse helm repository index %s: %s',
+                          self.index_url, e)
+            return self
+        self.entries = (index or {}).get('entries') or {}
+        return self
+
+    def get(self, name, version):
+        """Returns the index entry of a chart version, or None"""
+        for entry in (self.entries or {}).get(name) or []:
+            if str(entry.get('version')) == str(version):
+                return entry
+        return None
+
+    def add(self, name, version, url):
+        """Record a chart uploaded during this run"""
+        if self.entries is not None:
+            self.entries.setdefault(name, []).append(
+                {'version': version, 'urls': [url]})
+
+    def url(self, entry):
+        """Absolute URL to download the chart of an entry from"""
+        urls = entry.get('urls')
+        if not urls:
+            return None
+        return urllib.parse.urljoin(self.charts_url.rstrip('/') + '/',
+                                    urls[0])
+
+
+# ChartIndex by charts_url, of this process.
+_indexes = {}
+
+
+def get_index(charts_url, session=None):
+    """Get the index of a chart repository, loaded once per process"""
+    key = (os.getpid(), charts_url)
+    if key not in _indexes:
+        _indexes[key] = ChartIndex(charts_url, session).load()
+    return _indexes[key]
+
+
+def index_entry(fp, url):
+    """Build the helm repository index entry of the chart in file fp
+
+    The entry is the content of Chart.yaml, with the digest of the chart,
+    the time it was created and the URL it is downloaded from.
+    """
+    sha = hashlib.sha256()
+    for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+        sha.update(chunk)
+    fp.seek(0)
+    with tarfile.open(fileobj=fp, mode='r:gz') as tar:
+        for member in tar:
+            parts = member.name.split('/')
+            if len(parts) == 2 and parts[1] == 'Chart.yaml':
+                entry = yaml.load(
+                    tar.extractfile(member), Loader=yaml.SafeLoader)
+                break
+        else:
+            raise Exception('No Chart.yaml in chart %s' % url)
+    fp.seek(0)
+    entry.update({
+        'urls': [url],
+        'created': datetime.datetime.now(
+            datetime.timezone.utc).isoformat(),
+        'digest': sha.hexdigest(),
+    })
+    return entry
+
+
+def _version_key(entry):
+    version = str(entry.get('version'))
+    try:
+        return (1, packaging.version.Version(version), '')
+    except packaging.version.InvalidVersion:
+        return (0, packaging.version.Version('0'), version)
+
+
+def merge_index(index, entries):
+    """Add entries to a helm repository index, replacing the same versions
+
+    index is the parsed index.yaml, or None to start a new one.
+    """
+    index = index or {}
+    index.setdefault('apiVersion', 'v1')
+    all_entries = index.get('entries') or {}
+    index['entries'] = all_entries
+    for entry in entries:
+        versions = [
+            e for e in all_entries.get(entry['name'], [])
+            if str(e.get('version')) != str(entry['version'])]
+        versions.append(entry)
+        # Newest version first, like helm repo index.
+        versions.sort(key=_version_key, reverse=True)
+        all_entries[entry['name']] = versions
+    index['generated'] = datetime.datetime.now(
+        datetime.timezone.utc).isoformat()
+    return index
+
+
+def _constraint_bounds(token):
+    """(operator, version) pairs a helm version constraint token requires"""
+    m = re.match(r'^(>=|<=|!=|>|<|=|~|\^)?v?(.*)$', token)
+    op, version = m.group(1) or '', m.group(2)
+    parts = version.split('.') if version else []
+    # Wildcards, like 1.2.x, become a range.
+    wildcard = next((i for i, p in enumerate(parts)
+                     if p in ('x', 'X', '*')), None)
+    if wildcard is not None:
+        parts = parts[:wildcard]
+    if not parts:
+        return []
+    if wildcard is not None and op in ('', '='):
+        op = '~'
+    lower = packaging.version.Version('.'.join(parts))
+    numbers = [int(p) for p in lower.release]
+
+    def bump(i):
+        return packaging.version.Version(
+            '.'.join(str(n) for n in numbers[:i] + [numbers[i] + 1]))
+
+    if op == '~':
+        # Patch level changes, or minor if only the major is given.
+        return [(operator.ge, lower),
+                (operator.lt, bump(min(1, len(numbers) - 1)))]
+    if op == '^':
+        # Changes not modifying the first non-zero number.
+        first = next((i for i, n in enumerate(numbers) if n), None)
+        if first is None:
+            first = len(numbers) - 1
+        return [(operator.ge, lower), (operator.lt, bump(first))]
+    return [({
+        '': operator.eq, '=': operator.eq, '!=': operator.ne,
+        '>': operator.gt, '>=': operator.ge,
+        '<': operator.lt, '<=': operator.le,
+    }[op], lower)]
+
+
+def version_matches(version, constraint):
+    """Whether version satisfies a helm dependency version constraint
+
+    Supports exact versions, comparisons, x wildcards, ~ and ^ ranges,
+    hyphen ranges and alternatives separated by ||.
+    """
+    try:
+        version = packaging.version.Version(str(version))
+    except packaging.version.InvalidVersion:
+        return False
+    for alternative in str(constraint).split('||'):
+        alternative = re.sub(
+            r'(\S+)\s+-\s+(\S+)', r'>=\1 <=\2', alternative.strip())
+        # Allow spaces between an operator and its version.
+        alternative = re.sub(r'([<>=!~^]+)\s+', r'\1', alternative)
+        bounds = []
+        for token in re.split(r'[\s,]+', alternative):
+            if token:
+                bounds.extend(_constraint_bounds(token))
+        if version.is_prerelease and not any(
+                v.is_prerelease for _, v in bounds):
+            continue
+        if all(op(version, v) for op, v in bounds):
+            return True
+    return False
+
+
+def _fetch_dependency(dep, lock, subcharts):
+    """Place the chart of dependency dep in the subcharts directory"""
+    name, repository = dep['name'], dep.get('repository') or ''
+    if repository.startswith('file://'):
+        chartdir = os.path.join(
+            os.path.dirname(subcharts), repository[len('file://'):])
+        return os.path.basename(package(chartdir, subcharts))
+    index = get_index(repository)
+    if index.entries is None:
+        raise Exception('Failed to read the index of %s' % repository)
+    locked = lock.get(name)
+    if locked and version_matches(locked, dep.get('version', '*')):
+        entry = index.get(name, locked)
+    else:
+        candidates = [
+            e for e in index.entries.get(name) or []
+            if version_matches(e.get('version'), dep.get('version', '*'))]
+        entry = max(candidates, key=_version_key) if candidates else None
+    if entry is None:
+        raise Exception('No version of %s matching %s in %s' % (
+            name, dep.get('version'), repository))
+
+    filename = '%s-%s.tgz' % (name, entry['version'])
+    path = os.path.join(subcharts, filename)
+    digest = entry.get('digest')
+    if os.path.exists(path) and (
+            not digest or windlass.tools.sha256sum(path) == digest):
+        logging.debug('Dependency %s already in %s', filename, subcharts)
+        return filename
+
+    url = index.url(entry)
+    cache = windlass.cache.DiskCache('dependencies')
+    # Content addressed when the index has digests.
+    key = digest or windlass.cache.make_key(url)
+    src = cache.open(key)
+    if src is None:
+        logging.info('Downloading dependency %s from %s', filename, url)
+        resp = windlass.transport.get_session().get(url, stream=True)
+        try:
+            if resp.status_code != 200:
+                raise windlass.exc.RetryableFailure(
+                    'Failed (status: %d) to download %s' % (
+                        resp.status_code, url))
+            sha = hashlib.sha256()
+            with cache.put(key) as fp:
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    sha.update(chunk)
+                    fp.write(chunk)
+                if digest and sha.hexdigest() != digest:
+                    raise windlass.exc.RetryableFailure(
+                        'Checksum mismatch downloading %s' % url)
+        finally:
+            resp.close()
+        src = cache.open(key)
+    with src, windlass.tools.atomic_open(path) as fp:
+        shutil.copyfileobj(src, fp, CHUNK_SIZE)
+    return filename
+
+
+def _vendored_dependency(subcharts, dep, any_version=False):
+    """Filename of the chart of dependency dep in subcharts, or None
+
+    Unless any_version is set, packaged charts must satisfy the version
+    constraint of the dependency.
+    """
+    name = dep['name']
+    try:
+        present = sorted(os.listdir(subcharts))
+    except FileNotFoundError:
+        return None
+    if name in present:
+        # Unpacked, of unknown version.
+        return name
+    for filename in present:
+        version = filename[len(name) + 1:-len('.tgz')]
+        if filename.startswith(name + '-') and filename.endswith('.tgz') \
+                and version[:1].isdigit() and (
+                    any_version or
+                    version_matches(version, dep.get('version', '*'))):
+            return filename
+    return None
+
+
+def _update_dependency(dep, lock, subcharts):
+    """Filename of the chart of dep in subcharts, and whether it's new"""
+    name, repository = dep['name'], dep.get('repository') or ''
+    if repository.startswith('file://'):
+        # Local charts are packaged again, to pick up changes.
+        return _fetch_dependency(dep, lock, subcharts), True
+    vendored = _vendored_dependency(subcharts, dep)
+    if vendored:
+        logging.debug('Dependency %s already in %s', vendored, subcharts)
+        return vendored, False
+    if not repository.startswith(('http://', 'https://')):
+        # Like helm package, the chart must have been put in charts/.
+        logging.warning(
+            'Not fetching dependency %s from repository %s, only '
+            'repository URLs are supported', name, repository)
+        return None, False
+    try:
+        return _fetch_dependency(dep, lock, subcharts), True
+    except Exception as e:
+        vendored = _vendored_dependency(subcharts, dep, any_version=True)
+        if not vendored:
+            raise
+        logging.warning('Using %s, failed to update dependency %s: %s',
+                        vendored, name, e)
+        return vendored, False
+
+
+def update_dependencies(chartdir, max_workers=8):
+    """Vendor the dependencies of the chart in chartdir into charts/
+
+    Charts already in charts/ are used as they are when they satisfy the
+    version constraint of their dependency, or when a newer version can't
+    be fetched. Other versions are resolved like helm dependency update,
+    against the index of the repository of each dependency, preferring the
+    versions of Chart.lock or requirements.lock while they satisfy the
+    constraints. Charts are downloaded concurrently through a content
+    addressed cache shared by all builds, and older versions of the
+    dependencies fetched are removed from charts/. Dependencies on
+    repositories named by alias, rather than URL, aren't fetched.
+    """
+    deps = get_metadata(chartdir)['dependencies']
+    if not deps:
+        return []
+
+    lock = {}
+    for lockfile in ('Chart.lock', 'requirements.lock'):
+        try:
+            with open(os.path.join(chartdir, lockfile)) as fp:
+                data = yaml.load(fp, Loader=yaml.SafeLoader) or {}
+        except FileNotFoundError:
+            continue
+        lock.update((d['name'], d['version'])
+                    for d in data.get('dependencies') or [])
+
+    subcharts = os.path.join(chartdir, 'charts')
+    os.makedirs(subcharts, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        results = list(pool.map(
+            lambda dep: _update_dependency(dep, lock, subcharts), deps))
+    filenames = [filename for filename, new in results if filename]
+
+    for dep, (fetched, new) in zip(deps, results):
+        if not new:
+            continue
+        for filename in os.listdir(subcharts):
+            rest = filename[len(dep['name']) + 1:]
+            if filename.startswith(dep['name'] + '-') and \
+                    filename.endswith('.tgz') and rest[:1].isdigit() and \
+                    filename not in filenames:
+                logging.info('Removing old dependency %s', filename)
+                os.remove(os.path.join(subcharts, filename))
+    return filenames
+
+
+# Chart metadata by chart directory, of this process.
+_metadata = {}
+
+
+def get_metadata(chartdir):
+    """Metadata of the chart in chartdir
+
+    Returns a dict with the chart dir, name, version and dependencies.
+    Chart.yaml and requirements.yaml are only parsed again when they are
+    modified.
+    """
+    stamp = []
+    for filename in ('Chart.yaml', 'requirements.yaml'):
+        try:
+            st = os.stat(os.path.join(chartdir, filename))
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            stamp.append(None)
+    cached = _metadata.get(chartdir)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    with open(os.path.join(chartdir, 'Chart.yaml')) as fp:
+        chart = yaml.load(fp, Loader=yaml.SafeLoader)
+    metadata = {
+        'dir': chartdir,
+        'name': chart['name'],
+        'version': chart['version'],
+        'dependencies': _chart_dependencies(chartdir, chart),
+    }
+    _metadata[chartdir] = (stamp, metadata)
+    return metadata
 
 
 @windlass.api.register_type('charts')
@@ -50,31 +633,40 @@ class Chart(windlass.api.Artifact):
             self.name, self.version
         )
 
+    def load_metadata(self):
+        chartdir = self.get_chart_dir()
+        if os.path.exists(os.path.join(chartdir, 'Chart.yaml')):
+            get_metadata(chartdir)
+
     def get_chart_dir(self):
         # The directory containing the chart must match the name of the chart.
-        repopath = os.path.abspath('.')
-        return os.path.join(repopath, self.data.get('location', ''), self.name)
+        # Charts from other repositories are found in their checkout, others
+        # in the working directory.
+        location = os.path.join(self.data.get('location', ''), self.name)
+        repopath = self.metadata.get('repopath')
+        if repopath and os.path.isdir(os.path.join(repopath, location)):
+            return os.path.join(repopath, location)
+        return os.path.join(os.path.abspath('.'), location)
 
     def get_chart_name(self, version):
         return '%s-%s.tgz' % (self.name, version)
 
     def get_local_version(self):
-        chartdir = self.get_chart_dir()
-        with open(os.path.join(chartdir, 'Chart.yaml')) as fp:
-            chart = yaml.load(fp, Loader=yaml.SafeLoader)
-
-        return chart['version']
+        return get_metadata(self.get_chart_dir())['version']
 
     def build(self):
         "Builds local chart with developer specified version"
         chartdir = self.get_chart_dir()
         logging.info('Building %s in %s' % (self.name, chartdir))
 
-        # Can use --version here also
-        cmd = ['helm', 'package', chartdir]
-
-        if subprocess.call(cmd) != 0:
-            raise Exception('Failed to build chart: %s' % self.name)
+        try:
+            update_dependencies(chartdir)
+            # Upload and export find the package in the working directory.
+            path = package(chartdir)
+        except Exception as e:
+            raise Exception(
+                'Failed to build chart %s: %s' % (self.name, e)) from e
+        logging.info('%s: Packaged chart to %s' % (self.name, path))
 
     @windlass.retry.simple()
     @windlass.api.fall_back('charts_url')
@@ -87,20 +679,55 @@ class Chart(windlass.api.Artifact):
             raise Exception(
                 'charts_url is not specified. Unable to download charts')
 
-        chart_url = self.url(version or self.version, charts_url)
-        resp = requests.get(
-            chart_url,
-            verify='/etc/ssl/certs')
-        if resp.status_code != 200:
-            raise windlass.exc.RetryableFailure(
-                'Failed to download chart %s' % chart_url)
-
+        version = version or self.version
         # Save the chart with the version and don't try and package
         # the chart as a usable chart under the local version.
         # The package_chart can't take a chart and package it under
         # the development version, like we do with images.
-        with open(os.path.basename(chart_url), 'wb') as fp:
-            fp.write(resp.content)
+        chart_file = self.get_chart_name(version)
+
+        index = get_index(charts_url)
+        entry = index.get(self.name, version)
+        if entry:
+            chart_url = index.url(entry) or self.url(version, charts_url)
+            digest = entry.get('digest')
+        else:
+            if index.entries is not None:
+                logging.debug('%s: version %s not in the index of %s',
+                              self.name, version, charts_url)
+            chart_url = self.url(version, charts_url)
+            digest = None
+        if digest and os.path.exists(chart_file) and \
+                windlass.tools.sha256sum(chart_file) == digest:
+            logging.info('%s: %s already downloaded' % (
+                self.name, chart_file))
+            return
+        cache = windlass.cache.DownloadCache()
+        if cache.get(chart_file, digest, chart_url, version):
+            logging.info('%s: %s found in the download cache' % (
+                self.name, chart_file))
+            return
+
+        resp = windlass.transport.get_session().get(chart_url, stream=True)
+        try:
+            if resp.status_code != 200:
+                raise windlass.exc.RetryableFailure(
+                    'Failed to download chart %s' % chart_url)
+
+            # Write to a temporary file first, so that failed or
+            # concurrent downloads never leave a truncated chart behind.
+            sha = hashlib.sha256()
+            with windlass.tools.atomic_open(chart_file) as fp:
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    sha.update(chunk)
+                    fp.write(chunk)
+                if digest and sha.hexdigest() != digest:
+                    raise windlass.exc.RetryableFailure(
+                        'Checksum mismatch downloading chart %s: expected '
+                        '%s, got %s' % (chart_url, digest, sha.hexdigest()))
+        finally:
+            resp.close()
+        cache.add(chart_file, sha.hexdigest(), chart_url, version)
 
         # We can't save the chart under the version specified
         # in the original Chart.yaml. The reason being that we
@@ -118,75 +745,110 @@ class Chart(windlass.api.Artifact):
 
         return chart_name
 
-    def _package_chart(self, tarfile, version=None, **kwargs):
+    def _expand_values(self, values_data, values_file, version, **kwargs):
+        values = self.data.get('values', None)
+        if not values:
+            return
+        # TODO(kerrin) expand the amount of data available
+        # for users to control
+        data = {
+            'version': version,
+            'name': self.name,
+        }
+        data.update(kwargs)
+
+        def expand_values(source, expanded):
+            for key, value in source.items():
+                if isinstance(value, dict):
+                    try:
+                        expand_values(value, expanded[key])
+                    except KeyError as e:
+                        raise windlass.exc.MissingEntryInChartValues(
+                            expected_source=source,
+                            missing_key=e.args[0],
+                            values_filename=values_file,
+                            chart_name=self.name
+                        )
+                else:
+                    newvalue = value.format(**data)
+                    expanded[key] = newvalue
+        # Update by reference the values_data dictionary based on
+        # the format of the supplied values field.
+        expand_values(values, values_data)
+
+    def _package_chart(self, src, out, version=None, **kwargs):
         '''Internal Helper
 
-        Internal method to make it easier to hanle closing
-        the tarfile passed here automatically on exit.
+        Copy the chart read from the tarfile src, opened as a stream, to
+        the tarfile out, rewriting Chart.yaml and values.yaml on the way.
         '''
-        def get_data(filename):
-            membername = os.path.join(self.name, filename)
-            yaml = tarfile.extractfile(membername)
-            return membername, ruamel.yaml.load(
-                yaml, Loader=ruamel.yaml.RoundTripLoader)
+        chart_file = os.path.join(self.name, 'Chart.yaml')
+        values_file = os.path.join(self.name, 'values.yaml')
+
+        def rewrite(member, data):
+            # Override the size of the file
+            datastr = ruamel.yaml.dump(
+                data, Dumper=ruamel.yaml.RoundTripDumper)
+            databytes = datastr.encode('utf-8')
+            member.size = len(databytes)
+            out.addfile(member, io.BytesIO(databytes))
+
+        for member in src:
+            if member.name not in (chart_file, values_file):
+                out.addfile(member, src.extractfile(member))
+                continue
+            data = ruamel.yaml.load(
+                src.extractfile(member), Loader=ruamel.yaml.RoundTripLoader)
+            if member.name == chart_file:
+                data['version'] = version
+            else:
+                self._expand_values(data, values_file, version, **kwargs)
+            rewrite(member, data)
+
+    def write_chart(self, fp, local_version, version=None, **kwargs):
+        '''Package chart to a file object
+
+        Streams the chart with a different version, and all the values
+        specified in the configuration file applied, to fp. Only fp.write
+        is used, so fp can be a file, a socket or a pipe. The output only
+        depends on the source chart and arguments, the gzip header has no
+        timestamp nor file name.
+        '''
+        local_chart_name = self.get_chart_name(local_version)
 
-        chart_file, chart_data = get_data('Chart.yaml')
-        chart_data['version'] = version
+        with tarfile.open(local_chart_name, 'r|gz') as src, \
+                gzip.GzipFile(filename='', mode='wb', fileobj=fp,
+                              mtime=0) as gz, \
+                tarfile.open(fileobj=gz, mode='w|') as out:
+            self._package_chart(src, out, version, **kwargs)
 
-        values_file, values_data = get_data('values.yaml')
-        values = self.data.get('values', None)
-        if values:
-            # TODO(kerrin) expand the amount of data available
-            # for users to control
-            data = {
-                'version': version,
-                'name': self.name,
-            }
-            data.update(kwargs)
-
-            def expand_values(source, expanded):
-                for key, value in source.items():
-                    if isinstance(value, dict):
-                        try:
-                            expand_values(value, expanded[key])
-                        except KeyError as e:
-                            raise windlass.exc.MissingEntryInChartValues(
-                                expected_source=source,
-                                missing_key=e.args[0],
-                                values_filename=values_file,
-                                chart_name=self.name
-                            )
-                    else:
-                        newvalue = value.format(**data)
-                        expanded[key] = newvalue
-            # Update by reference the values_data dictionary based on
-            # the format of the supplied values field.
-            expand_values(values, values_data)
-
-        with tempfile.NamedTemporaryFile() as tmp_file:
-            with tarfile.open(tmp_file.name, 'w:gz') as out:
-                for member in tarfile.getmembers():
-                    if member.name == chart_file:
-                        # Override the size of the file
-                        datastr = ruamel.yaml.dump(
-                            chart_data,
-                            Dumper=ruamel.yaml.RoundTripDumper)
-                        databytes = datastr.encode('utf-8')
-                        member.size = len(databytes)
-                        out.addfile(member, io.BytesIO(databytes))
-                    elif member.name == values_file:
-                        # Override the size of the file
-                        datastr = ruamel.yaml.dump(
-                            values_data,
-                            Dumper=ruamel.yaml.RoundTripDumper)
-                        databytes = datastr.encode('utf-8')
-                        member.size = len(databytes)
-                        out.addfile(member, io.BytesIO(databytes))
-                    else:
-                        out.addfile(member, tarfile.extractfile(member.name))
-
-            with open(tmp_file.name, 'rb') as fp:
-                return fp.read()
+    def _open_packaged(self, local_version, version=None, **kwargs):
+        '''Open the chart repackaged as version for reading
+
+        Repackaged charts are cached by the digest of the source chart,
+        the version and the values substituted, so that the same chart
+        is only repackaged once for upload, export and update_version.
+        '''
+        local_chart_name = self.get_chart_name(local_version)
+        key = windlass.cache.make_key(
+            windlass.tools.sha256sum(local_chart_name), self.name, version,
+            self.data.get('values'), kwargs)
+        cache = windlass.cache.DiskCache('charts')
+        fp = cache.open(key)
+        if fp is not None:
+            logging.debug('%s: Using cached %s repackaged as %s',
+                          self.name, local_chart_name, version)
+            return fp
+
+        with cache.put(key) as out:
+            self.write_chart(out, local_version, version, **kwargs)
+        fp = cache.open(key)
+        if fp is None:
+            # Larger than the whole cache, keep it in a temporary file.
+            fp = tempfile.TemporaryFile()
+            self.write_chart(fp, local_version, version, **kwargs)
+            fp.seek(0)
+        return fp
 
     def package_chart(self, local_version, version=None, **kwargs):
         '''Package chart
@@ -195,10 +857,18 @@ class Chart(windlass.api.Artifact):
         of a chart with, different version, and apply all the values
         specified in the configuration file.
         '''
-        local_chart_name = self.get_chart_name(local_version)
+        with self._open_packaged(local_version, version, **kwargs) as fp:
+            return fp.read()
 
-        with tarfile.open(local_chart_name, 'r:gz') as tfile:
-            return self._package_chart(tfile, version, **kwargs)
+    def open_chart(self, local_version, version=None, **kwargs):
+        '''Open the chart as version for reading
+
+        This is the local chart file if the version doesn't change,
+        otherwise the repackaged chart.
+        '''
+        if version is None or version == local_version:
+            return open(self.get_chart_name(local_version), 'rb')
+        return self._open_packaged(local_version, version, **kwargs)
 
     def update_version(self, version):
         """Update the chart version, re-packing if the version changes.
@@ -212,8 +882,9 @@ class Chart(windlass.api.Artifact):
             )
             return
         new_chart_file = self.get_chart_name(version)
-        with open(new_chart_file, 'wb') as f:
-            f.write(self.package_chart(local_version, version))
+        with self.open_chart(local_version, version) as src, \
+                windlass.tools.atomic_open(new_chart_file) as f:
+            shutil.copyfileobj(src, f, CHUNK_SIZE)
         return self.set_version(version)
 
     @windlass.retry.simple()
@@ -268,35 +939,37 @@ class Chart(windlass.api.Artifact):
                 local_chart_name, upload_version
             )
 
-        # Specified version is different to that on the filesystem. So
-        # we need to package the chart with the new version and
-        # any updated values.
-        if upload_version != local_version:
-            data = self.package_chart(
-                local_version, upload_version,
-                registry=docker_image_registry)
-        else:  # No version deploy the local development version
-            data = open(local_chart_name, 'rb').read()
-
-        logging.info('%s: Pushing chart as %s' % (
-            self.name, upload_chart_url))
-
+        session = windlass.transport.get_session(
+            docker_user, docker_password)
+        index = get_index(charts_url, session)
         if not kwargs.get('allow_clobber'):
-            status_resp = requests.head(upload_chart_url,
-                                        verify='/etc/ssl/certs')
-            if status_resp.status_code == 200:
+            if index.entries is not None:
+                exists = index.get(self.name, upload_version) is not None
+            else:
+                # No index to look in, ask for the chart itself.
+                exists = session.head(upload_chart_url).status_code == 200
+            if exists:
                 # Chart already exists so don't try and upload it again
                 logging.info('%s: Chart already exists at %s' % (
                     self.name, upload_chart_url))
                 return
 
+        logging.info('%s: Pushing chart as %s' % (
+            self.name, upload_chart_url))
+
         # Artifact does not exist or we allow clobber, push it up.
-        auth = requests.auth.HTTPBasicAuth(docker_user, docker_password)
-        resp = requests.put(
-            upload_chart_url,
-            data=data,
-            auth=auth,
-            verify='/etc/ssl/certs')
+        # Specified version is different to that on the filesystem. So
+        # we need to package the chart with the new version and
+        # any updated values.
+        with self.open_chart(local_version, upload_version,
+                             registry=docker_image_registry) as data:
+            headers = windlass.transport.checksum_headers(data)
+            if windlass.transport.checksum_deploy(
+                    session, upload_chart_url, headers):
+                index.add(self.name, upload_version, upload_chart_url)
+                logging.info('%s: Successfully pushed chart' % self.name)
+                return
+            resp = session.put(upload_chart_url, data=data, headers=headers)
         if resp.status_code in (
                 requests.codes.unauthorized, requests.codes.forbidden):
             # No retries in this case.
@@ -307,6 +980,7 @@ class Chart(windlass.api.Artifact):
                 'Failed (status: %d) to upload %s' % (
                     resp.status_code, upload_chart_url))
 
+        index.add(self.name, upload_version, upload_chart_url)
         logging.info('%s: Successfully pushed chart' % self.name)
 
     @windlass.api.fall_back('charts_url')
@@ -321,12 +995,7 @@ class Chart(windlass.api.Artifact):
         local_version = self.version or self.get_local_version()
         stream_version = version or self.version or local_version
 
-        if stream_version == local_version:
-            local_chart_name = self.get_chart_name(local_version)
-            return open(local_chart_name, 'rb')
-        else:
-            cdata = self.package_chart(local_version, stream_version)
-            return io.BytesIO(cdata)
+        return self.open_chart(local_version, stream_version)
 
     def export(self, export_dir='.', export_name=None, version=None):
         local_version = self.version or self.get_local_version()
@@ -342,6 +1011,7 @@ class Chart(windlass.api.Artifact):
         # Don't write if the exported chart would be the same as locally saved
         # chart.
         if os.path.abspath(export_path) != os.path.abspath(local_chart_name):
-            with open(export_path, 'wb') as f:
-                f.write(self.export_stream(export_version).read())
+            with self.open_chart(local_version, export_version) as src, \
+                    windlass.tools.atomic_open(export_path) as f:
+                shutil.copyfileobj(src, f, CHUNK_SIZE)
         return export_path
@@ -0,0 +1,154 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Parallel streaming compression of exported artifacts
+
+The stream is cut into blocks which are compressed independently on a
+thread pool, like pigz does. Each block becomes a gzip member, an xz stream
+or a zstd frame, and for all three formats the concatenation of these is a
+valid compressed file that standard tools decompress in one go. zlib, lzma
+and zstandard release the GIL while compressing, so blocks are compressed
+in parallel while the next blocks are still being read from the source.
+
+zstd needs the optional zstandard package.
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import lzma
+import os
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def _gzip(level):
+    level = 6 if level is None else level
+    return lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _xz(level):
+    level = 6 if level is None else level
+    return lambda data: lzma.compress(data, preset=level)
+
+
+def _zstd(level):
+    if zstandard is None:
+        raise ValueError(
+            'zstd compression requires the zstandard python package')
+    level = 3 if level is None else level
+    # ZstdCompressor objects can't be shared between threads.
+    return lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+
+
+# codec name: (file extension, compressor factory taking a level)
+CODECS = {
+    'gzip': ('.gz', _gzip),
+    'xz': ('.xz', _xz),
+    'zstd': ('.zst', _zstd),
+}
+
+
+def get_extension(codec):
+    if codec is None:
+        return ''
+    return CODECS[codec][0]
+
+
+class CompressionStats(object):
+    """Sizes and timing of a compressed stream"""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.uncompressed = 0
+        self.compressed = 0
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    def __str__(self):
+        ratio = self.compressed * 100.0 / (self.uncompressed or 1)
+        throughput = self.uncompressed / (self.duration or 1e-9) / 2 ** 20
+        return (
+            '%d bytes compressed with %s to %d bytes (%.1f%%) in %.1fs, '
+            '%.1f MiB/s' % (
+                self.uncompressed, self.codec, self.compressed, ratio,
+                self.duration, throughput))
+
+
+def _blocks(stream, chunk_size):
+    """Regroup an iterable of byte strings into chunk_size blocks"""
+    buf = bytearray()
+    for data in stream:
+        buf += data
+        while len(buf) >= chunk_size:
+            yield bytes(buf[:chunk_size])
+            del buf[:chunk_size]
+    if buf:
+        yield bytes(buf)
+
+
+def compress_stream(stream, codec, chunk_size=None, threads=None,
+                    level=None, stats=None):
+    """Compress an iterable of byte strings, yielding compressed data
+
+    stream is closed, if it has a close method, when done. Pass a
+    CompressionStats object as stats to collect sizes and timing.
+    """
+    if codec not in CODECS:
+        raise ValueError('Unknown compression %s, expected one of: %s' % (
+            codec, ', '.join(sorted(CODECS))))
+    compress = CODECS[codec][1](level)
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    threads = threads or os.cpu_count() or 1
+
+    pool = concurrent.futures.ThreadPoolExecutor(threads)
+    pending = collections.deque()
+    try:
+        for block in _blocks(stream, chunk_size):
+            if stats:
+                stats.uncompressed += len(block)
+            pending.append(pool.submit(compress, block))
+            # Bound the blocks held in memory, while keeping every
+            # thread busy.
+            while len(pending) > threads * 2:
+                data = pending.popleft().result()
+                if stats:
+                    stats.compressed += len(data)
+                yield data
+        while pending:
+            data = pending.popleft().result()
+            if stats:
+                stats.compressed += len(data)
+            yield data
+        if stats:
+            stats.finished = time.time()
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+        if hasattr(stream, 'close'):
+            stream.close()
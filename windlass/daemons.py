@@ -0,0 +1,216 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Spread docker work across several docker daemons
+
+By default all docker operations go to the daemon configured in the
+environment (DOCKER_HOST). Setting WINDLASS_DOCKER_HOSTS to a comma
+separated list of docker endpoints, or passing --docker-host to windlass,
+turns these into a build farm: each build or pull is placed on the daemon
+with the fewest windlass jobs running, and operations on an existing image
+(tag, push, export) go to the daemon holding it.
+
+Jobs are counted in a flock-guarded state file, so that all windlass
+processes on the host share the view of how loaded each daemon is. Jobs of
+processes that died are discarded when the state is read.
+"""
+
+import fcntl
+import json
+import logging
+import os
+
+import docker
+
+import windlass.tools
+
+DOCKER_HOSTS_ENV = 'WINDLASS_DOCKER_HOSTS'
+
+
+def get_endpoints():
+    """List of docker endpoints to use
+
+    [None] means the single daemon configured in the environment.
+    """
+    hosts = os.environ.get(DOCKER_HOSTS_ENV, '')
+    endpoints = [h.strip() for h in hosts.split(',') if h.strip()]
+    return endpoints or [None]
+
+
+def get_client(endpoint=None, timeout=180):
+    if endpoint is None:
+        return docker.from_env(version='auto', timeout=timeout)
+    # Use the TLS settings from the environment for all endpoints.
+    kwargs = docker.utils.kwargs_from_env()
+    kwargs['base_url'] = endpoint
+    return docker.DockerClient(version='auto', timeout=timeout, **kwargs)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobCounter(object):
+    """Number of running windlass jobs per docker endpoint
+
+    State is a json file mapping endpoint to {pid: number of jobs}.
+    """
+
+    def __init__(self, state_dir=None):
+        state_dir = state_dir or windlass.tools.cache_dir('daemons')
+        self.path = os.path.join(state_dir, 'jobs.json')
+
+    def _update(self, func):
+        with open(self.path, 'a+') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                fp.seek(0)
+                try:
+                    state = json.loads(fp.read())
+                except ValueError:
+                    state = {}
+                for jobs in state.values():
+                    for pid in list(jobs):
+                        if not _pid_alive(int(pid)):
+                            del jobs[pid]
+                result = func(state)
+                fp.seek(0)
+                fp.truncate()
+                fp.write(json.dumps(state))
+                return result
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def start(self, endpoints):
+        """Pick the least loaded of endpoints and count a job on it"""
+        def start(state):
+            def load(endpoint):
+                return sum(state.get(endpoint, {}).values())
+            # min() keeps the first on ties, so follow the configured order.
+            endpoint = min(endpoints, key=load)
+            jobs = state.setdefault(endpoint, {})
+            pid = str(os.getpid())
+            jobs[pid] = jobs.get(pid, 0) + 1
+            return endpoint
+        return self._update(start)
+
+    def finish(self, endpoint):
+        def finish(state):
+            jobs = state.get(endpoint, {})
+            pid = str(os.getpid())
+            jobs[pid] = jobs.get(pid, 1) - 1
+            if jobs[pid] <= 0:
+                del jobs[pid]
+        self._update(finish)
+
+
+def acquire(endpoint=None, timeout=180):
+    """Get a client to run a job on a docker daemon
+
+    With no endpoint specified the least loaded daemon is used. The client
+    must be returned with release() once the job is done.
+    """
+    endpoints = get_endpoints()
+    if len(endpoints) == 1:
+        # Nothing to balance.
+        return get_client(endpoints[0], timeout)
+
+    endpoint = JobCounter().start([endpoint] if endpoint else endpoints)
+    logging.debug('Running docker job on %s', endpoint)
+    try:
+        client = get_client(endpoint, timeout)
+    except Exception:
+        JobCounter().finish(endpoint)
+        raise
+    client.windlass_endpoint = endpoint
+    return client
+
+
+def release(client):
+    client.close()
+    endpoint = getattr(client, 'windlass_endpoint', None)
+    if endpoint is not None:
+        JobCounter().finish(endpoint)
+
+
+def locate_image(name):
+    """Returns the endpoint of a daemon holding image name, or None"""
+    endpoints = get_endpoints()
+    if len(endpoints) == 1:
+        return endpoints[0]
+    for endpoint in endpoints:
+        client = get_client(endpoint)
+        try:
+            client.images.get(name)
+            return endpoint
+        except docker.errors.ImageNotFound:
+            continue
+        finally:
+            client.close()
+    return None
+
+
+def acquire_for_image(name, timeout=180):
+    """Get a client for the daemon holding image name
+
+    If no daemon has the image yet, the least loaded one is used. The
+    client must be returned with release().
+    """
+    return acquire(locate_image(name), timeout)
+
+
+def transfer_image(name, source, dest_client):
+    """Copy image name from the source endpoint to the daemon of dest_client
+
+    Streams docker save from the source straight into docker load.
+    """
+    logging.info('Copying image %s from %s to %s', name, source,
+                 dest_client.api.base_url)
+    source_client = get_client(source)
+    try:
+        stream = source_client.api.get_image(name)
+        try:
+            dest_client.api.load_image(stream)
+        finally:
+            stream.close()
+    finally:
+        source_client.close()
+
+
+def ensure_image(name, client):
+    """Make image name available on the daemon of client
+
+    Used for images built or pulled by windlass on another daemon, e.g.
+    base images of a later build. Images found on no daemon are left for
+    docker to pull.
+    """
+    if len(get_endpoints()) == 1:
+        return
+    try:
+        client.images.get(name)
+        return
+    except docker.errors.ImageNotFound:
+        pass
+    source = locate_image(name)
+    if source is not None:
+        transfer_image(name, source, client)
@@ -84,25 +84,29 @@ class FailedRetriesException(WindlassException):
 
 
 class WindlassBuildException(WindlassExternalException):
-    "Exception to catch failures to build artifacts"
+    """Exception to catch failures to build artifacts
+
+    out only contains the tail of the build output, the full output is
+    in the file at log_path.
+    """
+    def __init__(self, *args, **kwargs):
+        self.log_path = kwargs.pop('log_path', None)
+        super().__init__(*args, **kwargs)
 
     def debug_message(self):
         'Returns a long debug output.'
-        msg = '%s: Build failed with output:\n' % self.artifact_name
-        for line in self.out:
-            msg += '%s: %s\n' % (
-                self.artifact_name,
-                line)
+        name = self.artifact_name
+        lines = ['%s: Build failed with output:' % name]
+        lines.extend('%s: %s' % (name, line) for line in self.out)
         if self.errors:
-            msg += '%s: Error output:\n' % self.artifact_name
-            for line in self.errors:
-                msg += '%s: %s\n' % (
-                    self.artifact_name,
-                    line)
-        msg += '%s: Arguments passed to docker:\n' % self.artifact_name
-        for k, v in self.debug_data.items():
-            msg += '%s: %s=%s\n' % (self.artifact_name, k, v)
-        return msg
+            lines.append('%s: Error output:' % name)
+            lines.extend('%s: %s' % (name, line) for line in self.errors)
+        lines.append('%s: Arguments passed to docker:' % name)
+        lines.extend(
+            '%s: %s=%s' % (name, k, v) for k, v in self.debug_data.items())
+        if self.log_path:
+            lines.append('%s: Full build log: %s' % (name, self.log_path))
+        return '\n'.join(lines) + '\n'
 
 
 class WindlassPushPullException(RetryableFailure):
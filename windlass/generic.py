@@ -14,20 +14,434 @@
 # under the License.
 #
 
+import concurrent.futures
 import fnmatch
 import glob
+import hashlib
+import io
+import json
 import logging
 import os
+import shutil
+import stat
+import struct
+import tarfile
+import tempfile
+import zipfile
+import zlib
 
 import requests
 
 import windlass.api
+import windlass.cache
+import windlass.tools
+import windlass.transport
+
+CHUNK_SIZE = 1024 * 1024
+# The earliest time of zip members, given to all of them.
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+# Times a download unpacked as it's streamed is resumed.
+RESUME_ATTEMPTS = 3
 
 
 class LocalArtifactCopyMissing(Exception):
     pass
 
 
+class PropertySearch(object):
+    """Artifacts of an Artifactory repository with a version property
+
+    A single property search finds every artifact of the version in the
+    repository, and its results are indexed by filename. The download URIs
+    are then fetched from the storage API only for the artifacts matching,
+    concurrently, and are remembered for later lookups.
+    """
+
+    def __init__(self, generic_url, version, session=None, max_workers=8):
+        safe_url = generic_url.rstrip('/')
+        self.repo = safe_url[safe_url.rfind('/') + 1:]
+        self.api = safe_url[:safe_url.rfind('/')] + '/api/search/prop'
+        self.version = version
+        self.session = session or windlass.transport.get_session()
+        self.max_workers = max_workers
+        self.uris = None
+        self.download_uris = {}
+
+    def load(self):
+        params = {'version': self.version, 'repos': self.repo}
+        results = self.session.get(self.api, params=params).json()['results']
+        # Filenames to the storage URIs of the artifacts, in result order.
+        self.uris = {}
+        for item in results:
+            filename = item['uri'].split('/')[-1]
+            self.uris.setdefault(filename, []).append(item['uri'])
+        return self
+
+    def _download_uri(self, uri):
+        return self.session.get(uri).json()['downloadUri']
+
+    def find(self, pattern):
+        """Download URIs of the artifacts with a filename matching pattern"""
+        uris = []
+        for filename in fnmatch.filter(self.uris, pattern):
+            uris.extend(self.uris[filename])
+        missing = [uri for uri in uris if uri not in self.download_uris]
+        if len(missing) > 1:
+            with concurrent.futures.ThreadPoolExecutor(
+                    min(self.max_workers, len(missing))) as pool:
+                self.download_uris.update(
+                    zip(missing, pool.map(self._download_uri, missing)))
+        else:
+            for uri in missing:
+                self.download_uris[uri] = self._download_uri(uri)
+        return [self.download_uris[uri] for uri in uris]
+
+
+# PropertySearch by generic_url and version, of this process.
+_searches = {}
+
+
+def get_search(generic_url, version, session=None):
+    """Search the artifacts of a version, once per process"""
+    key = (os.getpid(), generic_url.rstrip('/'), version)
+    if key not in _searches:
+        _searches[key] = PropertySearch(generic_url, version, session).load()
+    return _searches[key]
+
+
+# Archive formats of generics made of several files, by extension.
+ARCHIVE_FORMATS = {
+    '.tar': 'tar',
+    '.tar.gz': 'tar.gz',
+    '.tgz': 'tar.gz',
+    '.zip': 'zip',
+}
+
+
+def archive_format(filename):
+    for ext, fmt in ARCHIVE_FORMATS.items():
+        if filename.endswith(ext):
+            return fmt
+    raise Exception(
+        'Unknown archive format of %s, expected one of %s' % (
+            filename, ', '.join(sorted(ARCHIVE_FORMATS))))
+
+
+class IterReader(object):
+    """Read-only file object of the bytes yielded by an iterable"""
+
+    def __init__(self, iterable):
+        self._iter = iter(iterable)
+        self._buffer = bytearray()
+        self._pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._iter)
+            except StopIteration:
+                break
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._pos += len(data)
+        return data
+
+    def unread(self, data):
+        """Put data back, to be read again next"""
+        self._buffer[:0] = data
+        self._pos -= len(data)
+
+    def close(self):
+        close = getattr(self._iter, 'close', None)
+        if close:
+            close()
+
+
+class _Sink(object):
+    """Collects what's written, for writers which can't be read from"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self.data)
+        self.data.clear()
+        return data
+
+
+def _archive_mode(st):
+    """Mode of a file in an archive, as git would check it out
+
+    Like the mtime, the rest of the mode depends on the checkout, and is
+    left out so that archives of the same files are the same.
+    """
+    if st.st_mode & stat.S_IXUSR:
+        return 0o755
+    return 0o644
+
+
+def _tar_chunks(paths, compress):
+    """Tar archive of the files at paths, in chunks"""
+    compressor = zlib.compressobj(
+        6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+
+    def out(data):
+        return compressor.compress(data) if compressor else data
+
+    for path in paths:
+        st = os.stat(path)
+        info = tarfile.TarInfo(path)
+        info.size = st.st_size
+        info.mtime = 0
+        info.mode = _archive_mode(st)
+        yield out(info.tobuf(tarfile.PAX_FORMAT))
+        with open(path, 'rb') as fp:
+            remaining = info.size
+            while remaining:
+                chunk = fp.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise Exception('%s changed while archived' % path)
+                remaining -= len(chunk)
+                yield out(chunk)
+        padding = -info.size % tarfile.BLOCKSIZE
+        if padding:
+            yield out(tarfile.NUL * padding)
+    yield out(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+    if compressor:
+        yield compressor.flush()
+
+
+def _zip_chunks(paths):
+    """Zip archive of the files at paths, in chunks"""
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w') as zf:
+        for path in paths:
+            info = zipfile.ZipInfo.from_file(path)
+            info.date_time = ZIP_EPOCH
+            info.external_attr = _archive_mode(os.stat(path)) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, 'rb') as src, zf.open(
+                    info, 'w',
+                    force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as dst:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    dst.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+class ArchiveReader(IterReader):
+    """Archive of files, generated as it's read
+
+    Nothing is written to disk. The archive is the same every time it's
+    generated, unless the content of the files changes, so it can be read
+    several times by seeking back to the start, e.g. to checksum it before
+    uploading it. Times and owners aren't archived, so the same files give
+    the same archive in any checkout.
+    """
+
+    def __init__(self, paths, fmt):
+        self.paths = paths
+        self.format = fmt
+        self.size = None
+        super().__init__(self._chunks())
+
+    def _chunks(self):
+        if self.format == 'zip':
+            return _zip_chunks(self.paths)
+        return _tar_chunks(self.paths, self.format == 'tar.gz')
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        data = super().read(size)
+        if not data and (size is None or size != 0):
+            self.size = self._pos
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_END:
+            if self.size is None:
+                for chunk in iter(lambda: self.read(CHUNK_SIZE), b''):
+                    pass
+            offset += self.size
+        elif whence == io.SEEK_CUR:
+            offset += self._pos
+        if self.size is not None and offset >= self.size:
+            # Nothing left to read, without generating the rest.
+            self.close()
+            IterReader.__init__(self, [])
+            self._pos = self.size
+            return self._pos
+        if offset < self._pos:
+            # Generate the archive again.
+            self.close()
+            IterReader.__init__(self, self._chunks())
+        while self._pos < offset:
+            if not self.read(min(CHUNK_SIZE, offset - self._pos)):
+                break
+        return self._pos
+
+
+def _validator(resp):
+    """What tells whether an artifact changed, for If-Range requests"""
+    etag = resp.headers.get('ETag')
+    if etag and etag.startswith('W/'):
+        # Weak ETags can't be used to resume.
+        etag = None
+    return etag or resp.headers.get('Last-Modified')
+
+
+def _safe_member(name):
+    parts = name.replace(os.sep, '/').split('/')
+    return not os.path.isabs(name) and '..' not in parts
+
+
+def _move_into_place(tmpdir):
+    """Move the files extracted to tmpdir into the working directory
+
+    Each file replaces the one at the same path, if any, atomically. Other
+    files in the working directory are left alone.
+    """
+    for dirpath, dirnames, filenames in os.walk(tmpdir):
+        target = os.path.relpath(dirpath, tmpdir)
+        os.makedirs(target, exist_ok=True)
+        for name in filenames:
+            os.replace(os.path.join(dirpath, name),
+                       os.path.join(target, name))
+
+
+def _untar_stream(stream, dest, filename):
+    """Extract the tar archive read from stream to dest, as it's read"""
+    with tarfile.open(fileobj=stream, mode='r|*') as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extraction_filter = tarfile.data_filter
+        for member in tar:
+            if not (member.isfile() or member.isdir()) or \
+                    not _safe_member(member.name):
+                raise Exception('Unsafe member %s in %s' % (
+                    member.name, filename))
+            tar.extract(member, dest)
+
+
+_ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_ZIP_DIRECTORY_SIGNATURES = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06')
+
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise zipfile.BadZipFile('Truncated zip archive')
+    return data
+
+
+def _zip_member_data(stream, method, size):
+    """Uncompressed data of a zip member, in chunks
+
+    Deflated data is read until its end, as its size may only follow it,
+    and what's read past the end is put back.
+    """
+    if method == zipfile.ZIP_STORED:
+        while size:
+            chunk = _read_exact(stream, min(CHUNK_SIZE, size))
+            size -= len(chunk)
+            yield chunk
+        return
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    while not decompressor.eof:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            raise zipfile.BadZipFile('Truncated zip archive')
+        yield decompressor.decompress(chunk)
+    stream.unread(decompressor.unused_data)
+
+
+def _unzip_stream(stream, dest, filename):
+    """Extract the zip archive read from stream, an IterReader, to dest
+
+    The directory of a zip archive is at its end, but each member is
+    preceded by a local header, which is enough to extract it as it's
+    read. Members whose sizes follow their data must be deflated, for
+    their end to be known. Permissions, only in the directory, aren't
+    restored.
+    """
+    while True:
+        signature = stream.read(4)
+        if signature in _ZIP_DIRECTORY_SIGNATURES:
+            # The members are followed by the directory.
+            return
+        if signature != b'PK\x03\x04':
+            raise zipfile.BadZipFile('%s is not a zip archive' % filename)
+        (_, _, flags, method, _, _, crc, size, uncompressed_size, name_len,
+         extra_len) = _ZIP_LOCAL_HEADER.unpack(
+            signature + _read_exact(stream, _ZIP_LOCAL_HEADER.size - 4))
+        name = _read_exact(stream, name_len).decode(
+            'utf-8' if flags & 0x800 else 'cp437')
+        extra = _read_exact(stream, extra_len)
+        zip64 = False
+        while len(extra) >= 4:
+            tag, length = struct.unpack('<HH', extra[:4])
+            if tag == 1:
+                # Zip64 sizes, when too big for the header.
+                zip64 = True
+                sizes = struct.unpack(
+                    '<%dQ' % (length // 8), extra[4:4 + length // 8 * 8])
+                if size == 0xffffffff:
+                    size = sizes[uncompressed_size == 0xffffffff]
+            extra = extra[4 + length:]
+
+        if not _safe_member(name):
+            raise Exception('Unsafe member %s in %s' % (name, filename))
+        if flags & 0x1 or method not in (
+                zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) or (
+                flags & 0x8 and method != zipfile.ZIP_DEFLATED):
+            raise Exception('Unsupported member %s in %s' % (name, filename))
+
+        path = os.path.join(dest, name)
+        actual_crc = 0
+        if name.endswith('/'):
+            os.makedirs(path, exist_ok=True)
+            for data in _zip_member_data(stream, method, size):
+                actual_crc = zlib.crc32(data, actual_crc)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as fp:
+                for data in _zip_member_data(stream, method, size):
+                    actual_crc = zlib.crc32(data, actual_crc)
+                    fp.write(data)
+        if flags & 0x8:
+            # The data descriptor, with an optional signature.
+            descriptor = _read_exact(stream, 4)
+            if descriptor == b'PK\x07\x08':
+                descriptor = _read_exact(stream, 4)
+            crc, = struct.unpack('<I', descriptor)
+            _read_exact(stream, 16 if zip64 else 8)
+        if actual_crc != crc:
+            raise zipfile.BadZipFile('Bad CRC of %s in %s' % (name, filename))
+
+
 @windlass.api.register_type('generic')
 class Generic(windlass.api.Artifact):
     """Generic artifact type
@@ -69,9 +483,41 @@ class Generic(windlass.api.Artifact):
             result += ' stored in %s>' % fname
         return result
 
+    def is_archive(self):
+        """Whether the artifact is several files, stored as an archive
+
+        The files are a directory or a glob matching several files, given
+        by filename, and the archive is named by archive.
+        """
+        return bool(self.data.get('archive'))
+
+    def get_members(self):
+        """Files of an archive artifact, relative to the working directory"""
+        pattern = self.data.get('filename')
+        if os.path.isabs(pattern) or not _safe_member(pattern):
+            raise Exception('Filename must be within the working directory')
+        paths = set()
+        for match in glob.glob(pattern):
+            if os.path.isdir(match):
+                for dirpath, dirnames, filenames in os.walk(match):
+                    paths.update(os.path.join(dirpath, f) for f in filenames)
+            else:
+                paths.add(match)
+        if not paths:
+            raise LocalArtifactCopyMissing(
+                'Failed to found artifacts matching %s' % pattern)
+        # In the same order in any checkout, for the archive to be the same.
+        return sorted(paths)
+
     def get_filename(self):
         if self.actual_filename is not None:
             return self.actual_filename
+        if self.is_archive():
+            archive = self.data['archive']
+            if os.sep in archive or '/' in archive:
+                raise Exception('Archive name cannot contain path')
+            archive_format(archive)
+            return archive
 
         # Generic artifacts should be pinned to their filename so that we
         # get find them for promotion, etc.
@@ -92,32 +538,22 @@ class Generic(windlass.api.Artifact):
     def url(self, version=None, generic_url=None, **kwargs):
         if version and generic_url:
             # This requires Arfifactory and remotes should replace it
-            safe_url = generic_url.rstrip('/')
-            repo = safe_url[safe_url.rfind('/') + 1:]
-            api = safe_url[:safe_url.rfind('/')] + '/api/search/prop'
-            params = {'version': version, 'repos': repo}
-            uri_list = requests.get(api,
-                                    params=params,
-                                    verify='/etc/ssl/certs').json()['results']
-            for item in uri_list:
-                artifact_name = item['uri'].split('/')[-1]
-                # TODO(kerrin) What does it mean if filename is None?
-                if fnmatch.fnmatch(
-                        artifact_name,
-                        self.actual_filename or self.data.get('filename')):
-                    return requests.get(
-                        item['uri'],
-                        verify='/etc/ssl/certs'
-                    ).json()['downloadUri']
+            search = get_search(generic_url, version)
+            # TODO(kerrin) What does it mean if filename is None?
+            uris = search.find(
+                self.actual_filename or self.data.get('archive') or
+                self.data.get('filename'))
+            if uris:
+                return uris[0]
 
             msg = 'Could not find artifact %s with version %s in %s' % (
-                self.name, version, repo)
+                self.name, version, search.repo)
             raise Exception(msg)
 
         if generic_url:
             # TODO(kerrin) Is this used for anything? I am not following the
             # logic here
-            return os.path.join(generic_url, artifact_name)
+            return os.path.join(generic_url, self.get_filename())
 
         return self.get_filename()
 
@@ -127,19 +563,192 @@ class Generic(windlass.api.Artifact):
                  version=None,
                  generic_url=None,
                  **kwargs):
-        artifact_url = self.url(version or self.version, generic_url)
-
-        resp = requests.get(
-            artifact_url,
-            verify='/etc/ssl/certs',
-            timeout=5)
-        if resp.status_code != 200:
+        version = version or self.version
+        artifact_url = self.url(version, generic_url)
+        filename = os.path.basename(artifact_url)
+        if self.is_archive():
+            return self._download_archive(artifact_url, filename)
+        self._download_file(artifact_url, filename, version)
+
+    def _download_archive(self, artifact_url, filename):
+        """Download an archive, unpacking it as it's downloaded
+
+        The archive itself isn't written to disk. Its files are extracted
+        to a temporary directory, and moved into place once the checksum of
+        the archive is verified.
+        """
+        tmpdir = tempfile.mkdtemp(dir='.', prefix='.%s.' % filename)
+        stream = IterReader(self._download_chunks(artifact_url, filename))
+        try:
+            try:
+                if archive_format(filename) == 'zip':
+                    _unzip_stream(stream, tmpdir, filename)
+                else:
+                    _untar_stream(stream, tmpdir, filename)
+                # The rest of the archive, checksummed with the members.
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    pass
+            except (tarfile.ReadError, zipfile.BadZipFile, zlib.error) as e:
+                raise windlass.exc.RetryableFailure(
+                    'Failed to unpack artifact %s: %s' % (filename, e))
+            _move_into_place(tmpdir)
+        finally:
+            stream.close()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        logging.info('%s: unpacked %s', self.name, filename)
+
+    def _download_chunks(self, artifact_url, filename):
+        """Content of an artifact, in chunks, verified by its checksum
+
+        When the connection drops, the rest of the artifact is asked for,
+        up to RESUME_ATTEMPTS times, as long as its ETag or Last-Modified
+        time says it didn't change.
+        """
+        session = windlass.transport.get_session()
+        sha = hashlib.sha256()
+        offset = 0
+        attempts = 0
+        validator = expected = None
+        while True:
+            headers = {}
+            if offset:
+                headers = {
+                    'Range': 'bytes=%d-' % offset, 'If-Range': validator}
+            resp = session.get(artifact_url, headers=headers, stream=True)
+            try:
+                if not offset and resp.status_code == requests.codes.ok:
+                    validator = _validator(resp)
+                    expected = resp.headers.get('X-Checksum-Sha256')
+                elif not offset:
+                    raise windlass.exc.RetryableFailure(
+                        'Failed to download artifact %s' % filename)
+                elif resp.status_code != requests.codes.partial_content or \
+                        not resp.headers.get('Content-Range', '').startswith(
+                            'bytes %d-' % offset):
+                    raise windlass.exc.RetryableFailure(
+                        'Failed to resume download of artifact %s' % filename)
+                try:
+                    for chunk in resp.iter_content(CHUNK_SIZE):
+                        sha.update(chunk)
+                        offset += len(chunk)
+                        yield chunk
+                    break
+                except (requests.exceptions.ConnectionError,
+                        requests.exceptions.ChunkedEncodingError) as e:
+                    attempts += 1
+                    if not validator or attempts > RESUME_ATTEMPTS:
+                        raise windlass.exc.RetryableFailure(
+                            'Download of artifact %s interrupted: %s' % (
+                                filename, e))
+                    logging.info('%s: resuming download of %s at %d bytes',
+                                 self.name, filename, offset)
+            finally:
+                resp.close()
+
+        if expected and sha.hexdigest() != expected:
+            raise windlass.exc.RetryableFailure(
+                'Checksum mismatch downloading artifact %s: expected %s, '
+                'got %s' % (filename, expected, sha.hexdigest()))
+
+    def _download_file(self, artifact_url, filename, version):
+        cache = windlass.cache.DownloadCache()
+        if cache.get(filename, url=artifact_url, version=version):
+            logging.info('%s: %s found in the download cache',
+                         self.name, filename)
+            return
+
+        # The partial download is kept when the transfer is interrupted, and
+        # the next attempt asks for the rest of the artifact only, if it
+        # didn't change since. Changes are told by the ETag or Last-Modified
+        # time of the artifact, kept next to the partial download.
+        part = filename + '.part'
+        validator_path = part + '.json'
+        try:
+            offset = os.path.getsize(part)
+        except FileNotFoundError:
+            offset = 0
+        validator = None
+        try:
+            with open(validator_path) as fp:
+                saved = json.load(fp)
+            if saved.get('url') == artifact_url:
+                validator = saved.get('validator')
+        except (FileNotFoundError, ValueError):
+            pass
+        headers = {}
+        if offset and validator:
+            headers = {'Range': 'bytes=%d-' % offset, 'If-Range': validator}
+        elif offset:
+            logging.info('%s: discarding partial download of %s',
+                         self.name, filename)
+            os.remove(part)
+
+        resp = windlass.transport.get_session().get(
+            artifact_url, headers=headers, stream=True)
+        try:
+            if resp.status_code == \
+                    requests.codes.requested_range_not_satisfiable:
+                # The partial download isn't of this artifact.
+                os.remove(part)
+                raise windlass.exc.RetryableFailure(
+                    'Failed to resume download of artifact %s' % filename)
+            if resp.status_code not in (
+                    requests.codes.ok, requests.codes.partial_content):
+                raise windlass.exc.RetryableFailure(
+                    'Failed to download artifact %s' % filename)
+
+            if resp.status_code == requests.codes.ok:
+                self._save_validator(resp, artifact_url, validator_path)
+
+            sha = hashlib.sha256()
+            mode = 'wb'
+            if resp.status_code == requests.codes.partial_content:
+                if not resp.headers.get('Content-Range', '').startswith(
+                        'bytes %d-' % offset):
+                    raise windlass.exc.RetryableFailure(
+                        'Unexpected range %s of artifact %s' % (
+                            resp.headers.get('Content-Range'), filename))
+                logging.info('%s: resuming download of %s at %d bytes',
+                             self.name, filename, offset)
+                mode = 'ab'
+                with open(part, 'rb') as fp:
+                    for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+                        sha.update(chunk)
+
+            with open(part, mode) as fp:
+                try:
+                    for chunk in resp.iter_content(CHUNK_SIZE):
+                        sha.update(chunk)
+                        fp.write(chunk)
+                except (requests.exceptions.ConnectionError,
+                        requests.exceptions.ChunkedEncodingError) as e:
+                    raise windlass.exc.RetryableFailure(
+                        'Download of artifact %s interrupted: %s' % (
+                            filename, e))
+        finally:
+            resp.close()
+
+        # Artifactory sends the checksum of the whole artifact, also with
+        # partial content.
+        expected = resp.headers.get('X-Checksum-Sha256')
+        if expected and sha.hexdigest() != expected:
+            os.remove(part)
+            os.remove(validator_path)
             raise windlass.exc.RetryableFailure(
-                'Failed to download artifact %s' % (
-                    os.path.basename(artifact_url)))
+                'Checksum mismatch downloading artifact %s: expected %s, '
+                'got %s' % (filename, expected, sha.hexdigest()))
+
+        os.replace(part, filename)
+        os.remove(validator_path)
+        cache.add(filename, sha.hexdigest(), artifact_url, version)
 
-        with open(os.path.basename(artifact_url), 'wb') as fp:
-            fp.write(resp.content)
+    @staticmethod
+    def _save_validator(resp, artifact_url, path):
+        """Save what tells whether the artifact changed, to resume with"""
+        with windlass.tools.atomic_open(path) as fp:
+            fp.write(json.dumps(
+                {'url': artifact_url, 'validator': _validator(resp)}
+            ).encode('utf-8'))
 
     @windlass.retry.simple()
     @windlass.api.fall_back('generic_url', first_only=True)
@@ -147,16 +756,20 @@ class Generic(windlass.api.Artifact):
                version=None,
                generic_url=None,
                docker_user=None, docker_password=None,
+               progress=None,
                **kwargs):
+        """Upload the artifact, streamed from disk
 
+        progress is called with the bytes uploaded so far and the size of
+        the artifact, by default logging every 10%.
+        """
         local_filename = self.get_filename()
-        with open(local_filename, 'rb') as fp:
-            data = fp.read()
         if 'remote' in kwargs:
+            stream = self._progress_stream(self.export_stream(), progress)
             try:
                 # Ignoring version.
                 return kwargs['remote'].upload_generic(
-                    local_filename, self.export_stream(),
+                    local_filename, stream,
                     properties={'version': version}
                 )
             except windlass.api.NoValidRemoteError:
@@ -164,6 +777,8 @@ class Generic(windlass.api.Artifact):
                 logging.debug(
                     "No generic endpoint configured for %s", kwargs['remote']
                 )
+            finally:
+                stream.close()
         if not generic_url:
             raise Exception(
                 'generic_url not specified. Unable to publish artifact %s' % (
@@ -179,14 +794,24 @@ class Generic(windlass.api.Artifact):
             temp_path,
             local_filename,
             ';version=%s' % version if version else '',)
-        auth = requests.auth.HTTPBasicAuth(docker_user, docker_password)
+        session = windlass.transport.get_session(
+            docker_user, docker_password)
 
         # This fails with a 403 if we try and upload the same artifact twice.
-        resp = requests.put(
-            upload_url,
-            data=data,
-            auth=auth,
-            verify='/etc/ssl/certs')
+        # Archives are generated twice, to checksum and then to send them,
+        # rather than written to disk.
+        stream = self.export_stream()
+        try:
+            headers = windlass.transport.checksum_headers(stream)
+            if windlass.transport.checksum_deploy(
+                    session, upload_url, headers):
+                logging.info('%s: Successfully pushed artifact' % self.name)
+                return
+            resp = session.put(
+                upload_url, data=self._progress_stream(stream, progress),
+                headers=headers)
+        finally:
+            stream.close()
         if resp.status_code in (
                 requests.codes.unauthorized, requests.codes.forbidden):
             # No retries in this case.
@@ -207,9 +832,16 @@ class Generic(windlass.api.Artifact):
         except FileNotFoundError:
             pass
 
+    def _progress_stream(self, stream, progress=None):
+        return windlass.transport.ProgressReader(
+            stream,
+            callback=progress or windlass.transport.log_progress(self.name))
+
     def export_stream(self, version=None):
-        with open(self.get_filename(), 'rb') as fp:
-            yield fp
+        if self.is_archive():
+            return ArchiveReader(
+                self.get_members(), archive_format(self.get_filename()))
+        return open(self.get_filename(), 'rb')
 
     def export(self, export_dir='.', export_name=None, version=None):
         if export_name is None:
@@ -218,8 +850,9 @@ class Generic(windlass.api.Artifact):
         logging.debug(
             "Exporting generic %s to %s", self.name, export_path
         )
-        with open(export_path, 'wb') as f:
-            f.write(self.export_stream().read())
+        with self.export_stream() as src:
+            with windlass.tools.atomic_open(export_path) as f:
+                shutil.copyfileobj(src, f, CHUNK_SIZE)
         return export_path
 
     def build(self):
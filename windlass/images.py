@@ -14,25 +14,51 @@
 # under the License.
 #
 
+import collections
 import logging
 import multiprocessing
 import os
+import tempfile
 
 import docker
 from git import Repo
 import yaml
 
 import windlass.api
+import windlass.compression
+import windlass.daemons
 import windlass.exc
+import windlass.ratelimit
+import windlass.remotes
 import windlass.tools
 
 BUILDARG_PREFIX = 'WINDLASS_BUILDARG_'
-
-
-def check_docker_stream(stream):
+# Directory to write the full build output of each image to. Defaults to a
+# windlass-build-logs directory under the system temporary directory.
+BUILD_LOG_DIR_ENV = 'WINDLASS_BUILD_LOG_DIR'
+# Number of lines of build output kept in memory for error reporting, the
+# full output is always available in the build log file.
+BUILD_OUTPUT_TAIL = 200
+
+
+def is_rate_limited(data):
+    """Whether an error in docker output is the registry's rate limit"""
+    detail = data.get('errorDetail') or {}
+    if detail.get('code') == 429:
+        return True
+    # Registry errors are reported as "<error code>: <message>", possibly
+    # prefixed with what failed.
+    message = detail.get('message') or data['error']
+    return 'toomanyrequests' in [
+        part.strip().lower() for part in message.split(':')]
+
+
+def check_docker_stream(stream, rate_limiter=None):
     # Read output from docker command and raise exception
     # if docker hit an error processing the command.
     # Also log messages if debugging is turned on.
+    # If the registry refused the request due to rate limiting, let the
+    # rate_limiter know so that other pulls wait.
     name = multiprocessing.current_process().name
     last_msgs = []
     for line in stream:
@@ -53,6 +79,8 @@ def check_docker_stream(stream):
         if 'error' in data:
             logging.error("Error processing image %s:%s" % (
                 name, data['error']))
+            if rate_limiter and is_rate_limited(data):
+                rate_limiter.rate_limited()
             raise windlass.exc.WindlassPushPullException(
                 '%s ERROR from docker: %s' % (
                     name, data['error']
@@ -64,9 +92,8 @@ def check_docker_stream(stream):
 
 def push_image(imagename, push_tag='latest', auth_config=None):
     output = None
-    client = docker.from_env(
-        version='auto',
-        timeout=180)
+    client = windlass.daemons.acquire_for_image(
+        '%s:%s' % (imagename, push_tag))
     try:
         name = multiprocessing.current_process().name
         logging.info('%s: Pushing as %s:%s', name, imagename, push_tag)
@@ -78,7 +105,7 @@ def push_image(imagename, push_tag='latest', auth_config=None):
     finally:
         if output:
             output.close()
-        client.close()
+        windlass.daemons.release(client)
 
     return True
 
@@ -94,13 +121,45 @@ def clean_tag(tag):
     return clean[:128]
 
 
+def get_build_log_path(name, log_dir=None):
+    """Path of the file the build output for image name is written to"""
+    if log_dir is None:
+        log_dir = os.environ.get(
+            BUILD_LOG_DIR_ENV,
+            os.path.join(tempfile.gettempdir(), 'windlass-build-logs'))
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, '%s.log' % clean_tag(name))
+
+
+def get_base_images(path, dockerfile=None):
+    """Images named in the FROM instructions of a Dockerfile"""
+    bases = []
+    stages = set()
+    try:
+        with open(os.path.join(path, dockerfile or 'Dockerfile')) as fp:
+            for line in fp:
+                words = line.split()
+                if len(words) < 2 or words[0].upper() != 'FROM':
+                    continue
+                args = [w for w in words[1:] if not w.startswith('--')]
+                # FROM <image> AS <stage>, later FROM <stage> isn't an image
+                if args[0] not in stages:
+                    bases.append(args[0])
+                if len(args) == 3 and args[1].upper() == 'AS':
+                    stages.add(args[2])
+    except (IOError, IndexError):
+        pass
+    return bases
+
+
 def build_verbosly(name, path, nocache=False, dockerfile=None,
-                   pull=True):
-    client = docker.from_env(
-        version='auto',
-        timeout=180
-    )
+                   pull=True, log_dir=None):
+    client = windlass.daemons.acquire()
+    log_path = get_build_log_path(name, log_dir)
     try:
+        # Base images built earlier may be on another daemon.
+        for base in get_base_images(path, dockerfile):
+            windlass.daemons.ensure_image(base, client)
         bargs = windlass.tools.load_proxy()
         for envvar in os.environ:
             if envvar.startswith(BUILDARG_PREFIX):
@@ -113,20 +172,25 @@ def build_verbosly(name, path, nocache=False, dockerfile=None,
                                   dockerfile=dockerfile,
                                   pull=pull)
         errors = []
-        output = []
-        for line in stream:
-            data = yaml.load(line.decode(), Loader=yaml.SafeLoader)
-            if 'stream' in data:
-                for out in data['stream'].split('\n\r'):
-                    logging.debug('%s: %s', name, out.strip())
-                    # capture detailed output in case of error
-                    output.append(out.strip())
-            elif 'error' in data:
-                errors.append(data['error'])
+        # Only the tail of the output is kept in memory, the full output
+        # is written to the build log.
+        output = collections.deque(maxlen=BUILD_OUTPUT_TAIL)
+        with open(log_path, 'w') as log:
+            for line in stream:
+                data = yaml.load(line.decode(), Loader=yaml.SafeLoader)
+                if 'stream' in data:
+                    for out in data['stream'].split('\n\r'):
+                        logging.debug('%s: %s', name, out.strip())
+                        # capture detailed output in case of error
+                        output.append(out.strip())
+                        log.write(out.strip() + '\n')
+                elif 'error' in data:
+                    errors.append(data['error'])
+                    log.write('ERROR: %s\n' % data['error'])
         if errors:
             logging.error(
-                'Failed to build %s. Error details will be shown at the end.',
-                name)
+                'Failed to build %s. Error details will be shown at the end. '
+                'Full build log in %s', name, log_path)
             debug_data = {'buildargs.%s' % k: v for k, v in bargs.items()}
             debug_data['dockerfile'] = dockerfile
             debug_data['tag'] = name
@@ -135,14 +199,15 @@ def build_verbosly(name, path, nocache=False, dockerfile=None,
             debug_data['pull'] = str(pull)
             raise windlass.exc.WindlassBuildException(
                 "Failed to build {}".format(name),
-                out=output,
+                out=list(output),
                 errors=errors,
                 artifact_name=name,
-                debug_data=debug_data)
+                debug_data=debug_data,
+                log_path=log_path)
         logging.info("Successfully built %s from path %s", name, path)
         return client.images.get(name)
     finally:
-        client.close()
+        windlass.daemons.release(client)
 
 
 def build_image_from_local_repo(repopath, imagepath, name, tags=[],
@@ -181,6 +246,9 @@ class Image(windlass.api.Artifact):
             self.version = devtag
 
         self.devtag = data.get('devtag', devtag)
+        # Where download found the image, when downloaded without the docker
+        # daemon: (RegistryClient, repository, digest).
+        self.registry_source = None
 
     def __repr__(self):
         return (
@@ -198,21 +266,19 @@ class Image(windlass.api.Artifact):
 
         And tag it with the imagename and tag.
         """
-        client = docker.from_env(
-            version='auto',
-            timeout=180
-        )
+        client = windlass.daemons.acquire()
         try:
             logging.info("%s: Pulling image from %s", imagename, remoteimage)
 
+            rate_limiter = windlass.ratelimit.acquire(remoteimage)
             output = client.api.pull(remoteimage, stream=True)
-            check_docker_stream(output)
+            check_docker_stream(output, rate_limiter)
             client.api.tag(remoteimage, imagename, tag)
 
             image = client.images.get('%s:%s' % (imagename, tag))
             return image
         finally:
-            client.close()
+            windlass.daemons.release(client)
 
     def url(self, version=None, docker_image_registry=None, **kwargs):
         if version is None:
@@ -253,16 +319,15 @@ class Image(windlass.api.Artifact):
             logging.info('Get image %s completed', image_def['name'])
 
     def _delete_image(self, image):
-        client = docker.from_env(
-            version='auto',
-            timeout=180)
-        try:
-            client.api.remove_image(image)
-        except docker.errors.ImageNotFound:
-            # Image isn't on system so no worries
-            pass
-        finally:
-            client.close()
+        for endpoint in windlass.daemons.get_endpoints():
+            client = windlass.daemons.get_client(endpoint)
+            try:
+                client.api.remove_image(image)
+            except docker.errors.ImageNotFound:
+                # Image isn't on system so no worries
+                pass
+            finally:
+                client.close()
 
     @windlass.api.fall_back('docker_image_registry')
     def delete(self, version=None, docker_image_registry=None, **kwargs):
@@ -276,32 +341,59 @@ class Image(windlass.api.Artifact):
             )
         self._delete_image('%s:%s' % (self.imagename, tag))
 
+    def oci_layout(self, oci_layout_dir):
+        """OCI image layout of the image in oci_layout_dir"""
+        return os.path.join(oci_layout_dir, self.imagename, self.version)
+
     @windlass.retry.simple()
     @windlass.api.fall_back('docker_image_registry')
-    def download(self, version=None, docker_image_registry=None, **kwargs):
-        client = docker.from_env(
-            version='auto',
-            timeout=180)
-        try:
-            if version is None and self.version is None:
-                raise Exception('Must specify version of image to download.')
+    def download(self, version=None, docker_image_registry=None,
+                 registry_transfer=False, oci_layout_dir=None,
+                 docker_user=None, docker_password=None, **kwargs):
+        """Pull the image from docker_image_registry
+
+        With registry_transfer, the docker daemon isn't used. The image is
+        looked up in the registry with the registry v2 API, using
+        docker_user and docker_password if asked for credentials, and
+        pulled into an OCI image layout under oci_layout_dir, if set.
+        Upload, with registry_transfer, then copies the image from the
+        registry, e.g. to promote it, or pushes it from the layout.
+        """
+        if version is None and self.version is None:
+            raise Exception('Must specify version of image to download.')
 
-            if docker_image_registry is None:
-                raise Exception(
-                    'docker_image_registry not set for image download. '
-                    'Where should we download from?')
+        if docker_image_registry is None:
+            raise Exception(
+                'docker_image_registry not set for image download. '
+                'Where should we download from?')
 
-            tag = version or self.version
+        tag = version or self.version
 
-            logging.info('Pinning image: %s to pin: %s', self.imagename, tag)
-            remoteimage = '%s/%s:%s' % (
-                docker_image_registry, self.imagename, tag
-            )
+        logging.info('Pinning image: %s to pin: %s', self.imagename, tag)
+        remoteimage = '%s/%s:%s' % (
+            docker_image_registry, self.imagename, tag
+        )
 
-            # Pull the remoteimage down and tag it with the name of artifact
-            # and the requested version
-            self.pull_image(remoteimage, self.imagename, tag)
+        if registry_transfer:
+            host, repository = windlass.ratelimit.registry_api(
+                '%s/%s' % (docker_image_registry, self.imagename))
+            client = windlass.remotes.RegistryClient(
+                host, docker_user, docker_password,
+                rate_limiter=windlass.ratelimit.acquire(remoteimage))
+            if oci_layout_dir:
+                digest = client.pull(
+                    repository, tag, self.oci_layout(oci_layout_dir))
+            else:
+                _, _, digest = client.get_manifest(repository, tag)
+            self.registry_source = (client, repository, digest)
+            return
+
+        # Pull the remoteimage down and tag it with the name of artifact
+        # and the requested version
+        self.pull_image(remoteimage, self.imagename, tag)
 
+        client = windlass.daemons.acquire_for_image(remoteimage)
+        try:
             if tag != self.version:
                 # Tag the image with the version but without the repository
                 client.api.tag(remoteimage, self.imagename, self.version)
@@ -310,16 +402,15 @@ class Image(windlass.api.Artifact):
             # support a devtag
             client.api.tag(remoteimage, self.imagename, self.devtag)
         finally:
-            client.close()
+            windlass.daemons.release(client)
 
     def update_version(self, version):
         """Tag the image with a new version tag and update internal version.
 
         Does not attempt to remove the old version tag.
         """
-        client = docker.from_env(
-            version='auto',
-            timeout=180)
+        client = windlass.daemons.acquire_for_image(
+            '%s:%s' % (self.imagename, self.version))
         try:
             if version == self.version:
                 logging.debug(
@@ -332,13 +423,21 @@ class Image(windlass.api.Artifact):
             )
             return self.set_version(version)
         finally:
-            client.close()
+            windlass.daemons.release(client)
 
     @windlass.retry.simple()
     @windlass.api.fall_back('docker_image_registry', first_only=True)
     def upload(self, version=None, docker_image_registry=None,
                docker_user=None, docker_password=None,
+               registry_transfer=False, oci_layout_dir=None,
                **kwargs):
+        """Push the image to docker_image_registry
+
+        With registry_transfer, an image downloaded with registry_transfer
+        is copied from the registry it was found in, and an image in an
+        OCI image layout under oci_layout_dir is pushed from there, without
+        the docker daemon. Other images are pushed from the daemon.
+        """
         # Start to phase out passing of version to upload.
         if version != self.version:
             logging.debug(
@@ -363,11 +462,23 @@ class Image(windlass.api.Artifact):
                 'docker_image_registry not set for image upload. '
                 'Unable to publish')
 
+        # Upload image with this tag
+        upload_tag = version or self.version
+        connector = docker_image_registry.connector
+
+        if registry_transfer and self.registry_source:
+            return connector.copy_image(
+                self.registry_source, self.imagename, upload_tag)
+        if registry_transfer and oci_layout_dir and os.path.exists(
+                os.path.join(self.oci_layout(oci_layout_dir), 'index.json')):
+            return connector.push_layout(
+                self.oci_layout(oci_layout_dir), self.imagename, upload_tag)
+
         # Local image name on the node
         local_fullname = self.url(self.version)
 
         # raises exception if imagename is missing
-        client = docker.from_env(version='auto', timeout=180)
+        client = windlass.daemons.acquire_for_image(local_fullname)
         try:
             client.images.get(local_fullname)
         except docker.errors.ImageNotFound as e:
@@ -377,12 +488,9 @@ class Image(windlass.api.Artifact):
                 errors=[str(e)]
             )
         finally:
-            client.close()
+            windlass.daemons.release(client)
 
-        # Upload image with this tag
-        upload_tag = version or self.version
-
-        result = docker_image_registry.connector.upload(
+        result = connector.upload(
             local_name=local_fullname,
             upload_name=self.imagename,
             upload_tag=upload_tag,
@@ -391,33 +499,52 @@ class Image(windlass.api.Artifact):
         logging.info('%s: Successfully pushed', self.name)
         return result
 
-    def export_stream(self, version=None):
+    def _compress(self, stream, compression, chunk_size):
+        stats = windlass.compression.CompressionStats(compression)
+        yield from windlass.compression.compress_stream(
+            stream, compression, chunk_size=chunk_size, stats=stats)
+        logging.info('%s: %s', self.name, stats)
+
+    def export_stream(self, version=None, compression=None, chunk_size=None):
+        """Export the image as a docker save tar stream
+
+        If compression is set (gzip, xz or zstd), or export_compression is
+        set in the artifact configuration, the stream is compressed in
+        blocks of chunk_size bytes on several threads as it is read.
+        """
+        compression = compression or self.data.get('export_compression')
         img_name = self.imagename + ':' + self.version
 
-        client = docker.from_env(version='auto', timeout=180)
+        client = windlass.daemons.acquire_for_image(img_name)
         try:
             img = client.images.get(img_name)
-            return img.save()
+            stream = img.save()
         finally:
-            client.close()
-
-    def export(self, export_dir='.', export_name=None, version=None):
-        client = docker.from_env(
-            version='auto',
-            timeout=180)
+            windlass.daemons.release(client)
+        if compression is None:
+            return stream
+        return self._compress(stream, compression, chunk_size)
+
+    def export(self, export_dir='.', export_name=None, version=None,
+               compression=None, chunk_size=None):
+        compression = compression or self.data.get('export_compression')
+        img_name = self.imagename + ':' + self.version
+        client = windlass.daemons.acquire_for_image(img_name)
         try:
-            img_name = self.imagename + ':' + self.version
             img = client.images.get(img_name)
 
             if export_name is None:
                 ver = version or img.short_id[7:]
-                export_name = "%s-%s.tar" % (self.name, ver)
+                export_name = "%s-%s.tar%s" % (
+                    self.name, ver,
+                    windlass.compression.get_extension(compression))
             export_path = os.path.join(export_dir, export_name)
             logging.debug("Exporting image %s to %s", img_name, export_path)
 
             os.makedirs(os.path.dirname(export_path), exist_ok=True)
             with open(export_path, 'wb') as f:
-                stream = self.export_stream()
+                stream = self.export_stream(
+                    compression=compression, chunk_size=chunk_size)
                 try:
                     for chunk in stream:
                         f.write(chunk)
@@ -427,15 +554,13 @@ class Image(windlass.api.Artifact):
             return export_path
 
         finally:
-            client.close()
+            windlass.daemons.release(client)
 
     def export_signable(self, export_dir='.', export_name=None, version=None):
         """Write the image ID (sha256 hash) to the export file"""
-        client = docker.from_env(
-            version='auto',
-            timeout=180)
+        img_name = self.imagename + ':' + self.version
+        client = windlass.daemons.acquire_for_image(img_name)
         try:
-            img_name = self.imagename + ':' + self.version
             img = client.images.get(img_name)
 
             if export_name is None:
@@ -454,4 +579,4 @@ class Image(windlass.api.Artifact):
             return export_path
 
         finally:
-            client.close()
+            windlass.daemons.release(client)
@@ -0,0 +1,253 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Pace requests to registries that enforce rate limits
+
+Registries like Docker Hub limit the number of pulls over a time window and
+answer with 429 Too Many Requests once the limit is reached. Each registry
+gets a token bucket whose state is kept in a file, so that all windlass
+worker processes on the host share it. The bucket is sized from the
+RateLimit-Limit and RateLimit-Remaining headers returned by the registry,
+and Retry-After (or a 429 without it) blocks all pulls until it passes.
+
+Registries which never return rate limit headers are not throttled.
+"""
+
+import email.utils
+import fcntl
+import json
+import logging
+import os
+import re
+import time
+
+import windlass.remotes
+import windlass.tools
+
+DOCKER_HUB = 'docker.io'
+DOCKER_HUB_ALIASES = (
+    DOCKER_HUB,
+    'index.docker.io',
+    'registry.hub.docker.com',
+    'registry-1.docker.io',
+)
+# Host serving the registry v2 API for Docker Hub
+DOCKER_HUB_API = 'registry-1.docker.io'
+
+# How long to stop pulling from a registry that returned a 429 without
+# a Retry-After header.
+default_backoff = 60
+# How old the bucket state can get before pulls probe the registry for
+# its current rate limit headers.
+probe_interval = 60
+
+
+def split_registry(image):
+    """Split a full image name into registry host and the rest
+
+    alpine:3.5 => docker.io, alpine:3.5
+    127.0.0.1:5000/org/image => 127.0.0.1:5000, org/image
+    """
+    parts = image.split('/', 1)
+    if len(parts) == 2 and (
+            '.' in parts[0] or ':' in parts[0] or parts[0] == 'localhost'):
+        host, rest = parts
+        if host in DOCKER_HUB_ALIASES:
+            host = DOCKER_HUB
+        return host, rest
+    return DOCKER_HUB, image
+
+
+def registry_api(name):
+    """Host serving the registry v2 API of an image name, and its repository
+
+    alpine => registry-1.docker.io, library/alpine
+    127.0.0.1:5000/org/image => 127.0.0.1:5000, org/image
+    """
+    registry, repository = split_registry(name)
+    if registry == DOCKER_HUB:
+        if '/' not in repository:
+            repository = 'library/' + repository
+        return DOCKER_HUB_API, repository
+    return registry, repository
+
+
+def registry_of(image):
+    """Registry host of a full image name, e.g. alpine => docker.io"""
+    return split_registry(image)[0]
+
+
+def _parse_quota(value):
+    """Parse a RateLimit header value like '100;w=21600'
+
+    Returns (quota, window in seconds or None).
+    """
+    match = re.match(r'\s*(\d+)\s*(?:;\s*w=(\d+))?', value or '')
+    if not match:
+        return None, None
+    window = match.group(2)
+    return int(match.group(1)), window and int(window)
+
+
+def _parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (seconds or HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, when.timestamp() - time.time())
+
+
+class TokenBucket(object):
+    """Token bucket for one registry, shared through a locked state file
+
+    The state holds the tokens available, the refill rate (tokens per
+    second, None if the registry isn't known to limit us), the capacity
+    and the time until which the registry asked us to stop.
+    """
+
+    def __init__(self, registry, state_dir=None):
+        self.registry = registry
+        state_dir = state_dir or windlass.tools.cache_dir('ratelimit')
+        self.path = os.path.join(
+            state_dir, re.sub(r'[^\w.-]', '_', registry) + '.json')
+
+    def _update(self, func):
+        """Call func(state, now) with the state locked, saving changes"""
+        with open(self.path, 'a+') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                fp.seek(0)
+                try:
+                    state = json.loads(fp.read())
+                except ValueError:
+                    state = {}
+                now = time.time()
+                rate = state.get('rate')
+                if rate:
+                    elapsed = max(0, now - state.get('updated', now))
+                    state['tokens'] = min(
+                        state['capacity'],
+                        state.get('tokens', 0) + elapsed * rate)
+                state['updated'] = now
+                result = func(state, now)
+                fp.seek(0)
+                fp.truncate()
+                fp.write(json.dumps(state))
+                return result
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def stale(self):
+        """True if the registry limits haven't been seen recently"""
+        def check(state, now):
+            return now - state.get('probed', 0) > probe_interval
+        return self._update(check)
+
+    def acquire(self):
+        """Wait until a request can be made to the registry, and take it"""
+        while True:
+            def take(state, now):
+                blocked = state.get('blocked_until', 0) - now
+                if blocked > 0:
+                    return blocked
+                if not state.get('rate'):
+                    return 0
+                if state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    return 0
+                return (1 - state['tokens']) / state['rate']
+            wait = self._update(take)
+            if not wait:
+                return
+            logging.info(
+                '%s: pacing requests to stay under rate limit, waiting '
+                '%.1f seconds', self.registry, wait)
+            time.sleep(wait)
+
+    def update_from_headers(self, headers, status_code=None):
+        """Update bucket from the headers of a registry response"""
+        limit, window = _parse_quota(headers.get('RateLimit-Limit'))
+        remaining, rwindow = _parse_quota(headers.get('RateLimit-Remaining'))
+        retry_after = _parse_retry_after(headers.get('Retry-After'))
+        if status_code == 429 and retry_after is None:
+            retry_after = default_backoff
+
+        def update(state, now):
+            state['probed'] = now
+            window_s = window or rwindow
+            if limit and window_s:
+                state['rate'] = limit / window_s
+                state['capacity'] = limit
+            if remaining is not None and state.get('rate'):
+                state['tokens'] = min(state['capacity'], remaining)
+            if retry_after is not None:
+                state['blocked_until'] = max(
+                    state.get('blocked_until', 0), now + retry_after)
+        self._update(update)
+        if retry_after is not None:
+            logging.warning(
+                '%s: rate limited, pausing requests for %d seconds',
+                self.registry, retry_after)
+
+    def rate_limited(self, retry_after=None):
+        """Record that the registry refused a request with a 429"""
+        headers = {}
+        if retry_after is not None:
+            headers['Retry-After'] = str(retry_after)
+        self.update_from_headers(headers, status_code=429)
+
+
+def for_registry(registry):
+    return TokenBucket(registry)
+
+
+def probe(bucket, image):
+    """Refresh the bucket from the registry's rate limit headers
+
+    A HEAD request on the manifest returns the rate limit headers without
+    counting as a pull on Docker Hub.
+    """
+    name, tag = windlass.tools.split_image(image)
+    registry = registry_of(name)
+    host, repository = registry_api(name)
+    client = windlass.remotes.RegistryClient(host)
+    try:
+        resp = client._request(
+            'HEAD', '/v2/%s/manifests/%s' % (repository, tag),
+            expected=(200, 404, 429),
+            headers={'Accept': ', '.join(client.manifest_types)},
+            timeout=10)
+    except Exception as e:
+        logging.debug('%s: failed to probe rate limits: %s', registry, e)
+        return
+    bucket.update_from_headers(resp.headers, resp.status_code)
+
+
+def acquire(image):
+    """Wait for the registry of image to allow a pull"""
+    bucket = for_registry(registry_of(image))
+    if bucket.stale():
+        probe(bucket, image)
+    bucket.acquire()
+    return bucket
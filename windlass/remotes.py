@@ -15,18 +15,38 @@
 #
 import base64
 import boto3
+import boto3.s3.transfer
+import botocore.config
 import botocore.exceptions
 import collections
-import docker
+import concurrent.futures
+import datetime
+import fcntl
+import hashlib
+import json
 import logging
 import os
+import re
 import requests
+import requests.auth
+import shutil
+import tempfile
+import threading
+import time
 import urllib.parse
+import uuid
+import yaml
 
 import windlass.api
+import windlass.cache
+import windlass.charts
+import windlass.daemons
 import windlass.exc
 import windlass.images
+import windlass.ratelimit
 import windlass.retry
+import windlass.tools
+import windlass.transport
 
 
 # Define an AWSCreds lightweight class, which also includes the region to use
@@ -37,6 +57,86 @@ AWSCreds = collections.namedtuple(
 # Set retry_backoff as a module-level variable to allow override for tests.
 global_retry_backoff = 5
 
+# S3 transfers are tuned through the environment, which is inherited by the
+# worker processes.
+S3_THRESHOLD_ENV = 'WINDLASS_S3_MULTIPART_THRESHOLD'
+S3_PART_SIZE_ENV = 'WINDLASS_S3_PART_SIZE'
+S3_CONCURRENCY_ENV = 'WINDLASS_S3_MAX_CONCURRENCY'
+S3_ENDPOINT_URL_ENV = 'WINDLASS_S3_ENDPOINT_URL'
+
+DEFAULT_S3_THRESHOLD = 16 * 1024 * 1024
+DEFAULT_S3_PART_SIZE = 16 * 1024 * 1024
+DEFAULT_S3_CONCURRENCY = 10
+
+# Most repository names ECR describes in one request.
+ECR_BATCH_SIZE = 100
+
+# Manifests of the images ECR is asked for, which refer to the image's config
+# by the digest docker uses as image id.
+ECR_MANIFEST_TYPES = [
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+]
+
+# ECR docker logins are valid for 12 hours, and are renewed once they
+# expire within ECR_TOKEN_MARGIN seconds, so they don't expire mid push.
+ECR_TOKEN_VALIDITY = 12 * 60 * 60
+ECR_TOKEN_MARGIN = 30 * 60
+
+# S3 clients by (pid, creds, endpoint_url).
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+# sha256 of the objects known to be in S3, by (endpoint_url, bucket, key),
+# so that unchanged objects are checked once per run.
+_s3_objects = {}
+
+
+def s3_transfer_config(threshold=None, part_size=None, concurrency=None):
+    """TransferConfig of S3 uploads and downloads
+
+    Objects larger than threshold are transferred in parts of part_size
+    bytes, up to concurrency parts at a time: uploads are multipart
+    uploads, and downloads ranged GETs.
+    """
+    return boto3.s3.transfer.TransferConfig(
+        multipart_threshold=threshold or int(os.environ.get(
+            S3_THRESHOLD_ENV, DEFAULT_S3_THRESHOLD)),
+        multipart_chunksize=part_size or int(os.environ.get(
+            S3_PART_SIZE_ENV, DEFAULT_S3_PART_SIZE)),
+        max_concurrency=concurrency or int(os.environ.get(
+            S3_CONCURRENCY_ENV, DEFAULT_S3_CONCURRENCY)),
+    )
+
+
+def get_s3_client(creds, endpoint_url=None, max_pool_connections=None):
+    """Get the S3 client of this process for the credentials
+
+    Clients are thread safe, and keep connections to S3 open between the
+    transfers of the process.
+    """
+    endpoint_url = endpoint_url or os.environ.get(S3_ENDPOINT_URL_ENV)
+    key = (os.getpid(), creds, endpoint_url)
+    with _s3_clients_lock:
+        client = _s3_clients.get(key)
+        if client is None:
+            # Drop clients inherited from the parent process.
+            for k in [k for k in _s3_clients if k[0] != key[0]]:
+                del _s3_clients[k]
+            key_id, secret_key, region = creds
+            # Enough connections for every part transferred concurrently.
+            config = botocore.config.Config(
+                max_pool_connections=max_pool_connections or max(
+                    10, s3_transfer_config().max_concurrency))
+            client = _s3_clients[key] = boto3.client(
+                's3',
+                region_name=region,
+                aws_access_key_id=key_id,
+                aws_secret_access_key=secret_key,
+                endpoint_url=endpoint_url,
+                config=config,
+            )
+        return client
+
 
 class remote_retry(windlass.retry.simple):
     """Retry decorator for AWS operations
@@ -55,6 +155,427 @@ class remote_retry(windlass.retry.simple):
             self.retry_on.update(retry_on)
 
 
+class RegistryClient(object):
+    """Docker registry v2 HTTP API client
+
+    Transfers images directly with a registry, without going through the
+    local docker daemon. Layers are transferred concurrently, uploads are
+    chunked and resumed from the last offset acknowledged by the registry,
+    and all blobs are verified against their digest.
+
+    Images are read from and written to a directory using the OCI image
+    layout, so that they can be uploaded again, copied elsewhere or loaded
+    with tools like skopeo. Images can also be copied from one registry
+    to another without touching the disk (see copy_image).
+
+    registry can include the scheme, e.g. http://registry.local for an
+    insecure registry. Like docker, registries on localhost or 127.0.0.0/8
+    are reached with http by default, others with https.
+
+    rate_limiter is a windlass.ratelimit.TokenBucket for the registry, used
+    to pace manifest fetches and updated from the rate limit headers of
+    every response.
+    """
+
+    manifest_types = [
+        'application/vnd.docker.distribution.manifest.v2+json',
+        'application/vnd.docker.distribution.manifest.list.v2+json',
+        'application/vnd.oci.image.manifest.v1+json',
+        'application/vnd.oci.image.index.v1+json',
+    ]
+    # Manifests which reference other manifests rather than blobs.
+    index_types = [
+        'application/vnd.docker.distribution.manifest.list.v2+json',
+        'application/vnd.oci.image.index.v1+json',
+    ]
+
+    def __init__(self, registry, username=None, password=None,
+                 max_workers=4, chunk_size=16 * 1024 * 1024,
+                 max_resumes=3, verify='/etc/ssl/certs', rate_limiter=None):
+        if '://' not in registry:
+            host = registry.split('/')[0].rsplit(':', 1)[0]
+            if host == 'localhost' or host.startswith('127.'):
+                registry = 'http://' + registry
+            else:
+                registry = 'https://' + registry
+        self.base_url = registry.rstrip('/')
+        self.username = username
+        self.password = password
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.max_resumes = max_resumes
+        self.verify = verify
+        self.rate_limiter = rate_limiter
+        self.session = windlass.transport.get_session()
+        # Bearer tokens, by the scope they were issued for.
+        self._tokens = {}
+        self._token_lock = threading.Lock()
+        # Authorization header to send, by repository.
+        self._auth = {}
+
+    def __str__(self):
+        return self.base_url
+
+    def __getstate__(self):
+        # Passed to the workers along with the images downloaded with it.
+        state = dict(self.__dict__)
+        del state['session'], state['_token_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.session = windlass.transport.get_session()
+        self._token_lock = threading.Lock()
+
+    def _error(self, msg, resp=None):
+        errors = [msg]
+        if resp is not None:
+            errors.append('%s %s: %s' % (
+                resp.status_code, resp.reason, resp.text[:1024]))
+        return windlass.exc.WindlassPushPullException(
+            '%s: %s' % (self, msg), out=[], errors=errors)
+
+    def _get_token(self, challenge, stale=None):
+        """Bearer token for the challenge
+
+        Tokens are reused until they expire, or until a request made with
+        the token stale is refused.
+        """
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop('realm')
+        key = (params.get('service'), params.get('scope'))
+        with self._token_lock:
+            token, expires = self._tokens.get(key, (None, 0))
+            if token is None or token == stale or expires <= time.time():
+                auth = None
+                if self.username is not None:
+                    auth = requests.auth.HTTPBasicAuth(
+                        self.username, self.password)
+                now = time.time()
+                resp = self.session.get(
+                    realm, params=params, auth=auth, verify=self.verify)
+                if resp.status_code != 200:
+                    raise self._error(
+                        'Failed to get token from %s' % realm, resp)
+                data = resp.json()
+                token = data.get('token') or data.get('access_token')
+                issued = now
+                if data.get('issued_at'):
+                    try:
+                        issued = min(now, datetime.datetime.fromisoformat(
+                            data['issued_at'].replace('Z', '+00:00')
+                        ).timestamp())
+                    except ValueError:
+                        pass
+                # Tokens without expires_in are valid for 60 seconds.
+                expires = issued + int(data.get('expires_in') or 60)
+                self._tokens[key] = (token, expires)
+        return token
+
+    def _send(self, method, url, **kwargs):
+        if self.rate_limiter and method == 'GET' and '/manifests/' in url:
+            # Manifest fetches are what registries count as pulls.
+            self.rate_limiter.acquire()
+        resp = self.session.request(method, url, verify=self.verify, **kwargs)
+        if self.rate_limiter:
+            self.rate_limiter.update_from_headers(
+                resp.headers, resp.status_code)
+        return resp
+
+    def _request(self, method, path, expected=(200,), **kwargs):
+        """Make a request, authenticating when challenged by the registry
+
+        Credentials that worked for a repository are sent up front on
+        later requests for it, saving the round trip to get challenged.
+        """
+        url = path if '://' in path else self.base_url + path
+        match = re.search(r'/v2/(.+)/(manifests|blobs)/', url)
+        repository = match and match.group(1)
+        headers = kwargs.pop('headers', {})
+        if repository in self._auth:
+            headers['Authorization'] = self._auth[repository]
+        resp = self._send(method, url, headers=headers, **kwargs)
+        if resp.status_code == 401:
+            challenge = resp.headers.get('WWW-Authenticate', '')
+            if challenge.lower().startswith('bearer'):
+                # The token sent, if any, has expired or been revoked.
+                sent = headers.get('Authorization', '')
+                stale = sent[len('Bearer '):] if sent.startswith(
+                    'Bearer ') else None
+                headers['Authorization'] = 'Bearer %s' % self._get_token(
+                    challenge, stale)
+            else:
+                headers['Authorization'] = requests.auth._basic_auth_str(
+                    self.username or '', self.password or '')
+            self._auth[repository] = headers['Authorization']
+            resp = self._send(method, url, headers=headers, **kwargs)
+        if resp.status_code not in expected:
+            raise self._error('%s %s failed' % (method, url), resp)
+        return resp
+
+    def get_manifest(self, repository, reference):
+        """Returns manifest body, media type and digest for reference"""
+        resp = self._request(
+            'GET', '/v2/%s/manifests/%s' % (repository, reference),
+            headers={'Accept': ', '.join(self.manifest_types)})
+        body = resp.content
+        digest = 'sha256:' + hashlib.sha256(body).hexdigest()
+        remote_digest = resp.headers.get('Docker-Content-Digest')
+        if remote_digest and remote_digest != digest:
+            raise self._error(
+                'Digest mismatch for manifest %s:%s (%s != %s)' % (
+                    repository, reference, remote_digest, digest))
+        if reference.startswith('sha256:') and reference != digest:
+            raise self._error(
+                'Digest mismatch for manifest %s@%s' % (
+                    repository, reference))
+        media_type = resp.headers.get('Content-Type', '').split(';')[0]
+        return body, media_type, digest
+
+    def put_manifest(self, repository, reference, body, media_type):
+        self._request(
+            'PUT', '/v2/%s/manifests/%s' % (repository, reference),
+            expected=(201,), data=body,
+            headers={'Content-Type': media_type})
+        return 'sha256:' + hashlib.sha256(body).hexdigest()
+
+    def blob_exists(self, repository, digest):
+        resp = self._request(
+            'HEAD', '/v2/%s/blobs/%s' % (repository, digest),
+            expected=(200, 404))
+        return resp.status_code == 200
+
+    def download_blob(self, repository, digest, fp):
+        """Stream blob into the file object fp, verifying its digest"""
+        resp = self._request(
+            'GET', '/v2/%s/blobs/%s' % (repository, digest), stream=True)
+        sha = hashlib.sha256()
+        try:
+            for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                sha.update(chunk)
+                fp.write(chunk)
+        finally:
+            resp.close()
+        if 'sha256:' + sha.hexdigest() != digest:
+            raise self._error(
+                'Digest mismatch downloading blob %s from %s' % (
+                    digest, repository))
+
+    def _upload_offset(self, location):
+        """Ask the registry how much of an upload it has received"""
+        resp = self._request('GET', location, expected=(204,))
+        # Range is inclusive, 0-0 is also returned for an empty upload.
+        end = int(resp.headers.get('Range', '0-0').split('-')[1])
+        return end + 1 if end else 0, resp.headers.get('Location', location)
+
+    def _absolute(self, location):
+        return urllib.parse.urljoin(self.base_url + '/', location)
+
+    def start_upload(self, repository, digest=None, mount_from=None):
+        """Start a blob upload, returns the upload location
+
+        mount_from is a repository on the same registry containing the
+        blob digest. If the registry supports cross repository mounts the
+        blob is mounted instead of uploaded and None is returned.
+        """
+        params = {}
+        if mount_from:
+            params = {'mount': digest, 'from': mount_from}
+        resp = self._request(
+            'POST', '/v2/%s/blobs/uploads/' % repository,
+            expected=(201, 202), params=params)
+        if resp.status_code == 201:
+            logging.debug('%s: Mounted %s from %s', repository, digest,
+                          mount_from)
+            return None
+        return self._absolute(resp.headers['Location'])
+
+    def upload_blob(self, repository, digest, fp, location=None):
+        """Upload blob from the seekable file object fp
+
+        The blob is uploaded in chunks of chunk_size. If sending a chunk
+        fails the upload resumes from the offset the registry has received.
+        """
+        if location is None:
+            location = self.start_upload(repository)
+        sha = hashlib.sha256()
+        offset = 0
+        resumes = 0
+        fp.seek(0)
+        while True:
+            chunk = fp.read(self.chunk_size)
+            if not chunk:
+                break
+            try:
+                resp = self._request(
+                    'PATCH', location, expected=(202,), data=chunk,
+                    headers={
+                        'Content-Type': 'application/octet-stream',
+                        'Content-Range': '%d-%d' % (
+                            offset, offset + len(chunk) - 1),
+                    })
+            except (requests.exceptions.ConnectionError,
+                    windlass.exc.WindlassPushPullException):
+                resumes += 1
+                if resumes > self.max_resumes:
+                    raise
+                offset, location = self._upload_offset(location)
+                location = self._absolute(location)
+                logging.info('%s: Resuming upload of %s at %d',
+                             repository, digest, offset)
+                # Recalculate the digest of what the registry has.
+                fp.seek(0)
+                sha = hashlib.sha256()
+                remaining = offset
+                while remaining:
+                    data = fp.read(min(remaining, self.chunk_size))
+                    if not data:
+                        break
+                    sha.update(data)
+                    remaining -= len(data)
+                continue
+            sha.update(chunk)
+            offset += len(chunk)
+            location = self._absolute(resp.headers.get('Location', location))
+
+        if 'sha256:' + sha.hexdigest() != digest:
+            raise self._error(
+                'Digest mismatch uploading blob %s to %s' % (
+                    digest, repository))
+        self._request(
+            'PUT', location, expected=(201,), params={'digest': digest},
+            headers={'Content-Length': '0'})
+
+    def _referenced(self, body, media_type):
+        """Returns blobs and child manifests referenced by a manifest"""
+        manifest = json.loads(body.decode('utf-8'))
+        if media_type in self.index_types:
+            return [], manifest['manifests']
+        return [manifest['config']] + manifest['layers'], []
+
+    def _map(self, func, items):
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            # Evaluate all to raise the first exception.
+            return list(pool.map(func, items))
+
+    @staticmethod
+    def _blob_path(layout_dir, digest):
+        algorithm, hexdigest = digest.split(':', 1)
+        return os.path.join(layout_dir, 'blobs', algorithm, hexdigest)
+
+    def pull(self, repository, reference, layout_dir):
+        """Download an image into an OCI image layout directory
+
+        Returns the manifest digest.
+        """
+        os.makedirs(os.path.join(layout_dir, 'blobs', 'sha256'),
+                    exist_ok=True)
+
+        def fetch_blob(desc):
+            path = self._blob_path(layout_dir, desc['digest'])
+            if os.path.exists(path):
+                return
+            with open(path + '.part', 'wb') as fp:
+                self.download_blob(repository, desc['digest'], fp)
+            os.rename(path + '.part', path)
+
+        def fetch_manifest(ref):
+            body, media_type, digest = self.get_manifest(repository, ref)
+            with open(self._blob_path(layout_dir, digest), 'wb') as fp:
+                fp.write(body)
+            blobs, children = self._referenced(body, media_type)
+            self._map(fetch_blob, blobs)
+            for child in children:
+                fetch_manifest(child['digest'])
+            return body, media_type, digest
+
+        body, media_type, digest = fetch_manifest(reference)
+        with open(os.path.join(layout_dir, 'oci-layout'), 'w') as fp:
+            json.dump({'imageLayoutVersion': '1.0.0'}, fp)
+        with open(os.path.join(layout_dir, 'index.json'), 'w') as fp:
+            json.dump({
+                'schemaVersion': 2,
+                'manifests': [{
+                    'mediaType': media_type,
+                    'digest': digest,
+                    'size': len(body),
+                    'annotations': {
+                        'org.opencontainers.image.ref.name': reference,
+                    },
+                }],
+            }, fp)
+        logging.info('Pulled %s/%s:%s', self, repository, reference)
+        return digest
+
+    def push(self, repository, reference, layout_dir):
+        """Upload an image from an OCI image layout directory
+
+        Returns the manifest digest.
+        """
+        with open(os.path.join(layout_dir, 'index.json')) as fp:
+            top = json.load(fp)['manifests'][0]
+
+        def send_blob(desc):
+            if self.blob_exists(repository, desc['digest']):
+                return
+            with open(self._blob_path(layout_dir, desc['digest']),
+                      'rb') as fp:
+                self.upload_blob(repository, desc['digest'], fp)
+
+        def send_manifest(desc, ref):
+            with open(self._blob_path(layout_dir, desc['digest']),
+                      'rb') as fp:
+                body = fp.read()
+            blobs, children = self._referenced(body, desc['mediaType'])
+            self._map(send_blob, blobs)
+            for child in children:
+                send_manifest(child, child['digest'])
+            return self.put_manifest(repository, ref, body, desc['mediaType'])
+
+        digest = send_manifest(top, reference)
+        logging.info('Pushed %s/%s:%s', self, repository, reference)
+        return digest
+
+    def copy_image(self, source, source_repository, source_reference,
+                   repository, reference=None):
+        """Copy (promote) an image from the source client to this registry
+
+        Blobs already present are skipped, blobs on the same registry are
+        mounted and other blobs are spooled through a temporary file.
+        Returns the manifest digest.
+        """
+        reference = reference or source_reference
+        same_registry = source.base_url == self.base_url
+
+        def copy_blob(desc):
+            if self.blob_exists(repository, desc['digest']):
+                return
+            location = self.start_upload(
+                repository, desc['digest'],
+                mount_from=source_repository if same_registry else None)
+            if location is None:
+                return
+            with tempfile.TemporaryFile() as fp:
+                source.download_blob(source_repository, desc['digest'], fp)
+                self.upload_blob(
+                    repository, desc['digest'], fp, location=location)
+
+        def copy_manifest(ref, dest_ref):
+            body, media_type, digest = source.get_manifest(
+                source_repository, ref)
+            blobs, children = self._referenced(body, media_type)
+            self._map(copy_blob, blobs)
+            for child in children:
+                copy_manifest(child['digest'], child['digest'])
+            return self.put_manifest(repository, dest_ref, body, media_type)
+
+        digest = copy_manifest(source_reference, reference)
+        logging.info('Copied %s/%s:%s to %s/%s:%s', source,
+                     source_repository, source_reference, self, repository,
+                     reference)
+        return digest
+
+
 class DockerConnector(object):
     """Interface with a remote docker registry.
 
@@ -71,11 +592,18 @@ class DockerConnector(object):
         else:
             self.registry_list = registry_list
 
+    def prepare(self, images):
+        """Prepare to upload images, before the workers upload them
+
+        images are the (upload_name, upload_tag) pairs of the images of a
+        run. Called in the parent process, so anything looked up here is
+        passed to the workers, which needn't each look it up.
+        """
+
     @remote_retry()
     def upload(self, local_name, upload_name=None, upload_tag=None):
+        dcli = windlass.daemons.acquire_for_image(local_name)
         try:
-            dcli = docker.from_env(version='auto')
-
             if self.username is not None:
                 auth_config = {
                     'username': self.username,
@@ -105,11 +633,56 @@ class DockerConnector(object):
             finally:
                 dcli.api.remove_image(upload_url)
         finally:
-            dcli.close()
+            windlass.daemons.release(dcli)
 
     def download_docker(self, image_name):
         pass
 
+    def get_registry_client(self, index=0, **kwargs):
+        """Registry v2 client for one of the registries, using our creds"""
+        return RegistryClient(
+            self.registry_list[index], self.username, self.password, **kwargs)
+
+    def _upload_client(self, upload_name):
+        """Registry v2 client to upload upload_name with, and its repository
+
+        The upload registry can include a path, prepended to upload_name.
+        """
+        host, repository = windlass.ratelimit.registry_api(
+            '%s/%s' % (self.registry_list[0], upload_name))
+        return (RegistryClient(host, self.username, self.password),
+                repository)
+
+    @remote_retry()
+    def copy_image(self, source, upload_name, upload_tag):
+        """Copy an image from a registry, without the docker daemon
+
+        source is the (RegistryClient, repository, reference) of the image,
+        e.g. where Image.download found it. Blobs are mounted when the image
+        is in the same registry. Used to promote images.
+        """
+        client, repository = self._upload_client(upload_name)
+        source_client, source_repository, source_reference = source
+        if source_client.base_url == client.base_url:
+            # Our credentials, to mount the blobs.
+            source_client = client
+        client.copy_image(source_client, source_repository, source_reference,
+                          repository, upload_tag)
+        upload_url = '%s/%s:%s' % (
+            self.registry_list[0], upload_name, upload_tag)
+        logging.info('%s: Copied as %s', source_repository, upload_url)
+        return upload_url
+
+    @remote_retry()
+    def push_layout(self, layout_dir, upload_name, upload_tag):
+        """Push the image in an OCI image layout, without the docker daemon"""
+        client, repository = self._upload_client(upload_name)
+        client.push(repository, upload_tag, layout_dir)
+        upload_url = '%s/%s:%s' % (
+            self.registry_list[0], upload_name, upload_tag)
+        logging.info('%s: Pushed as %s', layout_dir, upload_url)
+        return upload_url
+
 
 class ECRConnector(DockerConnector):
     """Interface with an ECR registry
@@ -159,10 +732,15 @@ class ECRConnector(DockerConnector):
         # Allow for specifying a test ECR client, for running tests.
         self._ecrc = ecrc
 
-        self._existing_repos = None
+        # Repositories known to exist, out of those looked up.
+        self._existing_repos = set()
+        self._checked_repos = set()
+        # Config digests of the images in the registry by (repository, tag),
+        # None for images looked up and not found.
+        self._registry_images = {}
 
-        reg, user, passwd = self._docker_login()
-        super().__init__([reg], user, passwd)
+        # Docker login, obtained when first used. See _get_token.
+        self._token = None
 
     def get_ecrc(self):
         return boto3.client(
@@ -187,39 +765,224 @@ class ECRConnector(DockerConnector):
     def _docker_login(self):
         """Get a docker login for the ECR registry
 
-        Returns a <registry>, <username>, <password> 3-tuple.
+        Returns a dict of the registry, username, password and the time the
+        login expires at, in seconds since the epoch.
         """
-        # Since _docker_login is called in __init__ we can't access
-        # the self.ecrc property here as it will persist the ECR client
-        # on this object making it non-pickleable
+        # Called before the connector is passed to the workers, so we can't
+        # access the self.ecrc property here as it will persist the ECR
+        # client on this object making it non-pickleable
         resp = (self._ecrc or self.get_ecrc()).get_authorization_token()
-        docker_reg_url = resp['authorizationData'][0]['proxyEndpoint']
-        registry = urllib.parse.urlparse(docker_reg_url)[1]
-        up = base64.b64decode(
-            resp['authorizationData'][0]['authorizationToken']
-        ).decode("utf-8")
+        data = resp['authorizationData'][0]
+        registry = urllib.parse.urlparse(data['proxyEndpoint'])[1]
+        up = base64.b64decode(data['authorizationToken']).decode("utf-8")
         username, password = up.split(':', 1)
+        if 'expiresAt' in data:
+            expires = data['expiresAt'].timestamp()
+        else:
+            expires = time.time() + ECR_TOKEN_VALIDITY
         logging.info("AWS Docker token obtained for registry %s", registry)
-        return registry, username, password
-
-    def _list_existing_repos(self):
-        paginator = self.ecrc.get_paginator('describe_repositories')
-        existing_repos = set()
-        for page in paginator.paginate():
-            existing_repos.update(
-                set(r['repositoryName'] for r in page['repositories'])
-            )
-        return existing_repos
+        return {
+            'registry': registry,
+            'username': username,
+            'password': password,
+            'expires': expires,
+        }
+
+    def _token_path(self):
+        """Path of the cached docker login, None if not cached on disk"""
+        if self.creds is None:
+            return None
+        dirname = windlass.tools.cache_dir('ecr-tokens')
+        os.chmod(dirname, 0o700)
+        # A digest, to keep the key id and secret out of the file name.
+        key = windlass.cache.make_key(
+            self.creds.key_id, self.creds.secret_key, self.creds.region)
+        return os.path.join(dirname, key + '.json')
+
+    @staticmethod
+    def _valid_token(token):
+        return (token is not None and
+                token['expires'] > time.time() + ECR_TOKEN_MARGIN)
+
+    @staticmethod
+    def _read_token(path):
+        try:
+            with open(path) as fp:
+                return json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _get_token(self):
+        """Docker login for the registry, obtained once for all processes
+
+        Logins are cached on disk until shortly before they expire, readable
+        only by the user.
+        """
+        if self._valid_token(self._token):
+            return self._token
+        path = self._token_path()
+        if path is None:
+            self._token = self._docker_login()
+            return self._token
+        token = self._read_token(path)
+        if not self._valid_token(token):
+            # One process logs in, the others wait for its token.
+            with open(path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    token = self._read_token(path)
+                    if not self._valid_token(token):
+                        token = self._docker_login()
+                        with windlass.tools.atomic_open(path, 0o600) as fp:
+                            fp.write(json.dumps(token).encode('utf-8'))
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        self._token = token
+        return token
 
     @property
-    def existing_repos(self):
-        if self._existing_repos is None:
-            self._existing_repos = self._list_existing_repos()
+    def registry_list(self):
+        return [self._get_token()['registry']]
+
+    @property
+    def username(self):
+        return self._get_token()['username']
 
+    @property
+    def password(self):
+        return self._get_token()['password']
+
+    def _describe_repositories(self, ecrc, names):
+        """Names of the repositories that exist among names
+
+        describe_repositories fails for the whole request when any of the
+        names doesn't exist, so failing requests are split in two until
+        the missing repositories are found.
+        """
+        if not names:
+            return set()
+        try:
+            resp = ecrc.describe_repositories(repositoryNames=names)
+        except ecrc.exceptions.RepositoryNotFoundException:
+            if len(names) == 1:
+                return set()
+            half = len(names) // 2
+            return (self._describe_repositories(ecrc, names[:half]) |
+                    self._describe_repositories(ecrc, names[half:]))
+        return set(r['repositoryName'] for r in resp['repositories'])
+
+    def find_existing_repos(self, names, ecrc=None):
+        """Names of the repositories that exist among names
+
+        Looks up ECR_BATCH_SIZE repositories per request.
+        """
+        # Not using the ecrc property, which would make the connector
+        # non-pickleable when called before it's passed to the workers.
+        ecrc = ecrc or self._ecrc or self.get_ecrc()
+        names = sorted(set(names))
+        existing = set()
+        for i in range(0, len(names), ECR_BATCH_SIZE):
+            existing |= self._describe_repositories(
+                ecrc, names[i:i + ECR_BATCH_SIZE])
+        return existing
+
+    def prepare(self, images):
+        try:
+            images = [(self.path_prefixes[0] + name, tag)
+                      for name, tag in images]
+            self.check_repos(name for name, tag in images)
+            self.check_images(images)
+        except botocore.exceptions.ClientError as e:
+            # The workers look them up as they upload.
+            logging.warning('Failed to look up ECR images: %s', e)
+
+    def check_repos(self, names):
+        """Look up which of the repositories names exist
+
+        Called by prepare for the images of a run, so the workers don't
+        need to look them up as they upload.
+        """
+        names = set(names) - self._checked_repos
+        self._existing_repos |= self.find_existing_repos(names)
+        self._checked_repos |= names
+
+    @property
+    def existing_repos(self):
         return self._existing_repos
 
+    def find_images(self, repository, tags, ecrc=None):
+        """Config digests of the images of repository tagged tags, by tag
+
+        Looks up ECR_BATCH_SIZE tags per request. The config digest is the
+        image id docker gives the image. Tags not in the repository, or of
+        manifest lists, are left out.
+        """
+        ecrc = ecrc or self._ecrc or self.get_ecrc()
+        tags = sorted(set(tags))
+        digests = {}
+        for i in range(0, len(tags), ECR_BATCH_SIZE):
+            resp = ecrc.batch_get_image(
+                repositoryName=repository,
+                imageIds=[
+                    {'imageTag': tag} for tag in tags[i:i + ECR_BATCH_SIZE]
+                ],
+                acceptedMediaTypes=ECR_MANIFEST_TYPES,
+            )
+            for image in resp['images']:
+                manifest = json.loads(image['imageManifest'])
+                digest = manifest.get('config', {}).get('digest')
+                if digest:
+                    digests[image['imageId']['imageTag']] = digest
+        return digests
+
+    def check_images(self, images, ecrc=None):
+        """Look up which of the images are in the registry
+
+        images are (repository, tag) pairs. Called by prepare for the images
+        of a run, after check_repos, so the workers don't need to look them
+        up before pushing.
+        """
+        by_repo = collections.defaultdict(set)
+        for repository, tag in images:
+            if (repository, tag) not in self._registry_images:
+                by_repo[repository].add(tag)
+        for repository, tags in sorted(by_repo.items()):
+            digests = {}
+            if (repository not in self._checked_repos or
+                    repository in self._existing_repos):
+                ecrc = ecrc or self._ecrc or self.get_ecrc()
+                try:
+                    digests = self.find_images(repository, tags, ecrc)
+                    self._existing_repos.add(repository)
+                    self._checked_repos.add(repository)
+                except ecrc.exceptions.RepositoryNotFoundException:
+                    self._checked_repos.add(repository)
+                except botocore.exceptions.ClientError as e:
+                    # Pushed regardless, e.g. when not allowed to pull.
+                    logging.warning('Failed to look up images of %s: %s',
+                                    repository, e)
+            for tag in tags:
+                self._registry_images[(repository, tag)] = digests.get(tag)
+
+    def _in_registry(self, local_name, repository, tag):
+        """Whether repository:tag in the registry is the local image"""
+        if (repository, tag) not in self._registry_images:
+            self.check_images([(repository, tag)], self.ecrc)
+        digest = self._registry_images[(repository, tag)]
+        if digest is None:
+            return False
+        dcli = windlass.daemons.acquire_for_image(local_name)
+        try:
+            return dcli.images.get(local_name).id == digest
+        finally:
+            windlass.daemons.release(dcli)
+
     def _create_repo_if_new(self, image_name):
-        if image_name in self.existing_repos:
+        if image_name not in self._checked_repos:
+            self._existing_repos |= self.find_existing_repos(
+                [image_name], self.ecrc)
+            self._checked_repos.add(image_name)
+        if image_name in self._existing_repos:
             return
 
         # The retry exception is defined within the client so declaring this
@@ -257,18 +1020,48 @@ class ECRConnector(DockerConnector):
         if upload_name is None:
             upload_name = local_image_name
         upload_path = self.path_prefixes[0] + upload_name
+        tag = upload_tag or local_image_tag
 
+        if self._in_registry(local_name, upload_path, tag):
+            upload_url = '%s/%s:%s' % (self.registry_list[0], upload_path, tag)
+            logging.info('%s: Already pushed as %s', local_name, upload_url)
+            return upload_url
         self._create_repo_if_new(upload_path)
         return super().upload(local_name, upload_path, upload_tag)
 
+    def copy_image(self, source, upload_name, upload_tag):
+        upload_path = self.path_prefixes[0] + upload_name
+        self._create_repo_if_new(upload_path)
+        return super().copy_image(source, upload_path, upload_tag)
+
+    def push_layout(self, layout_dir, upload_name, upload_tag):
+        upload_path = self.path_prefixes[0] + upload_name
+        self._create_repo_if_new(upload_path)
+        return super().push_layout(layout_dir, upload_path, upload_tag)
+
 
 class S3Connector(object):
-    def __init__(self, creds, bucket, path_prefix=None):
+    """Transfers objects with an S3 bucket
+
+    transfer_config is the boto3 TransferConfig of uploads and downloads,
+    see s3_transfer_config().
+    """
+
+    def __init__(self, creds, bucket, path_prefix=None, transfer_config=None,
+                 endpoint_url=None):
         self.creds = creds
         self.bucket = bucket
         self.path_prefix = path_prefix or ''
+        self.transfer_config = transfer_config or s3_transfer_config()
+        self.endpoint_url = endpoint_url
         self._s3c = None
 
+    def __getstate__(self):
+        # boto3 clients can't be pickled, the workers get their own.
+        state = self.__dict__.copy()
+        state['_s3c'] = None
+        return state
+
     def _obj_url(self, upload_name):
         return 'https://%s.s3.amazonaws.com/%s%s' % (
             self.bucket, self.path_prefix, upload_name
@@ -277,21 +1070,157 @@ class S3Connector(object):
     @property
     def s3c(self):
         if not self._s3c:
-            key_id, secret_key, region = self.creds
-            self._s3c = boto3.client(
-                's3',
-                region_name=region,
-                aws_access_key_id=key_id,
-                aws_secret_access_key=secret_key,
-            )
+            self._s3c = get_s3_client(
+                self.creds, self.endpoint_url,
+                max(10, self.transfer_config.max_concurrency))
         return self._s3c
 
+    def _unchanged(self, key, sha256, md5):
+        """Whether the object at key already has the content hashed
+
+        Objects uploaded by windlass have the sha256 of their content in
+        their metadata. For others only objects uploaded in a single part
+        can be compared, as their ETag is the MD5 of their content.
+        """
+        cache_key = (self.s3c.meta.endpoint_url, self.bucket, key)
+        if _s3_objects.get(cache_key) == sha256:
+            return True
+        try:
+            head = self.s3c.head_object(Bucket=self.bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            # Without s3:GetObject on the bucket, HEAD is forbidden rather
+            # than not found, and the object is uploaded regardless.
+            if e.response['Error']['Code'] not in (
+                    'NoSuchKey', '404', '403', 'AccessDenied', 'Forbidden'):
+                raise
+            return False
+        remote_sha256 = head.get('Metadata', {}).get('sha256')
+        if remote_sha256:
+            unchanged = remote_sha256 == sha256
+        else:
+            unchanged = head['ETag'].strip('"') == md5
+        if unchanged:
+            _s3_objects[cache_key] = sha256
+        return unchanged
+
     def upload(self, upload_name, stream):
         key = self.path_prefix + upload_name
-        logging.info("Upload to s3://%s/%s", self.bucket, key)
-        self.s3c.upload_fileobj(stream, self.bucket, key)
+        spool = None
+        if not getattr(stream, 'seekable', lambda: False)():
+            # The content is hashed before it's uploaded.
+            spool = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+            shutil.copyfileobj(stream, spool)
+            spool.seek(0)
+            stream = spool
+        try:
+            start = stream.tell()
+            sha256 = hashlib.sha256()
+            md5 = hashlib.md5(usedforsecurity=False)
+            for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+                sha256.update(chunk)
+                md5.update(chunk)
+            stream.seek(start)
+            sha256 = sha256.hexdigest()
+
+            if self._unchanged(key, sha256, md5.hexdigest()):
+                logging.info("s3://%s/%s is up to date", self.bucket, key)
+                return self._obj_url(upload_name)
+
+            logging.info("Upload to s3://%s/%s", self.bucket, key)
+            self.s3c.upload_fileobj(
+                stream, self.bucket, key, Config=self.transfer_config,
+                ExtraArgs={'Metadata': {'sha256': sha256}})
+            _s3_objects[
+                (self.s3c.meta.endpoint_url, self.bucket, key)] = sha256
+        finally:
+            if spool:
+                spool.close()
         return self._obj_url(upload_name)
 
+    def download(self, upload_name, path):
+        """Download an object to path
+
+        Large objects are downloaded in parts, with concurrent ranged GETs.
+        """
+        key = self.path_prefix + upload_name
+        logging.info("Download s3://%s/%s to %s", self.bucket, key, path)
+        # The object is written to a temporary file, renamed once complete.
+        self.s3c.download_file(
+            self.bucket, key, path, Config=self.transfer_config)
+        return path
+
+    def upload_chart(self, upload_name, stream):
+        """Upload a chart, returning its URL and helm index entry"""
+        with tempfile.SpooledTemporaryFile(
+                max_size=16 * 1024 * 1024) as fp:
+            shutil.copyfileobj(stream, fp)
+            fp.seek(0)
+            entry = windlass.charts.index_entry(
+                fp, self._obj_url(upload_name))
+            return self.upload(upload_name, fp), entry
+
+    def _supports(self, operation, param):
+        model = self.s3c.meta.service_model.operation_model(operation)
+        return param in model.input_shape.members
+
+    def update_chart_index(self, entries, attempts=5):
+        """Add entries to the helm repository index.yaml in the bucket
+
+        The index is read, updated and written back only if it didn't
+        change in between, checked with its ETag, and this is tried again
+        if another update got in first.
+
+        botocore before 1.35 can't make conditional writes, so the ETag is
+        instead compared just before writing. Another update landing in
+        between the two can then be lost.
+        """
+        key = self.path_prefix + 'index.yaml'
+        conditional = self._supports('PutObject', 'IfMatch')
+        for attempt in range(attempts):
+            try:
+                resp = self.s3c.get_object(Bucket=self.bucket, Key=key)
+                etag = resp['ETag']
+                index = yaml.load(resp['Body'].read(), Loader=yaml.SafeLoader)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                    raise
+                etag = index = None
+
+            index = windlass.charts.merge_index(index, entries)
+            body = yaml.safe_dump(index, default_flow_style=False)
+
+            kwargs = {}
+            if conditional:
+                if etag:
+                    kwargs['IfMatch'] = etag
+                else:
+                    kwargs['IfNoneMatch'] = '*'
+            elif etag:
+                # Older botocore, compare the ETag just before writing.
+                current = self.s3c.head_object(Bucket=self.bucket, Key=key)
+                if current['ETag'] != etag:
+                    logging.debug('s3://%s/%s changed, retrying',
+                                  self.bucket, key)
+                    continue
+            try:
+                self.s3c.put_object(
+                    Bucket=self.bucket, Key=key, Body=body.encode('utf-8'),
+                    ContentType='application/x-yaml', **kwargs)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in (
+                        'PreconditionFailed', 'ConditionalRequestConflict',
+                        '412', '409'):
+                    raise
+                logging.debug('s3://%s/%s changed, retrying',
+                              self.bucket, key)
+                continue
+            logging.info('Added %d charts to s3://%s/%s', len(entries),
+                         self.bucket, key)
+            return
+        raise windlass.exc.RetryableFailure(
+            'Failed to update s3://%s/%s after %d attempts' % (
+                self.bucket, key, attempts))
+
 
 class HTTPBasicAuthConnector(object):
     def __init__(self, url, username, password):
@@ -300,9 +1229,7 @@ class HTTPBasicAuthConnector(object):
         self.password = password
 
     def upload(self, upload_name, stream, properties={}):
-        auth = requests.auth.HTTPBasicAuth(
-            self.username, self.password
-        )
+        session = windlass.transport.get_session(self.username, self.password)
 
         upload_url = os.path.join(self.base_url, upload_name)
         logging.info("Upload to %s" % upload_url)
@@ -310,11 +1237,24 @@ class HTTPBasicAuthConnector(object):
         props = ';'.join(['%s=%s' % (k, v) for k, v in properties.items()])
         if props:
             upload_url = '%s;%s' % (upload_url, props)
-        resp = requests.put(
-            upload_url,
-            data=stream,
-            auth=auth,
-            verify='/etc/ssl/certs')
+
+        seekable = getattr(stream, 'seekable', lambda: False)()
+        spool = None
+        if not seekable:
+            # Checksums are needed before the upload.
+            spool = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+            shutil.copyfileobj(stream, spool)
+            spool.seek(0)
+            stream = spool
+        try:
+            headers = windlass.transport.checksum_headers(stream)
+            if windlass.transport.checksum_deploy(
+                    session, upload_url, headers):
+                return upload_url
+            resp = session.put(upload_url, data=stream, headers=headers)
+        finally:
+            if spool:
+                spool.close()
         if resp.status_code in (
                 requests.codes.unauthorized, requests.codes.forbidden):
             # No retries in this case.
@@ -350,7 +1290,8 @@ class HTTPBasicAuthConnector2Phase(HTTPBasicAuthConnector):
             # final location.
             # TODO(kerrin) make this configurable
             check_url = os.path.join(self.base_url, upload_name)
-            check_resp = requests.head(check_url, verify='/etc/ssl/certs')
+            check_resp = windlass.transport.get_session(
+                self.username, self.password).head(check_url)
             if check_resp.ok:
                 raise Exception('Artifact %s already exists' % check_url)
 
@@ -372,6 +1313,9 @@ class AWSRemote(windlass.api.Remote):
         self.signature_connector = None
         self.generic_connector = None
         self.charts_connector = None
+        # Directory the workers leave index entries of uploaded charts in,
+        # during Windlass.run.
+        self.chart_index_spool = None
 
     def __str__(self):
         return "AWSRemote(region=%s, key_id=%s)" % (
@@ -414,11 +1358,47 @@ class AWSRemote(windlass.api.Remote):
         self.charts_connector = S3Connector(self.creds, bucket, prefix)
 
     def upload_chart(self, name, stream, properties={}):
+        if not self.charts_connector:
+            raise windlass.api.NoValidRemoteError(
+                "No %s connector configured for charts" % self)
+        # Ignore properties for AWS
+        url, entry = self.charts_connector.upload_chart(name, stream)
+        if entry is None:
+            return url
+        if self.chart_index_spool:
+            # Added to the index all at once by finalize.
+            path = os.path.join(
+                self.chart_index_spool, '%s.json' % uuid.uuid4().hex)
+            with windlass.tools.atomic_open(path) as fp:
+                fp.write(json.dumps(entry, default=str).encode('utf-8'))
+        else:
+            self.charts_connector.update_chart_index([entry])
+        return url
+
+    def prepare(self, artifacts):
+        if self.ecr:
+            self.ecr.prepare(
+                (artifact.imagename, artifact.version)
+                for artifact in artifacts
+                if isinstance(artifact, windlass.images.Image))
         if self.charts_connector:
-            # Ignore properties for AWS
-            return self.charts_connector.upload(name, stream)
-        raise windlass.api.NoValidRemoteError(
-            "No %s connector configured for charts" % self)
+            self.chart_index_spool = tempfile.mkdtemp(
+                prefix='windlass-chart-index-')
+
+    def finalize(self):
+        spool, self.chart_index_spool = self.chart_index_spool, None
+        if not spool:
+            return
+        try:
+            entries = []
+            for filename in sorted(os.listdir(spool)):
+                if filename.endswith('.json'):
+                    with open(os.path.join(spool, filename)) as fp:
+                        entries.append(json.load(fp))
+            if entries:
+                self.charts_connector.update_chart_index(entries)
+        finally:
+            shutil.rmtree(spool, ignore_errors=True)
 
 
 class ArtifactoryRemote(windlass.api.Remote):
@@ -22,7 +22,10 @@ Test support code for modules that use windlass
 
 import base64
 import contextlib
+import datetime
+import json
 import logging
+import time
 
 import botocore.stub
 
@@ -31,6 +34,72 @@ import windlass.remotes
 log = logging.getLogger(__name__)
 
 
+def stub_get_authorization_token(stubber, registry, username='test_username',
+                                 password='test_password', expires_in=43200):
+    """Stub a docker login to registry, expiring in expires_in seconds"""
+    auth_resp = {'authorizationData': [{
+        'proxyEndpoint': 'https://%s' % registry,
+        'authorizationToken': base64.b64encode(
+            ('%s:%s' % (username, password)).encode('utf-8')
+        ).decode('utf-8'),
+        'expiresAt': datetime.datetime.fromtimestamp(
+            time.time() + expires_in, datetime.timezone.utc),
+    }]}
+    stubber.add_response('get_authorization_token', auth_resp, {})
+
+
+def stub_describe_repositories(stubber, names, existing):
+    """Stub looking up the repositories names, of which existing exist"""
+    inp = {'repositoryNames': names}
+    if set(names) - set(existing):
+        stubber.add_client_error(
+            'describe_repositories', 'RepositoryNotFoundException',
+            expected_params=inp,
+        )
+        return
+    resp = {'repositories': [{'repositoryName': name} for name in names]}
+    stubber.add_response('describe_repositories', resp, inp)
+
+
+def stub_batch_get_image(stubber, repository, tags, images):
+    """Stub getting the images of repository tagged tags
+
+    images maps the tags in the repository to the config digest of their
+    image, which is the image id docker gives the image.
+    """
+    inp = {
+        'repositoryName': repository,
+        'imageIds': [{'imageTag': tag} for tag in tags],
+        'acceptedMediaTypes': windlass.remotes.ECR_MANIFEST_TYPES,
+    }
+    resp = {'images': [], 'failures': []}
+    for tag in tags:
+        if tag not in images:
+            resp['failures'].append({
+                'imageId': {'imageTag': tag},
+                'failureCode': 'ImageNotFound',
+                'failureReason': 'Requested image not found',
+            })
+            continue
+        manifest = {
+            'schemaVersion': 2,
+            'mediaType': windlass.remotes.ECR_MANIFEST_TYPES[0],
+            'config': {
+                'mediaType': 'application/vnd.docker.container.image.v1+json',
+                'digest': images[tag],
+                'size': 1024,
+            },
+            'layers': [],
+        }
+        resp['images'].append({
+            'repositoryName': repository,
+            'imageId': {'imageTag': tag, 'imageDigest': 'sha256:' + '0' * 64},
+            'imageManifest': json.dumps(manifest),
+            'imageManifestMediaType': windlass.remotes.ECR_MANIFEST_TYPES[0],
+        })
+    stubber.add_response('batch_get_image', resp, inp)
+
+
 class FakeECRConnector(windlass.remotes.ECRConnector):
     """A subclass of ECRConnector to enable testing
 
@@ -59,14 +128,7 @@ class FakeECRConnector(windlass.remotes.ECRConnector):
     def _init_stubber(self, client):
         stubber = botocore.stub.Stubber(client)
         stubber.activate()
-
-        auth_resp = {'authorizationData': [{
-            'proxyEndpoint': 'https://%s' % self._aws_urn,
-            'authorizationToken': base64.b64encode(
-                b'test_username:test_password'
-            ).decode('utf-8'),
-        }]}
-        stubber.add_response('get_authorization_token', auth_resp, {})
+        stub_get_authorization_token(stubber, self._aws_urn)
         return stubber
 
     def get_ecrc(self):
@@ -74,6 +136,14 @@ class FakeECRConnector(windlass.remotes.ECRConnector):
         self._init_stubber(client)
         return client
 
+    def find_existing_repos(self, names, ecrc=None):
+        # All repositories exist in the fake registry.
+        return set(names)
+
+    def find_images(self, repository, tags, ecrc=None):
+        # But there are no images in them.
+        return {}
+
     def upload(self, local_name, upload_name=None, upload_tag=None):
 
         # TODO(desbonne): Refactor windlass.remotes.ECRConnector to separate
@@ -95,6 +165,10 @@ class FakeS3Connector(windlass.remotes.S3Connector):
     def upload(self, upload_name, stream):
         return self._obj_url(upload_name)
 
+    def upload_chart(self, upload_name, stream):
+        # No index entry, so there's no index.yaml to update.
+        return self.upload(upload_name, stream), None
+
 
 class FakeAWSRemote(windlass.remotes.AWSRemote):
 
@@ -13,7 +13,91 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import contextlib
+import hashlib
 import os
+import shutil
+import uuid
+
+CACHE_DIR_ENV = 'WINDLASS_CACHE_DIR'
+
+
+def cache_dir(*parts):
+    """Directory to keep windlass state in between runs and processes
+
+    Defaults to windlass under $XDG_CACHE_HOME or ~/.cache, and is
+    overridden by setting WINDLASS_CACHE_DIR. Created if missing.
+    """
+    base = os.environ.get(CACHE_DIR_ENV)
+    if not base:
+        base = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'),
+            'windlass')
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def sha256sum(path, chunk_size=1024 * 1024):
+    """Hex sha256 digest of the file at path"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode=0o666):
+    """Open a temporary file to write, moved over path on success
+
+    Readers of path, and other processes writing it, never see a partial
+    file. The temporary file is removed if an exception is raised. The file
+    is created with the permissions mode, less the umask.
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    tmp = os.path.join(
+        dirname, '.%s.%s.part' % (basename, uuid.uuid4().hex))
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        with os.fdopen(fd, 'wb') as fp:
+            yield fp
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def link_or_copy(src, dst):
+    """Hard link the file src to dst, or copy it if it can't be linked
+
+    dst is replaced atomically.
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    dirname, basename = os.path.split(os.path.abspath(dst))
+    tmp = os.path.join(
+        dirname, '.%s.%s.part' % (basename, uuid.uuid4().hex))
+    try:
+        os.link(src, tmp)
+    except FileNotFoundError:
+        # There's nothing to copy either.
+        raise
+    except OSError:
+        # On another filesystem, or links aren't supported.
+        with open(src, 'rb') as fp, atomic_open(dst) as out:
+            shutil.copyfileobj(fp, out, 1024 * 1024)
+        return
+    try:
+        os.replace(tmp, dst)
+    finally:
+        # Left behind if dst was linked to src in the meantime.
+        if os.path.exists(tmp):
+            os.remove(tmp)
 
 
 def load_proxy():
@@ -0,0 +1,251 @@
+#
+# (c) Copyright 2019 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Shared HTTP sessions
+
+All HTTP requests made by windlass go through sessions from get_session(),
+so that connections to a host are kept alive and reused for the following
+requests instead of repeating the TCP and TLS handshakes. Sessions are kept
+per worker process, as connections can't be shared with forked processes.
+
+Defaults can be changed through the environment, which is inherited by the
+worker processes:
+
+WINDLASS_HTTP_TIMEOUT
+    Seconds to wait to connect, and between bytes read. Either a single
+    number or "connect,read".
+WINDLASS_HTTP_RETRIES
+    Number of times to retry requests failing to connect, and GET and HEAD
+    requests getting a gateway or unavailable error.
+WINDLASS_HTTP_POOL_SIZE
+    Maximum number of connections kept open to each host.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import urllib.parse
+
+import requests
+import requests.adapters
+import requests.auth
+import urllib3.util.retry
+
+TIMEOUT_ENV = 'WINDLASS_HTTP_TIMEOUT'
+RETRIES_ENV = 'WINDLASS_HTTP_RETRIES'
+POOL_SIZE_ENV = 'WINDLASS_HTTP_POOL_SIZE'
+
+DEFAULT_TIMEOUT = (30, 300)
+DEFAULT_RETRIES = 3
+DEFAULT_POOL_SIZE = 16
+CA_PATH = '/etc/ssl/certs'
+CHUNK_SIZE = 1024 * 1024
+
+# Sessions by (pid, auth).
+_sessions = {}
+_lock = threading.Lock()
+# Hosts found not to support Artifactory's checksum deploy.
+_no_checksum_deploy = set()
+
+
+def _timeout_from_env():
+    value = os.environ.get(TIMEOUT_ENV)
+    if not value:
+        return DEFAULT_TIMEOUT
+    parts = [float(v) for v in value.split(',')]
+    if len(parts) == 1:
+        return parts[0]
+    return tuple(parts)
+
+
+class Session(requests.Session):
+    """requests session with pooled connections, retries and a timeout
+
+    The timeout applies to requests not passing one.
+    """
+
+    def __init__(self, timeout=None, retries=None, pool_size=None,
+                 verify=CA_PATH):
+        super().__init__()
+        self.timeout = timeout or _timeout_from_env()
+        if retries is None:
+            retries = int(os.environ.get(RETRIES_ENV, DEFAULT_RETRIES))
+        pool_size = pool_size or int(
+            os.environ.get(POOL_SIZE_ENV, DEFAULT_POOL_SIZE))
+        self.verify = verify
+
+        # Only retry requests which are safe to send again, others,
+        # uploads in particular, are retried by windlass.retry.
+        retry = urllib3.util.retry.Retry(
+            total=retries,
+            read=0,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+def get_session(username=None, password=None):
+    """Get the session of this process for the credentials
+
+    Requests made with the session are authenticated with HTTP basic auth
+    when a username is given.
+    """
+    key = (os.getpid(), username, password)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            # Drop sessions inherited from the parent process.
+            for k in [k for k in _sessions if k[0] != key[0]]:
+                del _sessions[k]
+            session = _sessions[key] = Session()
+            if username is not None:
+                session.auth = requests.auth.HTTPBasicAuth(
+                    username, password)
+        return session
+
+
+class ProgressReader(object):
+    """File object reporting the progress of reading another
+
+    Reads are passed on to fp, and callback is called with the number of
+    bytes read so far and the size after each of them. The size defaults
+    to what is left of the file, found when first needed. len() is the
+    size, so that requests sets the Content-Length of uploads instead of
+    sending them chunked.
+    """
+
+    def __init__(self, fp, size=None, callback=None):
+        self.fp = fp
+        self.start = fp.tell()
+        self._size = size
+        self.callback = callback
+        self.bytes_read = 0
+
+    @property
+    def size(self):
+        if self._size is None:
+            try:
+                self._size = os.fstat(self.fp.fileno()).st_size - self.start
+            except (AttributeError, OSError):
+                # Not a file, ask the file object.
+                pos = self.fp.tell()
+                self._size = self.fp.seek(0, os.SEEK_END) - self.start
+                self.fp.seek(pos)
+        return self._size
+
+    def __len__(self):
+        return self.size
+
+    def seekable(self):
+        return self.fp.seekable()
+
+    def tell(self):
+        return self.fp.tell() - self.start
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            offset += self.start
+        self.fp.seek(offset, whence)
+        self.bytes_read = self.tell()
+        return self.bytes_read
+
+    def __iter__(self):
+        return iter(lambda: self.read(CHUNK_SIZE), b'')
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        if data:
+            self.bytes_read += len(data)
+            if self.callback:
+                self.callback(self.bytes_read, self.size)
+        return data
+
+    def close(self):
+        self.fp.close()
+
+
+def log_progress(name, step=10):
+    """Progress callback logging every step percent of an upload"""
+    logged = [0]
+
+    def callback(done, total):
+        percent = done * 100 // total if total else 100
+        if percent - logged[0] >= step or (
+                done >= total and percent > logged[0]):
+            logged[0] = percent
+            logging.info('%s: uploaded %d%% (%d of %d bytes)',
+                         name, percent, done, total)
+    return callback
+
+
+def checksum_headers(fp):
+    """Artifactory checksum headers of the rest of the seekable file fp
+
+    Both checksums are computed in a single pass, and fp is then rewound.
+    """
+    start = fp.tell()
+    sha1 = hashlib.sha1()
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+        sha1.update(chunk)
+        sha256.update(chunk)
+    fp.seek(start)
+    return {
+        'X-Checksum-Sha1': sha1.hexdigest(),
+        'X-Checksum-Sha256': sha256.hexdigest(),
+    }
+
+
+def checksum_deploy(session, url, headers):
+    """Deploy content Artifactory already has by its checksums
+
+    headers are from checksum_headers(). Returns True if the content was
+    deployed to url without sending it. Otherwise it has to be uploaded,
+    passing the same headers so that Artifactory verifies it.
+    """
+    host = urllib.parse.urlsplit(url).netloc
+    if host in _no_checksum_deploy:
+        return False
+    resp = session.put(
+        url, headers=dict(headers, **{'X-Checksum-Deploy': 'true'}))
+    # Artifactory answers 404 when it doesn't have the content.
+    if resp.status_code != 201:
+        return False
+    try:
+        deployed = resp.json()['checksums']['sha1'] == \
+            headers['X-Checksum-Sha1']
+    except (ValueError, KeyError, TypeError):
+        deployed = False
+    if not deployed:
+        # Not Artifactory, the empty content stored is overwritten by the
+        # upload that follows.
+        logging.debug('%s does not support checksum deploy', host)
+        _no_checksum_deploy.add(host)
+        return False
+    logging.info('Deployed %s by checksum', url)
+    return True
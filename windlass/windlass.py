@@ -21,6 +21,8 @@ import os
 import sys
 
 import windlass.api
+import windlass.daemons
+import windlass.images
 import windlass.pins
 import windlass.registries
 import windlass.remotes
@@ -116,6 +118,14 @@ configuration''')
                             default=[],
                             help='Generic artifact repositories')
 
+    parser.add_argument('--registry-transfer', action='store_true',
+                        help='''Pull, push and promote images with the
+registry v2 API instead of the docker daemon. Images downloaded are copied
+from registry to registry when pushed, or pulled into --oci-layout-dir.''')
+    parser.add_argument('--oci-layout-dir', type=str,
+                        help='''Directory of the OCI image layouts of images
+downloaded, or to push, with --registry-transfer.''')
+
     parser.add_argument('--download-version', type=str,
                         help='Specify version of artifacts.')
     parser.add_argument('--push-version', type=str,
@@ -132,6 +142,12 @@ WORKSPACE or else if that isn't present to your parent directory.''')
                         help='''Set size of the process pool. This is the
 amount of artifacts to process at any one time.''')
 
+    parser.add_argument('--docker-host', action='append', default=[],
+                        help='''Docker daemon to build and push images on.
+Repeat to spread the work over several daemons, each build or pull goes to the
+daemon with the fewest jobs running. Defaults to the daemon set by
+DOCKER_HOST.''')
+
     ns = parser.parse_args()
 
     # Setup ns.workspace if it is not specified.
@@ -156,6 +172,11 @@ amount of artifacts to process at any one time.''')
 
     windlass.api.setupLogging(ns.debug, ns.timestamps)
 
+    if ns.docker_host:
+        # Set in the environment so that it is inherited by the workers.
+        os.environ[windlass.daemons.DOCKER_HOSTS_ENV] = ','.join(
+            ns.docker_host)
+
     # We have specified a product integration repository. Load all
     # artifacts from the configuration in this repository.
     if ns.product_integration_repo:
@@ -178,6 +199,16 @@ amount of artifacts to process at any one time.''')
     # for each docker registry, build a config object, can also be
     # read in from a config file in the future
 
+    if not ns.no_push and not ns.build_only:
+        images = [
+            (artifact.imagename, ns.push_version or artifact.version)
+            for artifact in g.artifacts
+            if isinstance(artifact, windlass.images.Image) and
+            ns.artifact_name in (None, artifact.name)
+        ]
+        for registry in ns.push_docker_registry:
+            registry.connector.prepare(images)
+
     try:
         g.run(
             process,
@@ -186,7 +217,9 @@ amount of artifacts to process at any one time.''')
             # following args are for the process function
             ns=ns,
             docker_user=docker_user,
-            docker_password=docker_password)
+            docker_password=docker_password,
+            registry_transfer=ns.registry_transfer,
+            oci_layout_dir=ns.oci_layout_dir)
     except windlass.exc.WindlassException:
         logging.error('Exited due to error.')
         sys.exit(1)